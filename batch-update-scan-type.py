@@ -10,12 +10,8 @@ logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.ERROR)
 
 VER=0.1
 
-try:
-    import requests
-except:
-    print('please type "pip install requests" for installing request package')
-
-requests.packages.urllib3.disable_warnings()
+from xnat_transfer.client import XnatClient
+from xnat_transfer.session import SessionManager
 
 
 class XnatExport:
@@ -26,18 +22,20 @@ class XnatExport:
         data_dirs = self.scan_root_dir() 
         data_dir = data_dirs[0]
         self.auth_info = self.load_config(data_dir)
-        self.session_id = None
-        self.authErr = 0
+        self.client = XnatClient(self.XNAT_BASE_URL, self.auth_info, self.pool_size, sessions=self.sessions)
         #self.listProjects(auth_info)
 
     def scan_root_dir(self): 
         data_dirs = [] 
-        for item in os.listdir('.'): 
+        for item in sorted(os.listdir('.')): 
             if (os.path.isdir(item)): 
-                if (item[:1] != '.'): 
+                # the directories holding config.ini, not the python packages
+                if (item[:1] != '.' and os.path.isfile(os.path.join(item, self.XNAT_CONF_NAME))): 
                     data_dirs.append(os.path.abspath( 
                         os.path.join(os.getcwd(), item))) 
  
+        if not data_dirs:
+            sys.exit('please run the scan type updater next to data/{0}'.format(self.XNAT_CONF_NAME))
         return data_dirs 
 
     def load_config(self, dir):
@@ -49,6 +47,8 @@ class XnatExport:
             username = config.get('xnat', 'username')
             password = config.get('xnat', 'password')
             xnat_url = config.get('xnat', 'url')
+            self.pool_size = config.getint('xnat', 'pool_size', fallback=XnatClient.DEFAULT_POOL_SIZE)
+            self.sessions = SessionManager.from_config(config, xnat_url, username)
 
             # side effect?
             self.XNAT_BASE_URL = xnat_url
@@ -60,41 +60,15 @@ class XnatExport:
         except:
             raise
 
-    def session_request(self):
-        if self.authErr >= 2:
-            raise
-
-        auth_info = self.auth_info
-        api_url = '/'.join([self.XNAT_BASE_URL, 'data', 'JSESSION'])
-        r = requests.get(api_url, auth=(auth_info[0], auth_info[1]), verify=False)
-        if r.status_code < 400:
-            self.session_id = r.text
-            self.authErr = 0
-            return True
-        elif r.status_code == 401:
-            logging.error('please check the status of api {0}'.format(api_url))
-            logging.error(r.status_code)
-            logging.error(r.text)
-            print(r.text)
-            self.authErr = self.authErr + 1
-            raise EOFError
-        else:
-            logging.error('please check the status of api {0}'.format(api_url))
-            logging.error(r.status_code)
-            logging.error(r.text)
-            print(r.text)
-            raise EOFError
-
     def xnatapi(self, api, action='get', raw=0):
-        cookies = dict(JSESSIONID=self.session_id)
         api_url = "{0}/data/archive/{1}".format(self.XNAT_BASE_URL, api)
         print(api_url)
 
         if action == 'get':
             api_url = '{0}?format=json'.format(api_url)
-            r = requests.get(api_url, cookies=cookies, verify=False)
+            r = self.client.get(api_url)
         elif action == 'put':
-            r = requests.put(api_url, cookies=cookies, verify=False)
+            r = self.client.put(api_url)
         else:
             logging.error('please check api action {0}'.format(action))
             raise EOFError
@@ -103,9 +77,6 @@ class XnatExport:
             logging.info('api:{0} successfully!'.format(api_url))
             if raw == 1:
                 return r
-        elif r.status_code == 401:
-            if self.session_request() == True:
-                return self.xnatapi(api, action, raw)
         else:
             if raw == 1:
                 return r
@@ -178,9 +149,12 @@ class XnatExport:
         print("Collection: ", file['collection'])
 
     def downloadFile(self, fileName, link):
-        auth_info = self.auth_info
-        r = requests.get(link, auth=(auth_info[0], auth_info[1]), verify=False, allow_redirects=True)
-        open(fileName, 'wb').write(r.content)
+        # an error answer (e.g. an expired session) is not written to fileName
+        r, size = self.client.download(link, fileName, allow_redirects=True)
+        if size is None:
+            logging.error('download of {0} failed: {1}'.format(link, r.status_code))
+            return False
+        return True
 
     def exportProject(self, project):
         print(project)
@@ -0,0 +1,62 @@
+"""
+    files/s of DICOM routing metadata extraction:
+    full dcmread (the importer before header-only parsing) vs. header-only
+    reads, inline and in a process pool
+
+    python -m benchmarks.bench_dicom_headers [--files N] [--rows N] [--processes N]
+"""
+import argparse
+import concurrent.futures
+import os
+import tempfile
+import time
+
+import pydicom
+
+from benchmarks.synthetic import make_tree
+from xnat_transfer import dicom
+
+
+def full_read(file_name):
+    ds = pydicom.dcmread(file_name)
+    return str(ds.PatientName), ds.StudyDate, ds.Modality
+
+
+def timed(name, count, function):
+    start = time.time()
+    function()
+    elapsed = time.time() - start
+    print('{0:<32} {1:10.1f} files/s'.format(name, count / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=400)
+    parser.add_argument('--rows', type=int, default=512)
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 2)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        scans = 4
+        make_tree(root, subjects=1, scans=scans, files=args.files // scans, rows=args.rows, columns=args.rows)
+        scan_dirs = []
+        for dir_path, dir_names, file_names in os.walk(root):
+            if file_names:
+                scan_dirs.append([os.path.join(dir_path, name) for name in sorted(file_names)])
+        all_files = [name for names in scan_dirs for name in names]
+        count = len(all_files)
+        print('{0} files of {1}x{1} pixels, {2} processes'.format(count, args.rows, args.processes))
+
+        timed('full dcmread', count, lambda: [full_read(name) for name in all_files])
+        timed('header-only', count, lambda: [dicom.read_routing_header(name) for name in all_files])
+        with concurrent.futures.ProcessPoolExecutor(args.processes) as executor:
+            # warm up the workers so process start-up is not measured
+            list(executor.map(dicom.read_routing_header, all_files[:args.processes]))
+            timed('header-only, verify all, pool', count, lambda: list(
+                executor.map(dicom.read_directory_header, scan_dirs, [True] * len(scan_dirs))))
+            timed('header-only, pool', count, lambda: list(
+                executor.map(dicom.read_routing_header, all_files, chunksize=32)))
+
+
+if __name__ == '__main__':
+    main()
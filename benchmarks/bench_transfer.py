@@ -0,0 +1,237 @@
+"""
+    end-to-end throughput of the scripts against the mock XNAT server
+    (benchmarks/mock_xnat.py): project-importer.py, project-export.py and
+    batch-update-scan-type.py run one after the other over a synthetic
+    DICOM tree, each in its own process
+
+    reports files/s, MB/s, requests (per method and status), injected
+    faults and the peak RSS of each script
+
+    import-async imports the tree again with --engine async after the
+    server was emptied, to compare both engines; the resync tool rewrites --changed-files files of the tree with new
+    content and runs the importer again, as when re-syncing a partially
+    changed study
+
+    python -m benchmarks.bench_transfer [--subjects N] [--scans N] [--files N] [--rows N]
+        [--latency S] [--bandwidth BYTES/S] [--bandwidth-limit RATE] [--error-rate R] [--drop-rate R] [--session-ttl S]
+        [--tools import,import-async,export,update,resync] [--importer-args "--workers 8 --upload-mode archive"]
+"""
+import argparse
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.mock_xnat import DEFAULT_PASSWORD, DEFAULT_USERNAME, MockXnatServer
+from benchmarks.synthetic import PIXELS, make_dicom, make_tree
+from xnat_transfer import dicom
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TOOLS = {
+    # name: (script, counters of the mock server giving files and bytes)
+    'import': ('project-importer.py', 'files_in', 'stored_bytes_in'),
+    # the same import on the asyncio engine, into an emptied server
+    'import-async': ('project-importer.py', 'files_in', 'stored_bytes_in'),
+    'export': ('project-export.py', 'files_out', 'bytes_out'),
+    'update': ('batch-update-scan-type.py', 'scan_updates', None),
+    'resync': ('project-importer.py', 'files_in', 'stored_bytes_in'),
+}
+
+CONFIG = """[xnat]
+url={url}
+username={username}
+password={password}
+pool_size={pool_size}
+session_cache=sessions.json
+session_max_age={session_max_age}
+
+[transfer]
+journal=
+history=
+
+[export]
+workers={export_workers}
+listing_workers={export_listing_workers}
+
+[metrics]
+progress=false
+
+[bandwidth]
+limit={bandwidth_limit}
+"""
+
+
+def run_tool(server, root, name, argv, log):
+    """Run one script in its own process; returns its row of results"""
+    script, files_key, bytes_key = TOOLS[name]
+    server.reset_stats()
+    log.write('\n===== {0} {1}\n'.format(script, ' '.join(argv)))
+    log.flush()
+    start = time.time()
+    process = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, script)] + argv,
+                               cwd=root, stdout=log, stderr=subprocess.STDOUT)
+    peak_rss = None
+    cpu_seconds = None
+    if hasattr(os, 'wait4'):
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        # kilobytes on Linux, bytes on macOS
+        peak_rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        cpu_seconds = usage.ru_utime + usage.ru_stime
+    else:
+        process.wait()
+    elapsed = time.time() - start
+
+    stats = json.loads(json.dumps(server.stats))
+    status = stats['status']
+    files = stats[files_key]
+    nbytes = stats[bytes_key] if bytes_key else 0
+    wire_bytes = stats['bytes_in'] + stats['bytes_out']
+    return {
+        'tool': name,
+        'exit_code': process.returncode,
+        'seconds': round(elapsed, 3),
+        'files': files,
+        'bytes': nbytes,
+        'files_per_second': round(files / elapsed, 2),
+        'mb_per_second': round(nbytes / 1e6 / elapsed, 3),
+        'wire_bytes': wire_bytes,
+        'requests': stats['requests'],
+        'methods': stats['methods'],
+        'status': status,
+        'unauthorized': status.get('401', 0),
+        'server_errors': sum(count for code, count in status.items() if code.startswith('5')),
+        'dropped': stats['drops_injected'],
+        'sessions_created': stats['sessions_created'],
+        'peak_rss_mb': round(peak_rss / 1e6, 1) if peak_rss else None,
+        'cpu_seconds': round(cpu_seconds, 2) if cpu_seconds is not None else None,
+    }
+
+
+def change_files(root, count, rows, pixels):
+    """Rewrite count DICOM files of the tree with new pixels (same routing tags)"""
+    changed = 0
+    for dir_path, dir_names, file_names in sorted(os.walk(os.path.join(root, 'data', 'projects'))):
+        dir_names.sort()
+        for name in sorted(file_names):
+            if changed == count:
+                return changed
+            path = os.path.join(dir_path, name)
+            header = dicom.read_routing_header(path)
+            make_dicom(path, header['PatientName'], header['StudyDate'], header['Modality'], rows, rows, pixels)
+            changed += 1
+    return changed
+
+
+def print_table(rows):
+    header = '{0:<12} {1:>4} {2:>8} {3:>7} {4:>9} {5:>9} {6:>8} {7:>8} {8:>8} {9:>6} {10:>5} {11:>5} {12:>5} {13:>8} {14:>7}'
+    print(header.format('tool', 'exit', 'seconds', 'files', 'files/s', 'MB/s', 'wire MB', 'requests', 'GET/PUT',
+                        'auth', '401', '5xx', 'drop', 'RSS MB', 'CPU s'))
+    for row in rows:
+        methods = '{0}/{1}'.format(row['methods'].get('GET', 0), row['methods'].get('PUT', 0))
+        print(header.format(row['tool'], row['exit_code'], row['seconds'], row['files'], row['files_per_second'],
+                            row['mb_per_second'], round(row['wire_bytes'] / 1e6, 2), row['requests'], methods,
+                            row['sessions_created'], row['unauthorized'], row['server_errors'], row['dropped'],
+                            row['peak_rss_mb'], row['cpu_seconds']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--projects', type=int, default=1)
+    parser.add_argument('--subjects', type=int, default=4)
+    parser.add_argument('--scans', type=int, default=3)
+    parser.add_argument('--files', type=int, default=50, help='files per scan')
+    parser.add_argument('--rows', type=int, default=256, help='rows and columns of each image')
+    parser.add_argument('--pixels', choices=PIXELS, default='random',
+                        help='random (incompressible), image (compresses like a CT slice) or jpeg (JPEG transfer syntax)')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every answer')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--bandwidth', type=float, default=0.0, help='bytes/s of the link, 0 for unlimited')
+    parser.add_argument('--bandwidth-limit', default='0',
+                        help='[bandwidth] limit of the scripts (e.g. 2M), 0 for none')
+    parser.add_argument('--session-ttl', type=float, default=0.0, help='seconds a JSESSIONID stays valid')
+    parser.add_argument('--expire-rate', type=float, default=0.0, help='share of requests answered 401')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered 503')
+    parser.add_argument('--retry-after', type=int, default=0)
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='share of connections dropped')
+    parser.add_argument('--corrupt-rate', type=float, default=0.0, help='share of uploaded files stored corrupted')
+    parser.add_argument('--accept-gzip', action='store_true', help='decode gzip-encoded request bodies')
+    parser.add_argument('--pool-size', type=int, default=10)
+    parser.add_argument('--tools', default='import,export,update')
+    parser.add_argument('--async-concurrency', type=int, default=100, help='uploads in flight of import-async')
+    parser.add_argument('--export-workers', type=int, default=8, help='parallel downloads of project-export.py')
+    parser.add_argument('--export-listing-workers', type=int, default=4, help='listing threads of project-export.py')
+    parser.add_argument('--changed-files', type=int, default=10, help='files rewritten before the resync tool runs')
+    parser.add_argument('--importer-args', default='', help='extra arguments of project-importer.py')
+    parser.add_argument('--json', metavar='FILE', help='also write the results as JSON')
+    parser.add_argument('--keep', metavar='DIR', help='build the tree in DIR and keep it (and the tool logs)')
+    args = parser.parse_args()
+
+    tools = [name.strip() for name in args.tools.split(',') if name.strip()]
+    for name in tools:
+        if name not in TOOLS:
+            parser.error('unknown tool {0}, expected some of {1}'.format(name, ','.join(TOOLS)))
+
+    workdir = None
+    if args.keep:
+        root = os.path.abspath(args.keep)
+        os.makedirs(root, exist_ok=True)
+    else:
+        workdir = tempfile.TemporaryDirectory()
+        root = workdir.name
+
+    try:
+        count, total = make_tree(root, args.projects, args.subjects, args.scans, args.files, args.rows, args.rows,
+                                 pixels=args.pixels)
+        print('{0} files, {1:.1f} MB in {2} project(s) x {3} subjects x {4} scans'.format(
+            count, total / 1e6, args.projects, args.subjects, args.scans))
+
+        server = MockXnatServer(latency=args.latency, jitter=args.jitter, bandwidth=args.bandwidth,
+                                session_ttl=args.session_ttl, expire_rate=args.expire_rate,
+                                error_rate=args.error_rate, retry_after=args.retry_after, drop_rate=args.drop_rate,
+                                corrupt_rate=args.corrupt_rate, accept_gzip=args.accept_gzip)
+        server.serve_in_thread()
+        with open(os.path.join(root, 'data', 'config.ini'), 'w') as fh:
+            fh.write(CONFIG.format(url=server.url, username=DEFAULT_USERNAME, password=DEFAULT_PASSWORD,
+                                   pool_size=args.pool_size, bandwidth_limit=args.bandwidth_limit,
+                                   session_max_age=args.session_ttl, export_workers=args.export_workers,
+                                   export_listing_workers=args.export_listing_workers))
+        print('mock XNAT at {0}: {1}'.format(server.url, json.dumps(server.config.to_dict())))
+
+        rows = []
+        with open(os.path.join(root, 'bench-transfer.log'), 'w') as log:
+            for name in tools:
+                argv = shlex.split(args.importer_args) if TOOLS[name][0] == 'project-importer.py' else []
+                if TOOLS[name][0] == 'project-importer.py':
+                    # project-export.py writes to data/export, which the importer would walk
+                    shutil.rmtree(os.path.join(root, 'data', 'export'), ignore_errors=True)
+                if name == 'import-async':
+                    argv += ['--engine', 'async', '--async-concurrency', str(args.async_concurrency)]
+                    server.archive.reset()
+                if name == 'resync':
+                    change_files(root, args.changed_files, args.rows, args.pixels)
+                rows.append(run_tool(server, root, name, argv, log))
+        print_table(rows)
+
+        for row in rows:
+            if row['exit_code'] != 0:
+                print('{0} failed, see {1}'.format(row['tool'], os.path.join(root, 'bench-transfer.log')))
+        for name in ('import', 'import-async'):
+            if name in tools and rows[tools.index(name)]['files'] != count:
+                print('warning: {0} of {1} files reached the server ({2})'.format(rows[tools.index(name)]['files'], count, name))
+        if args.json:
+            with open(args.json, 'w') as fh:
+                json.dump({'files': count, 'bytes': total, 'config': server.config.to_dict(), 'results': rows}, fh, indent=1)
+        server.shutdown()
+    finally:
+        if workdir is not None:
+            workdir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,667 @@
+"""
+    in-memory stand-in for the XNAT REST API used by the scripts of this
+    repository: JSESSION, projects / subjects / experiments / scans /
+    resources / reconstructions (PUT and GET), file listings, file
+    upload (also zips with extract=true) and download, session documents
+    (XML PUT with inbody=true) and the scan field updates of
+    batch-update-scan-type.py
+
+    latency, bandwidth and faults (expired sessions, 5xx answers,
+    dropped connections) are configurable, on the command line or
+    during a run with PUT /_mock/config (JSON body)
+
+    python -m benchmarks.mock_xnat [--port 8080] [--latency 0.02] [--bandwidth 10e6] ...
+"""
+import argparse
+import base64
+import gzip
+import hashlib
+import io
+import json
+import random
+import socket
+import threading
+import time
+import uuid
+import xml.etree.ElementTree as ET
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+DEFAULT_USERNAME = 'bench'
+DEFAULT_PASSWORD = 'bench'
+
+
+class MockConfig:
+    """Server behaviour; every field can be changed while running"""
+
+    FIELDS = {
+        'latency': 0.0,          # seconds added to every answer
+        'jitter': 0.0,           # up to this many seconds added at random
+        'bandwidth': 0.0,        # bytes/s of the link shared by all connections, 0 for unlimited
+        'session_ttl': 0.0,      # seconds a JSESSIONID stays valid, 0 for forever
+        'expire_rate': 0.0,      # share of requests whose session is expired (401) at random
+        'error_rate': 0.0,       # share of requests answered with error_status
+        'error_status': 503,
+        'retry_after': 0,        # Retry-After of the error answers, 0 to leave it out
+        'drop_rate': 0.0,        # share of requests whose connection is closed without an answer
+        'fault_methods': 'GET,PUT',  # methods subject to the faults above
+        'keep_bodies': True,     # keep uploaded bytes (needed for downloads); False keeps size and MD5 only
+        'corrupt_rate': 0.0,     # share of uploaded files stored with a flipped byte
+        'accept_gzip': False,    # decode Content-Encoding: gzip bodies; XNAT stores them as sent
+    }
+
+    def __init__(self, **kwargs):
+        for name, default in self.FIELDS.items():
+            setattr(self, name, default)
+        self.update(kwargs)
+
+    def update(self, values):
+        for name, value in values.items():
+            if name not in self.FIELDS:
+                raise KeyError(name)
+            if value is None:
+                continue
+            if isinstance(self.FIELDS[name], bool) and isinstance(value, str):
+                value = value.lower() in ('1', 'true', 'yes')
+            setattr(self, name, type(self.FIELDS[name])(value))
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.FIELDS)
+
+
+class Link:
+    """Bandwidth shared by every connection: each chunk waits for its turn"""
+
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.next_free = 0.0
+
+    def transfer(self, nbytes):
+        bandwidth = self.config.bandwidth
+        if bandwidth <= 0 or nbytes == 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_free)
+            self.next_free = start + nbytes / bandwidth
+            wait = self.next_free - now
+        time.sleep(wait)
+
+
+class StoredFile:
+    __slots__ = ('size', 'md5', 'data')
+
+    def __init__(self, data, keep):
+        self.size = len(data)
+        self.md5 = hashlib.md5(data).hexdigest()
+        self.data = data if keep else None
+
+    def content(self):
+        return self.data if self.data is not None else b'\0' * self.size
+
+
+class Archive:
+    """The XNAT data model, just deep enough for the scripts"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.projects = {}
+        self.experiments = {}
+        self.subject_count = 0
+        self.experiment_count = 0
+
+    def reset(self):
+        with self.lock:
+            self.projects.clear()
+            self.experiments.clear()
+            self.subject_count = 0
+            self.experiment_count = 0
+
+    def project(self, project_id, create=False):
+        project = self.projects.get(project_id)
+        if project is None and create:
+            project = self.projects[project_id] = {'ID': project_id, 'name': project_id, 'subjects': {}}
+        return project
+
+    def subject(self, project, name, create=False):
+        for subject in project['subjects'].values():
+            if name in (subject['ID'], subject['label']):
+                return subject
+        if not create:
+            return None
+        self.subject_count += 1
+        subject = {'ID': 'MOCK_S{0:05d}'.format(self.subject_count), 'label': name,
+                   'project': project['ID'], 'experiments': {}}
+        project['subjects'][name] = subject
+        return subject
+
+    def experiment(self, subject, name, create=False):
+        for experiment in subject['experiments'].values():
+            if name in (experiment['ID'], experiment['label']):
+                return experiment
+        if not create:
+            return None
+        self.experiment_count += 1
+        experiment = {'ID': 'MOCK_E{0:05d}'.format(self.experiment_count), 'label': name,
+                      'project': subject['project'], 'subject': subject, 'xsiType': 'xnat:mrSessionData',
+                      'date': '', 'scans': {}, 'resources': {}}
+        subject['experiments'][name] = experiment
+        self.experiments[experiment['ID']] = experiment
+        return experiment
+
+
+def result_set(rows):
+    return {'ResultSet': {'Result': rows, 'totalRecords': str(len(rows))}}
+
+
+def field_updates(query, suffix_names):
+    """xnat:ctScanData/type=... style query parameters, by field name"""
+    fields = {}
+    for key, value in query.items():
+        if '/' in key:
+            xsi_type, field = key.rsplit('/', 1)
+            if field in suffix_names:
+                fields[field] = value
+                fields['xsiType'] = xsi_type
+    return fields
+
+
+class MockXnatServer(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, address=('127.0.0.1', 0), username=DEFAULT_USERNAME, password=DEFAULT_PASSWORD, **config):
+        ThreadingHTTPServer.__init__(self, address, MockXnatHandler)
+        self.config = MockConfig(**config)
+        self.link = Link(self.config)
+        self.archive = Archive()
+        self.credentials = (username, password)
+        self.sessions = {}
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}'.format(*self.server_address[:2])
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.stats = {
+                'requests': 0, 'methods': {}, 'status': {}, 'endpoints': {},
+                'files_in': 0, 'bytes_in': 0, 'stored_bytes_in': 0, 'files_out': 0, 'bytes_out': 0,
+                'sessions_created': 0, 'sessions_expired': 0, 'errors_injected': 0, 'drops_injected': 0,
+                'scan_updates': 0,
+            }
+
+    def count(self, **increments):
+        with self.stats_lock:
+            for name, value in increments.items():
+                self.stats[name] += value
+
+    def count_in(self, name, key):
+        with self.stats_lock:
+            self.stats[name][key] = self.stats[name].get(key, 0) + 1
+
+    def new_session(self):
+        session_id = uuid.uuid4().hex.upper()
+        ttl = self.config.session_ttl
+        self.sessions[session_id] = time.monotonic() + ttl if ttl > 0 else None
+        self.count(sessions_created=1)
+        return session_id
+
+    def session_valid(self, session_id):
+        expires = self.sessions.get(session_id, 'gone')
+        if expires == 'gone':
+            return False
+        if expires is not None and time.monotonic() > expires:
+            self.expire_session(session_id)
+            return False
+        return True
+
+    def expire_session(self, session_id):
+        if self.sessions.pop(session_id, 'gone') != 'gone':
+            self.count(sessions_expired=1)
+
+    def serve_in_thread(self):
+        thread = threading.Thread(target=self.serve_forever, name='mock-xnat', daemon=True)
+        thread.start()
+        return thread
+
+
+class MockXnatHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'MockXNAT/1.0'
+    # headers and body go out in separate writes: without this, Nagle and
+    # delayed ACKs add ~40ms to every answer
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    # --- plumbing -----------------------------------------------------
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+                self.server.link.transfer(size)
+            return b''.join(chunks)
+        length = int(self.headers.get('Content-Length') or 0)
+        chunks = []
+        while length > 0:
+            chunk = self.rfile.read(min(length, 65536))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            length -= len(chunk)
+            self.server.link.transfer(len(chunk))
+        return b''.join(chunks)
+
+    def answer(self, status, body=b'', content_type='application/json', headers=()):
+        # only recorded here: the archive lock is released before sending
+        self.response = (status, body, content_type, headers)
+
+    def send_answer(self, status, body, content_type, headers):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        elif isinstance(body, str):
+            body = body.encode()
+            if content_type == 'application/json':
+                content_type = 'text/plain'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            for start in range(0, len(body), 65536):
+                chunk = body[start:start + 65536]
+                self.server.link.transfer(len(chunk))
+                self.wfile.write(chunk)
+
+    def drop(self):
+        self.close_connection = True
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def session_cookie(self):
+        for part in self.headers.get('Cookie', '').split(';'):
+            name, _, value = part.strip().partition('=')
+            if name == 'JSESSIONID':
+                return value
+        return None
+
+    def basic_auth_ok(self):
+        header = self.headers.get('Authorization', '')
+        if not header.startswith('Basic '):
+            return False
+        try:
+            username, _, password = base64.b64decode(header[6:]).decode().partition(':')
+        except ValueError:
+            return False
+        return (username, password) == self.server.credentials
+
+    def authenticated(self):
+        if self.basic_auth_ok():
+            return True
+        session_id = self.session_cookie()
+        if session_id is None or not self.server.session_valid(session_id):
+            return False
+        if self.server.config.expire_rate and random.random() < self.server.config.expire_rate:
+            self.server.expire_session(session_id)
+            return False
+        return True
+
+    def handle_any(self):
+        self.response = None
+        self.dispatch()
+        if self.response is not None:
+            if not self.path.startswith('/_mock/'):
+                self.server.count_in('status', str(self.response[0]))
+            self.send_answer(*self.response)
+
+    def dispatch(self):
+        server = self.server
+        config = server.config
+        url = urlsplit(self.path)
+        path = [unquote(part) for part in url.path.strip('/').split('/') if part]
+        query = dict(parse_qsl(url.query, keep_blank_values=True))
+        body = self.read_body() if self.command in ('PUT', 'POST') else b''
+
+        if path[:1] == ['_mock']:
+            return self.control(path[1:], body)
+
+        server.count(requests=1)
+        server.count_in('methods', self.command)
+        if config.latency or config.jitter:
+            time.sleep(config.latency + random.random() * config.jitter)
+
+        if self.command in config.fault_methods.split(','):
+            if config.drop_rate and random.random() < config.drop_rate:
+                server.count(drops_injected=1)
+                return self.drop()
+            if config.error_rate and random.random() < config.error_rate:
+                server.count(errors_injected=1)
+                headers = [('Retry-After', str(config.retry_after))] if config.retry_after else []
+                return self.answer(config.error_status, 'injected error', headers=headers)
+
+        if path[:1] != ['data']:
+            return self.answer(404, 'not found')
+        path = path[1:]
+        if path[:1] == ['archive']:
+            path = path[1:]
+
+        if path == ['JSESSION']:
+            server.count_in('endpoints', 'auth')
+            if not self.basic_auth_ok():
+                # like XNAT: a valid session cookie gets its own session back
+                session_id = self.session_cookie()
+                if session_id is not None and server.session_valid(session_id):
+                    return self.answer(200, session_id, 'text/plain')
+                return self.answer(401, 'bad credentials')
+            session_id = server.new_session()
+            return self.answer(200, session_id, 'text/plain',
+                               [('Set-Cookie', 'JSESSIONID={0}; Path=/; HttpOnly'.format(session_id))])
+        if not self.authenticated():
+            return self.answer(401, 'session expired', 'text/html')
+
+        with server.archive.lock:
+            return self.route(path, query, body)
+
+    do_GET = do_PUT = do_POST = do_DELETE = do_HEAD = handle_any
+
+    def control(self, path, body):
+        server = self.server
+        if path == ['stats']:
+            with server.stats_lock:
+                return self.answer(200, json.loads(json.dumps(server.stats)))
+        if path == ['config']:
+            if self.command == 'PUT':
+                try:
+                    server.config.update(json.loads(body.decode() or '{}'))
+                except (KeyError, ValueError) as e:
+                    return self.answer(400, 'bad config: {0}'.format(e))
+            return self.answer(200, server.config.to_dict())
+        if path == ['reset'] and self.command in ('PUT', 'POST'):
+            server.reset_stats()
+            return self.answer(200, 'ok')
+        if path == ['wipe'] and self.command in ('PUT', 'POST'):
+            server.archive.reset()
+            server.reset_stats()
+            return self.answer(200, 'ok')
+        return self.answer(404, 'unknown control path')
+
+    # --- the REST API -------------------------------------------------
+
+    def route(self, path, query, body):
+        archive = self.server.archive
+        put = self.command == 'PUT'
+        if path[:1] == ['projects']:
+            if len(path) == 1:
+                return self.listing('project', [{'ID': p['ID'], 'name': p['name'], 'URI': '/data/projects/' + p['ID']}
+                                                 for p in archive.projects.values()])
+            project = archive.project(path[1], create=put and len(path) == 2)
+            if project is None:
+                return self.missing('project')
+            if len(path) == 2:
+                return self.entity('project', put, {'ID': project['ID'], 'name': project['name']})
+            if path[2] == 'experiments' and len(path) == 3:
+                # like XNAT, the subject is only listed when asked for in columns
+                columns = query.get('columns', '').split(',')
+                rows = []
+                for s in project['subjects'].values():
+                    for e in s['experiments'].values():
+                        row = self.experiment_row(e)
+                        for name, value in (('subject_ID', s['ID']), ('subject_label', s['label'])):
+                            if name in columns:
+                                row[name] = value
+                        rows.append(row)
+                return self.listing('session', rows)
+            if path[2] != 'subjects':
+                return self.missing('other')
+            if len(path) == 3:
+                return self.listing('subject', [{'ID': s['ID'], 'label': s['label'], 'project': project['ID']}
+                                                for s in project['subjects'].values()])
+            subject = archive.subject(project, path[3], create=put and len(path) == 4)
+            if subject is None:
+                return self.missing('subject')
+            if len(path) == 4:
+                return self.entity('subject', put, {'ID': subject['ID'], 'label': subject['label']})
+            if path[4] != 'experiments':
+                return self.missing('other')
+            if len(path) == 5:
+                return self.listing('session', [self.experiment_row(e) for e in subject['experiments'].values()])
+            experiment = archive.experiment(subject, path[5], create=put and len(path) == 6)
+            if experiment is None:
+                return self.missing('session')
+            return self.in_experiment(experiment, path[6:], query, body)
+        if path[:1] == ['experiments'] and len(path) >= 2:
+            experiment = archive.experiments.get(path[1])
+            if experiment is None:
+                return self.missing('session')
+            return self.in_experiment(experiment, path[2:], query, body)
+        return self.missing('other')
+
+    def missing(self, endpoint):
+        self.server.count_in('endpoints', endpoint)
+        return self.answer(404, 'not found', 'text/html')
+
+    def listing(self, endpoint, rows):
+        self.server.count_in('endpoints', endpoint + '_listing')
+        if self.command != 'GET':
+            return self.answer(405, 'method not allowed')
+        return self.answer(200, result_set(rows))
+
+    def entity(self, endpoint, created, fields):
+        self.server.count_in('endpoints', endpoint)
+        if created:
+            return self.answer(200, fields.get('ID', ''), 'text/plain')
+        return self.answer(200, {'items': [{'data_fields': fields}]})
+
+    def experiment_row(self, experiment):
+        return {'ID': experiment['ID'], 'label': experiment['label'], 'xsiType': experiment['xsiType'],
+                'date': experiment['date'], 'project': experiment['project'],
+                'URI': '/data/experiments/' + experiment['ID']}
+
+    def in_experiment(self, experiment, path, query, body):
+        put = self.command == 'PUT'
+        if not path:
+            if put and query.get('inbody') == 'true':
+                return self.put_session_document(experiment, query, body)
+            if put:
+                for key, value in query.items():
+                    if key.endswith('SessionData/date'):
+                        experiment['xsiType'] = key.rsplit('/', 1)[0]
+                        experiment['date'] = value
+            return self.entity('session', put, self.experiment_row(experiment))
+        if path[0] == 'resources' or path[0] == 'files':
+            return self.in_resources(experiment['resources'], path, query, body, experiment['ID'], None)
+        if path[0] != 'scans':
+            return self.missing('other')
+        scans = experiment['scans']
+        if len(path) == 1:
+            return self.listing('scan', [dict((k, scan[k]) for k in ('ID', 'xsiType', 'type', 'quality'))
+                                         for scan in scans.values()])
+        scan = scans.get(path[1])
+        if len(path) == 2:
+            if put:
+                if scan is None:
+                    scan = scans[path[1]] = {'ID': path[1], 'xsiType': 'xnat:otherDicomScanData', 'type': '',
+                                             'quality': '', 'resources': {}, 'reconstructions': {}}
+                if 'xsiType' in query:
+                    scan['xsiType'] = query['xsiType']
+                fields = field_updates(query, ('type', 'quality'))
+                if 'type' in fields or 'quality' in fields:
+                    self.server.count(scan_updates=1)
+                scan.update(fields)
+            elif scan is None:
+                return self.missing('scan')
+            return self.entity('scan', put, dict((k, scan[k]) for k in ('ID', 'xsiType', 'type', 'quality')))
+        if scan is None:
+            return self.missing('scan')
+        if path[2] == 'reconstructions' and len(path) >= 4:
+            recon = scan['reconstructions'].setdefault(path[3], {}) if put else scan['reconstructions'].get(path[3])
+            if recon is None:
+                return self.missing('resource')
+            return self.in_resources(recon, path[4:], query, body, experiment['ID'], path[1])
+        return self.in_resources(scan['resources'], path[2:], query, body, experiment['ID'], path[1])
+
+    def put_session_document(self, experiment, query, body):
+        """xnat:*Session document with scans and their resources"""
+        self.server.count_in('endpoints', 'session_document')
+        try:
+            root = ET.fromstring(body)
+        except ET.ParseError as e:
+            return self.answer(400, 'invalid XML: {0}'.format(e), 'text/plain')
+        xnat = '{http://nrg.wustl.edu/xnat}'
+        xsi_type = '{http://www.w3.org/2001/XMLSchema-instance}type'
+        element = root.tag[len(xnat):] if root.tag.startswith(xnat) else root.tag
+        if element.endswith('Session'):
+            # CTSession -> xnat:ctSessionData, OtherDicomSession -> xnat:otherDicomSessionData
+            modality = element[:-len('Session')]
+            modality = modality.lower() if modality.isupper() else modality[0].lower() + modality[1:]
+            experiment['xsiType'] = 'xnat:{0}SessionData'.format(modality)
+        scans = experiment['scans']
+        # like a resource PUT, a catalog without URI cannot replace a resource holding files
+        for scan_element in root.iter(xnat + 'scan'):
+            scan = scans.get(scan_element.get('ID'))
+            for resource in scan_element.findall(xnat + 'file') if scan is not None else ():
+                if scan['resources'].get(resource.get('label')) and not resource.get('URI'):
+                    return self.answer(409, 'resource {0} of scan {1} already exists'.format(
+                        resource.get('label'), scan['ID']), 'text/plain')
+        experiment['date'] = root.findtext(xnat + 'date', experiment['date'])
+        listed = set()
+        for scan_element in root.iter(xnat + 'scan'):
+            scan_id = scan_element.get('ID')
+            listed.add(scan_id)
+            scan = scans.setdefault(scan_id, {'ID': scan_id, 'xsiType': 'xnat:otherDicomScanData', 'type': '',
+                                              'quality': '', 'resources': {}, 'reconstructions': {}})
+            scan['xsiType'] = scan_element.get(xsi_type, scan['xsiType'])
+            scan['type'] = scan_element.get('type', scan['type'])
+            scan['quality'] = scan_element.findtext(xnat + 'quality', scan['quality'])
+            for resource in scan_element.findall(xnat + 'file'):
+                scan['resources'].setdefault(resource.get('label'), {})
+        if query.get('allowDataDeletion', 'true') != 'false':
+            for scan_id in list(scans):
+                if scan_id not in listed:
+                    del scans[scan_id]
+        return self.answer(200, experiment['ID'], 'text/plain')
+
+    def in_resources(self, resources, path, query, body, experiment_id, scan_id):
+        put = self.command == 'PUT'
+        if path == ['files']:
+            return self.file_listing(resources, experiment_id, scan_id)
+        if path[0] != 'resources':
+            return self.missing('other')
+        if len(path) == 1:
+            return self.listing('resource', [{'label': label, 'file_count': str(len(files))}
+                                             for label, files in resources.items()])
+        label = path[1]
+        if len(path) == 2:
+            self.server.count_in('endpoints', 'resource')
+            if put:
+                if label in resources:
+                    return self.answer(409, 'resource {0} already exists'.format(label), 'text/plain')
+                resources[label] = {}
+                return self.answer(200, label, 'text/plain')
+            if label not in resources:
+                return self.missing('resource')
+            return self.answer(200, {'items': [{'data_fields': {'label': label}}]})
+        if path[2] != 'files':
+            return self.missing('other')
+        if len(path) == 3:
+            if label not in resources:
+                return self.missing('file_listing')
+            return self.file_listing({label: resources[label]}, experiment_id, scan_id)
+        name = '/'.join(path[3:])
+        if put:
+            return self.upload(resources.setdefault(label, {}), name, query, body)
+        if self.command == 'DELETE':
+            self.server.count_in('endpoints', 'file_delete')
+            if resources.get(label, {}).pop(name, None) is None:
+                return self.missing('file_delete')
+            return self.answer(200, '', 'text/plain')
+        stored = resources.get(label, {}).get(name)
+        if stored is None:
+            return self.missing('file_download')
+        self.server.count_in('endpoints', 'file_download')
+        self.server.count(files_out=1, bytes_out=stored.size)
+        return self.answer(200, stored.content(), 'application/octet-stream')
+
+    def file_listing(self, resources, experiment_id, scan_id):
+        prefix = '/data/experiments/{0}'.format(experiment_id)
+        if scan_id is not None:
+            prefix += '/scans/{0}'.format(scan_id)
+        rows = []
+        for label, files in resources.items():
+            for name, stored in files.items():
+                rows.append({'Name': name, 'Size': str(stored.size), 'digest': stored.md5, 'collection': label,
+                             'file_format': '', 'file_content': '', 'cat_ID': label,
+                             'URI': '{0}/resources/{1}/files/{2}'.format(prefix, label, name)})
+        return self.listing('file', rows)
+
+    def upload(self, files, name, query, body):
+        server = self.server
+        keep = server.config.keep_bodies
+        server.count_in('endpoints', 'file_upload')
+        server.count(bytes_in=len(body))
+        if server.config.accept_gzip and self.headers.get('Content-Encoding', '').lower() == 'gzip':
+            try:
+                body = gzip.decompress(body)
+            except OSError:
+                return self.answer(400, 'bad gzip body', 'text/plain')
+        if query.get('extract', '').lower() == 'true':
+            try:
+                with zipfile.ZipFile(io.BytesIO(body)) as bundle:
+                    for info in bundle.infolist():
+                        if not info.is_dir():
+                            stored = files[info.filename.rsplit('/', 1)[-1]] = StoredFile(bundle.read(info), keep)
+                            server.count(files_in=1, stored_bytes_in=stored.size)
+            except zipfile.BadZipFile:
+                return self.answer(400, 'not a zip file', 'text/plain')
+            return self.answer(200, '', 'text/plain')
+        if name in files and query.get('overwrite', '').lower() != 'true':
+            return self.answer(409, 'file {0} already exists'.format(name), 'text/plain')
+        if body and server.config.corrupt_rate and random.random() < server.config.corrupt_rate:
+            body = bytes([body[0] ^ 0xff]) + body[1:]
+        files[name] = StoredFile(body, keep)
+        server.count(files_in=1, stored_bytes_in=len(body))
+        return self.answer(200, '', 'text/plain')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='in-memory XNAT stand-in for benchmarks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--username', default=DEFAULT_USERNAME)
+    parser.add_argument('--password', default=DEFAULT_PASSWORD)
+    for name, default in MockConfig.FIELDS.items():
+        if isinstance(default, bool):
+            parser.add_argument('--' + name.replace('_', '-'), type=lambda v: v.lower() in ('1', 'true', 'yes'))
+        else:
+            parser.add_argument('--' + name.replace('_', '-'), type=type(default),
+                                help='default: {0}'.format(default))
+    args = parser.parse_args()
+    config = dict((name, getattr(args, name)) for name in MockConfig.FIELDS)
+    server = MockXnatServer((args.host, args.port), args.username, args.password, **config)
+    print('mock XNAT listening on {0} (user {1}, password {2})'.format(server.url, args.username, args.password))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
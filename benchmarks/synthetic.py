@@ -0,0 +1,102 @@
+"""
+    synthetic DICOM trees for the benchmarks
+
+    layout written by make_tree (the one project-importer.py expects):
+    <root>/data/projects/<project>/<subject>/<scan>/DICOM/<n>.dcm
+"""
+import array
+import os
+import random
+
+try:
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.encaps import encapsulate
+    from pydicom.uid import ExplicitVRLittleEndian, JPEGBaseline8Bit, CTImageStorage, generate_uid
+except:
+    print('please type "pip install pydicom" for installing pydicom package')
+
+
+# random: incompressible noise; image: smooth 12 bit values with a little
+# noise, deflates about like a CT slice; jpeg: JPEG transfer syntax
+# (encapsulated random bytes), i.e. already compressed
+PIXELS = ('random', 'image', 'jpeg')
+
+_images = {}
+
+
+def random_bytes(size):
+    return random.randbytes(size) if hasattr(random, 'randbytes') else os.urandom(size)
+
+
+def image_pixels(rows, columns):
+    key = (rows, columns)
+    if key not in _images:
+        values = array.array('H', bytes(rows * columns * 2))
+        for y in range(rows):
+            for x in range(columns):
+                distance = ((x - columns // 2) ** 2 + (y - rows // 2) ** 2) * 16 // (rows * columns // 4 + 1)
+                values[y * columns + x] = (1024 + 2048 // (1 + distance) + random.getrandbits(3)) & 0x0fff
+        _images[key] = values.tobytes()
+    return _images[key]
+
+
+def make_dicom(path, patient, study_date, modality='CT', rows=512, columns=512, pixels='random'):
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = CTImageStorage
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = JPEGBaseline8Bit if pixels == 'jpeg' else ExplicitVRLittleEndian
+
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.preamble = b'\0' * 128
+    ds.SOPClassUID = CTImageStorage
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.PatientName = patient
+    ds.PatientID = patient
+    ds.StudyDate = study_date
+    ds.Modality = modality
+    ds.Rows = rows
+    ds.Columns = columns
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    if pixels == 'jpeg':
+        ds.BitsAllocated = 8
+        ds.BitsStored = 8
+        ds.HighBit = 7
+        # about the size of a lossy JPEG of the slice
+        ds.PixelData = encapsulate([random_bytes(rows * columns // 4)])
+    elif pixels == 'image':
+        ds.PixelData = image_pixels(rows, columns)
+    else:
+        ds.PixelData = random_bytes(rows * columns * 2)
+    try:
+        ds.save_as(path, enforce_file_format=True)
+    except TypeError:
+        # pydicom < 3
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        ds.save_as(path, write_like_original=False)
+
+
+def make_tree(root, projects=1, subjects=2, scans=3, files=20, rows=256, columns=256, modality='CT', pixels='random'):
+    """Write a synthetic tree and return (file count, total bytes)"""
+    count = 0
+    total = 0
+    for p in range(projects):
+        for s in range(subjects):
+            patient = 'BENCH^P{0:03d}S{1:03d}'.format(p, s)
+            study_date = '2020{0:02d}{1:02d}'.format(1 + s % 12, 1 + s % 28)
+            for c in range(scans):
+                scan_dir = os.path.join(root, 'data', 'projects', 'bench_p{0}'.format(p),
+                                        'subject{0:03d}'.format(s), 'S{0}'.format(c), 'DICOM')
+                os.makedirs(scan_dir, exist_ok=True)
+                for f in range(files):
+                    path = os.path.join(scan_dir, 'IM{0:05d}.dcm'.format(f))
+                    make_dicom(path, patient, study_date, modality, rows, columns, pixels)
+                    count += 1
+                    total += os.path.getsize(path)
+    return count, total
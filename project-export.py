@@ -1,6 +1,10 @@
 import sys
 import configparser
+import errno
 import os
+import threading
+import traceback
+import concurrent.futures
 """
     print project file export 
 """
@@ -10,34 +14,55 @@ logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.ERROR)
 
 VER=0.1
 
-try:
-    import requests
-except:
-    print('please type "pip install requests" for installing request package')
-
-requests.packages.urllib3.disable_warnings()
+from xnat_transfer.client import XnatClient
+from xnat_transfer.metrics import Metrics, ProgressLine
+from xnat_transfer.ratelimit import BandwidthLimiter
+from xnat_transfer.session import SessionManager
 
 
 class XnatExport:
+    """Export of projects to data/export/<project>/<subject>/<experiment>/<scan>/<collection>.
+
+    Subjects, experiments and scans are listed by `listing_workers`
+    threads, which hand every file to a pool of `workers` download threads
+    as soon as its scan is listed: the listings of the next scans run while
+    the files of the first ones download. At most `workers` * 4 files wait
+    for a download thread, so the listings stay just ahead of the downloads
+    however large the project is.
+    """
     XNAT_CONF_NAME = 'config.ini'
     XNAT_BASE_URL = 'https://dmxnat.nchc.org.tw'
+    DEFAULT_WORKERS = 8
+    DEFAULT_LISTING_WORKERS = 4
 
     def __init__(self):
         data_dirs = self.scan_root_dir() 
         data_dir = data_dirs[0]
+        self.metrics = Metrics('export')
         self.auth_info = self.load_config(data_dir)
-        self.session_id = None
-        self.authErr = 0
+        self.limiter = BandwidthLimiter(os.path.join(data_dir, self.XNAT_CONF_NAME))
+        self.metrics.register('bandwidth', self.limiter.to_dict)
+        # one connection per download and listing thread
+        self.client = XnatClient(self.XNAT_BASE_URL, self.auth_info,
+                                 max(self.pool_size, self.workers + self.listingWorkers), metrics=self.metrics,
+                                 limiter=self.limiter, sessions=self.sessions)
+        self.printLock = threading.Lock()
+        self.pendingLock = threading.Condition()
+        self.pending = 0
+        self.errors = 0
         #self.listProjects(auth_info)
 
     def scan_root_dir(self): 
         data_dirs = [] 
-        for item in os.listdir('.'): 
+        for item in sorted(os.listdir('.')): 
             if (os.path.isdir(item)): 
-                if (item[:1] != '.'): 
+                # the directories holding config.ini, not the python packages
+                if (item[:1] != '.' and os.path.isfile(os.path.join(item, self.XNAT_CONF_NAME))): 
                     data_dirs.append(os.path.abspath( 
                         os.path.join(os.getcwd(), item))) 
  
+        if not data_dirs:
+            sys.exit('please run the exporter next to data/{0}'.format(self.XNAT_CONF_NAME))
         return data_dirs 
 
     def load_config(self, dir):
@@ -49,6 +74,14 @@ class XnatExport:
             username = config.get('xnat', 'username')
             password = config.get('xnat', 'password')
             xnat_url = config.get('xnat', 'url')
+            self.pool_size = config.getint('xnat', 'pool_size', fallback=XnatClient.DEFAULT_POOL_SIZE)
+            self.workers = max(1, config.getint('export', 'workers', fallback=self.DEFAULT_WORKERS))
+            self.listingWorkers = max(1, config.getint('export', 'listing_workers', fallback=self.DEFAULT_LISTING_WORKERS))
+            self.sessions = SessionManager.from_config(config, xnat_url, username)
+            self.metrics_json = config.get('metrics', 'json', fallback='{tool}-metrics.json').format(tool='export')
+            self.metrics_prometheus = config.get('metrics', 'prometheus', fallback='').format(tool='export')
+            progress = config.get('metrics', 'progress', fallback='auto')
+            self.progress = sys.stderr.isatty() if progress == 'auto' else config.getboolean('metrics', 'progress')
 
             # side effect?
             self.XNAT_BASE_URL = xnat_url
@@ -60,43 +93,14 @@ class XnatExport:
         except:
             raise
 
-    def session_request(self):
-        if self.authErr >= 2:
-            raise
-
-        auth_info = self.auth_info
-        api_url = '/'.join([self.XNAT_BASE_URL, 'data', 'JSESSION'])
-        r = requests.get(api_url, auth=(auth_info[0], auth_info[1]), verify=False)
-        if r.status_code < 400:
-            self.session_id = r.text
-            self.authErr = 0
-            return True
-        elif r.status_code == 401:
-            logging.error('please check the status of api {0}'.format(api_url))
-            logging.error(r.status_code)
-            logging.error(r.text)
-            print(r.text)
-            self.authErr = self.authErr + 1
-            raise EOFError
-        else:
-            logging.error('please check the status of api {0}'.format(api_url))
-            logging.error(r.status_code)
-            logging.error(r.text)
-            print(r.text)
-            raise EOFError
-
     def xnatapi(self, api):
-        cookies = dict(JSESSIONID=self.session_id)
         api_url = '/'.join([self.XNAT_BASE_URL, 'data', api])
         api_url = "{0}?format=json".format(api_url)
         print(api_url)
 
-        r = requests.get(api_url, cookies=cookies, verify=False)
+        r = self.client.get(api_url)
         if r.status_code < 400:
             logging.info('api:{0} successfully!'.format(api_url))
-        elif r.status_code == 401:
-            if self.session_request() == True:
-                return self.xnatapi(api)
         else:
             logging.error('please check the status of api {0}'.format(api_url))
             logging.error(r.status_code)
@@ -170,59 +174,130 @@ class XnatExport:
         return data
 
     def getFile(self, file):
-        print("Name: ", file['Name'])
-        print("Disest: ", file['digest'])
-        print("Size: ", file['Size'])
-        print("Collection: ", file['collection'])
+        with self.printLock:
+            print("Name: ", file['Name'])
+            print("Disest: ", file['digest'])
+            print("Size: ", file['Size'])
+            print("Collection: ", file['collection'])
 
     def downloadFile(self, fileName, link):
-        auth_info = self.auth_info
-        r = requests.get(link, auth=(auth_info[0], auth_info[1]), verify=False, allow_redirects=True)
-        open(fileName, 'wb').write(r.content)
+        with self.metrics.stage('download'):
+            # streamed to the file, paced by the bandwidth limit
+            r, size = self.client.download(link, fileName, allow_redirects=True)
+        if size is None:
+            # error answers are not written to fileName
+            logging.error('download of {0} failed: {1}'.format(link, r.status_code))
+            self.addError()
+            return False
+        self.metrics.add_transfer(size)
+        return True
+
+    def addError(self):
+        with self.pendingLock:
+            self.errors += 1
+        self.metrics.inc('export_errors')
+
+    def writeMetrics(self):
+        if self.metrics_json:
+            self.metrics.write_json(self.metrics_json)
+        if self.metrics_prometheus:
+            self.metrics.write_prometheus(self.metrics_prometheus)
+
+    def submit(self, pool, function, *args):
+        """Run function on pool; exportProject waits for it and for the tasks it submits"""
+        with self.pendingLock:
+            self.pending += 1
+
+        def task():
+            try:
+                function(*args)
+            except Exception:
+                traceback.print_exc()
+                self.addError()
+            finally:
+                with self.pendingLock:
+                    self.pending -= 1
+                    self.pendingLock.notify_all()
+        return pool.submit(task)
+
+    def waitAll(self):
+        with self.pendingLock:
+            while self.pending:
+                self.pendingLock.wait()
 
     def exportProject(self, project):
         print(project)
         projectData = self.getProject(project)
         if projectData == '':
             raise
+        basepath = "{0}/data/export".format(os.getcwd())
+        basepath = "{0}/{1}".format(basepath, project)
+        self.createDir(basepath)
         subjects = self.listSubjects(project)
         subjectsData = subjects['ResultSet']['Result']
-        for subject in subjectsData:
-            subjectID = subject['ID']
-            subjectLabel = subject['label']
-            basepath = "{0}/data/export".format(os.getcwd())
-            basepath = "{0}/{1}".format(basepath, project)
-            self.createDir(basepath)
-            sbpath = "{0}/{1}".format(basepath, subjectLabel)
-            self.createDir(sbpath)
-            experiments = self.listExperiments(project, subjectID)
-            experimentData = experiments['ResultSet']['Result']
-            for experiment in experimentData:
-                experimentID = experiment['ID']
-                experimentLabel = experiment['label']
-                expath = "{0}/{1}".format(sbpath, experimentLabel)
-                self.createDir(expath)
-                eFiles = self.filesFromExperiment(experimentID)
-                print(eFiles)
-                scans = self.scansFromExperiment(experimentID)
-                scansData = scans['ResultSet']['Result']
-                for scan in scansData:
-                    scanID = scan['ID']
-                    scanpath = "{0}/{1}".format(expath, scanID)
-                    self.createDir(scanpath)
-                    sFiles = self.filesFromExperimentScan(experimentID, scanID)
-                    sFilesData = sFiles['ResultSet']['Result']
-                    for sfile in sFilesData:
-                        collectionpath = "{0}/{1}".format(scanpath, sfile['collection'])
-                        self.createDir(collectionpath)
-                        self.getFile(sfile)
-                        fileLink = '/'.join([self.XNAT_BASE_URL, 'data', 'experiments', experimentID, 'scans', scanID, 'resources', sfile['collection'], 'files', sfile['Name']])
-                        fileName = '/'.join([collectionpath, sfile['Name']])
-                        print("URL: ", fileLink)
-                        print("filename: ", fileName)
-                        
-                        self.downloadFile(fileName, fileLink)
-                        
+
+        self.listingPool = concurrent.futures.ThreadPoolExecutor(self.listingWorkers, thread_name_prefix='listing')
+        self.downloadPool = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix='download')
+        # files listed but not downloaded yet
+        self.queuedFiles = threading.BoundedSemaphore(self.workers * 4)
+        self.errors = 0
+        try:
+            for subject in subjectsData:
+                self.submit(self.listingPool, self.exportSubject, project, basepath, subject)
+            self.waitAll()
+        finally:
+            self.listingPool.shutdown()
+            self.downloadPool.shutdown()
+        if self.errors:
+            logging.error('{0} listings or downloads of project {1} failed'.format(self.errors, project))
+
+    def exportSubject(self, project, basepath, subject):
+        subjectID = subject['ID']
+        subjectLabel = subject['label']
+        sbpath = "{0}/{1}".format(basepath, subjectLabel)
+        self.createDir(sbpath)
+        experiments = self.listExperiments(project, subjectID)
+        experimentData = experiments['ResultSet']['Result']
+        for experiment in experimentData:
+            self.submit(self.listingPool, self.exportExperiment, sbpath, experiment)
+
+    def exportExperiment(self, sbpath, experiment):
+        experimentID = experiment['ID']
+        experimentLabel = experiment['label']
+        expath = "{0}/{1}".format(sbpath, experimentLabel)
+        self.createDir(expath)
+        eFiles = self.filesFromExperiment(experimentID)
+        print(eFiles)
+        scans = self.scansFromExperiment(experimentID)
+        scansData = scans['ResultSet']['Result']
+        for scan in scansData:
+            self.submit(self.listingPool, self.exportScan, expath, experimentID, scan)
+
+    def exportScan(self, expath, experimentID, scan):
+        scanID = scan['ID']
+        scanpath = "{0}/{1}".format(expath, scanID)
+        self.createDir(scanpath)
+        sFiles = self.filesFromExperimentScan(experimentID, scanID)
+        sFilesData = sFiles['ResultSet']['Result']
+        for sfile in sFilesData:
+            collectionpath = "{0}/{1}".format(scanpath, sfile['collection'])
+            self.createDir(collectionpath)
+            fileLink = '/'.join([self.XNAT_BASE_URL, 'data', 'experiments', experimentID, 'scans', scanID, 'resources', sfile['collection'], 'files', sfile['Name']])
+            fileName = '/'.join([collectionpath, sfile['Name']])
+            # waits while enough files are queued for the download threads
+            self.queuedFiles.acquire()
+            self.submit(self.downloadPool, self.exportFile, sfile, fileName, fileLink)
+
+    def exportFile(self, sfile, fileName, fileLink):
+        try:
+            self.getFile(sfile)
+            with self.printLock:
+                print("URL: ", fileLink)
+                print("filename: ", fileName)
+            self.downloadFile(fileName, fileLink)
+        finally:
+            self.queuedFiles.release()
+
 
 if __name__ == '__main__':
     proName=None
@@ -231,6 +306,7 @@ if __name__ == '__main__':
     if len(sys.argv) == 2:
         proName = sys.argv[1]
     xnatExport = XnatExport()
+    progressLine = ProgressLine(xnatExport.metrics).start() if xnatExport.progress else None
     if proName != None:
         xnatExport.exportProject(proName)
     else:
@@ -241,3 +317,7 @@ if __name__ == '__main__':
             projectLabel = project['name']
             print("project: ", projectLabel)
             xnatExport.exportProject(projectID)
+    if progressLine != None:
+        progressLine.stop()
+    print(xnatExport.metrics.progress())
+    xnatExport.writeMetrics()
@@ -1,6 +1,4 @@
-import csv
 import traceback
-import subprocess
 import pprint
 import datetime
 import configparser
@@ -8,9 +6,39 @@ import os
 import pdb
 import sys
 import logging
-
+import argparse
+import asyncio
+import concurrent.futures
+import subprocess
+import threading
 import time
+
+import collections
 import functools
+import itertools
+import zipfile
+
+from xnat_transfer import aim
+from xnat_transfer import archive
+from xnat_transfer import compression
+from xnat_transfer import dicom
+from xnat_transfer import digest
+from xnat_transfer import plan
+from xnat_transfer import schedule
+from xnat_transfer.client import XnatClient
+from xnat_transfer.dirindex import DirectoryIndex
+from xnat_transfer.hierarchy import HierarchyCache, session_batches, session_xml
+from xnat_transfer.journal import UploadJournal
+from xnat_transfer.listing import FileListing, ListingCache
+from xnat_transfer.metrics import Metrics, ProgressLine
+from xnat_transfer.pipeline import Pipeline
+from xnat_transfer.pool import TransferPool
+from xnat_transfer.ratelimit import BandwidthLimiter, parse_rate
+from xnat_transfer.results import ResultLog
+from xnat_transfer.retry import CircuitBreaker, PermanentError, RetryPolicy, classify, in_task
+from xnat_transfer.session import SessionManager
+from xnat_transfer.shard import Shard, parse_shard, shard_path, split_shard
+from xnat_transfer.streams import FileBody
 """
 Assume user put the data in this directory structure
 /<whatever>/data/projects/<project_ID>/<whatever>/<scan_ID>/*.dcm
@@ -24,53 +52,162 @@ session_data_type:
 logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
 
 VER=0.41
-try:
-    from lxml import etree
-except:
-    print('please type "pip install lxml" for installing lxml package')
-
-try:
-    import requests
-except:
-    print('please type "pip install requests" for installing request package')
-
-try:
-    import pydicom
-except:
-    print('please type "pip install pydicom" for installing pydicom package')
-
-requests.packages.urllib3.disable_warnings()
-
 # r = requests.get('https://dmxnat.nchc.org.tw/data/projects', auth=('admin', 'admin@steps'), verify=False)
 
 class XnatImporter:
     XNAT_CONF_NAME = 'config.ini'
     XNAT_BASE_URL = 'https://dmxnat.nchc.org.tw'
     AIM_SCHEMA_XSD = 'data/AIM_v4_rv44_XML.xsd'
-
-    def __init__(self):
-        self.results = {
-            'exist': [],
-            'success': [],
-            'fail': []
-        }
+    DEFAULT_WORKERS = 4
+    DEFAULT_PARSE_WORKERS = 2
+    DEFAULT_JOURNAL = 'upload-journal.db'
+    DEFAULT_HISTORY = 'transfer-history.json'
+    DEFAULT_XML_WORKERS = 2
+    DEFAULT_MAX_RETRIES = 8
+    DEFAULT_PIPELINE_QUEUE_SIZE = 8
+    DEFAULT_RETRY_MAX_DELAY = 60.0
+    DEFAULT_ARCHIVE_BATCH_SIZE = 1000
+    UPLOAD_MODES = ('file', 'archive')
+    DEFAULT_COMPRESSION_LEVEL = 6
+    DEFAULT_COMPRESSION_WORKERS = 2
+    DEFAULT_COMPRESSION_MAX_RATIO = 0.9
+    DEFAULT_HASH_WORKERS = 2
+    ENGINES = ('thread', 'async')
+    HIERARCHY_MODES = ('calls', 'xml')
+    DEFAULT_ASYNC_CONCURRENCY = 100
+    DEFAULT_REPORT = 'import-report.jsonl'
+    DEFAULT_REPORT_MAX_MB = 100
+    DEFAULT_REPORT_BACKUPS = 5
+
+    def __init__(self, args=None):
+        self.metrics = Metrics('import')
+        self.stats = self.metrics.transfers
+        self.progress_line = None
+        self.args = args
+        self.config = None
+        self.config_path = None
+        self.dry_run = getattr(args, 'plan', None) is not None
 
         data_dirs = self.scan_root_dir()
         data_dir = data_dirs[0]
         self.auth_info = self.load_config(data_dir)
-        self.session_id = None
-        self.authErr = 0
+        shard_index, shard_count = parse_shard(args.shard) if getattr(args, 'shard', None) else (1, 1)
+        self.shard = Shard(shard_index, shard_count, self.get_option('claim_dir', 'transfer', 'claim_dir', ''),
+                           getattr(args, 'claim_owner', None), self.metrics)
+        # results are streamed to the report and fail.csv, only counters stay in memory
+        report = '' if self.dry_run else self.get_option('report', 'transfer', 'report', self.DEFAULT_REPORT)
+        self.results = ResultLog(
+            shard_path(report, shard_index, shard_count),
+            None if self.dry_run else shard_path('fail.csv', shard_index, shard_count),
+            int(self.get_option('report_max_mb', 'transfer', 'report_max_mb', self.DEFAULT_REPORT_MAX_MB, float) * 1024 * 1024),
+            self.get_option('report_backups', 'transfer', 'report_backups', self.DEFAULT_REPORT_BACKUPS, int))
+        self.metrics.register('results', self.results.to_dict)
+        self.workers = self.get_option('workers', 'transfer', 'workers', self.DEFAULT_WORKERS, int)
+        self.upload_mode = self.get_option('upload_mode', 'transfer', 'upload_mode', 'file')
+        self.archive_batch_size = self.get_option('archive_batch_size', 'transfer', 'archive_batch_size', self.DEFAULT_ARCHIVE_BATCH_SIZE, int)
+        self.parse_workers = self.get_option('parse_workers', 'transfer', 'parse_workers', self.DEFAULT_PARSE_WORKERS, int)
+        self.verify_all_headers = self.get_option('verify_all_headers', 'transfer', 'verify_all_headers', False, bool)
+        # one SQLite file per shard: shards of several machines share the working directory, often over NFS
+        journal_path = shard_path(self.get_option('journal', 'transfer', 'journal', self.DEFAULT_JOURNAL), shard_index, shard_count)
+        self.journal = UploadJournal(journal_path) if journal_path else None
+        directory_index = shard_path(self.get_option('directory_index', 'transfer', 'directory_index', ''), shard_index, shard_count)
+        self.directory_index = DirectoryIndex(directory_index, getattr(args, 'full_scan', False)) if directory_index else None
+        if self.directory_index is not None:
+            self.metrics.register('directory_index', self.directory_index.to_dict)
+        self.pipeline_queue_size = self.get_option('pipeline_queue_size', 'transfer', 'pipeline_queue_size', self.DEFAULT_PIPELINE_QUEUE_SIZE, int)
+        self.scheduler = schedule.Scheduler(
+            schedule.parse_policies(self.get_option('schedule', 'transfer', 'schedule', 'walk')),
+            schedule.parse_subjects(self.get_option('priority_subjects', 'transfer', 'priority_subjects', '')),
+            self.get_option('schedule_window', 'transfer', 'schedule_window', schedule.DEFAULT_WINDOW, int))
+        self.xml_workers = self.get_option('xml_workers', 'transfer', 'xml_validation_workers', self.DEFAULT_XML_WORKERS, int)
+        self.use_xmllint = self.get_option('xmllint', 'transfer', 'xmllint_check', False, bool)
+        self.xml_validator = None
+        self.history = self.get_option('history', 'transfer', 'history', self.DEFAULT_HISTORY)
+        # every shard of a run writes its own files
+        self.metrics_json = shard_path(self.get_option('metrics_json', 'metrics', 'json', '{tool}-metrics.json').format(tool='import'),
+                                       shard_index, shard_count)
+        self.metrics_prometheus = shard_path(self.get_option('metrics_prometheus', 'metrics', 'prometheus', '').format(tool='import'),
+                                             shard_index, shard_count)
+        progress = self.get_option('progress', 'metrics', 'progress', 'auto')
+        self.progress = sys.stderr.isatty() if progress == 'auto' else progress in (True, 'true', 'yes', 'on', '1')
+        self.warm_hierarchy_cache = self.get_option('warm_cache', 'transfer', 'warm_hierarchy_cache', False, bool)
+        self.hierarchy = HierarchyCache()
+        self.hierarchy_mode = self.get_option('hierarchy_mode', 'transfer', 'hierarchy_mode', 'calls')
+        if self.hierarchy_mode not in self.HIERARCHY_MODES:
+            raise ValueError('unknown hierarchy_mode {0}, expected one of {1}'.format(self.hierarchy_mode, self.HIERARCHY_MODES))
+        # sessions this run created: their scans hold no files yet
+        self.new_sessions = set()
+        self.listings = ListingCache(self.xnat_fetch_listing)
+        if self.upload_mode not in self.UPLOAD_MODES:
+            raise ValueError('unknown upload_mode {0}, expected one of {1}'.format(self.upload_mode, self.UPLOAD_MODES))
+        self.digest_check = self.get_option('digest_check', 'transfer', 'digest_check', True, bool)
+        self.hasher = digest.Hasher(self.get_option('hash_workers', 'transfer', 'hash_workers', self.DEFAULT_HASH_WORKERS, int)) \
+            if self.digest_check else None
+        self.compressor = None
+        compression_mode = self.get_option('compression', 'transfer', 'compression', 'none')
+        if compression_mode != 'none':
+            # deflated zip bundles are an archive mode upload
+            if compression_mode == 'zip':
+                self.upload_mode = 'archive'
+            self.compressor = compression.Compressor(
+                compression_mode,
+                self.get_option('compression_level', 'transfer', 'compression_level', self.DEFAULT_COMPRESSION_LEVEL, int),
+                self.get_option('compression_workers', 'transfer', 'compression_workers', self.DEFAULT_COMPRESSION_WORKERS, int),
+                self.get_option('compression_max_ratio', 'transfer', 'compression_max_ratio', self.DEFAULT_COMPRESSION_MAX_RATIO, float),
+                # one body for each file waiting in the transfer pool
+                ahead=self.workers * 4)
+            self.metrics.register('compression', self.compressor.stats.to_dict)
+        pool_size = self.get_option('pool_size', 'xnat', 'pool_size', XnatClient.DEFAULT_POOL_SIZE, int)
+        max_retries = self.get_option('max_retries', 'transfer', 'max_retries', self.DEFAULT_MAX_RETRIES, int)
+        max_delay = self.get_option('retry_max_delay', 'transfer', 'retry_max_delay', self.DEFAULT_RETRY_MAX_DELAY, float)
+        # one breaker for every request of the run: all workers pause together
+        breaker = CircuitBreaker(
+            threshold=self.get_option('breaker_threshold', 'transfer', 'breaker_threshold', 0.5, float),
+            cooldown=self.get_option('breaker_cooldown', 'transfer', 'breaker_cooldown', 30.0, float))
+        self.retry_policy = RetryPolicy(max_retries, max_delay=max_delay, breaker=breaker, metrics=self.metrics)
+        # one bandwidth budget for every upload worker, see [bandwidth] in config.ini
+        bandwidth_limit = getattr(args, 'bandwidth_limit', None)
+        self.limiter = BandwidthLimiter(self.config_path,
+                                        parse_rate(bandwidth_limit) if bandwidth_limit is not None else None,
+                                        share=1.0 / (getattr(args, 'local_processes', None) or 1))
+        self.metrics.register('bandwidth', self.limiter.to_dict)
+        self.client = XnatClient(self.XNAT_BASE_URL, self.auth_info, max(pool_size, self.workers),
+                                 retry_policy=RetryPolicy(4, max_delay=max_delay, breaker=breaker),
+                                 metrics=self.metrics, limiter=self.limiter,
+                                 sessions=SessionManager.from_config(self.config, self.XNAT_BASE_URL, self.auth_info[0]))
+        self.engine = self.get_option('engine', 'transfer', 'engine', 'thread')
+        if self.engine not in self.ENGINES:
+            raise ValueError('unknown engine {0}, expected one of {1}'.format(self.engine, self.ENGINES))
+        if self.engine == 'async' and (self.upload_mode != 'file' or self.compressor is not None):
+            logging.warning('the async engine sends files one by one, uncompressed: the threaded engine runs this import')
+            self.engine = 'thread'
+        if self.engine == 'async' and self.hierarchy_mode == 'xml':
+            logging.warning('the async engine creates scans one by one: the threaded engine runs this import')
+            self.engine = 'thread'
+        self.async_concurrency = self.get_option('async_concurrency', 'transfer', 'async_concurrency', self.DEFAULT_ASYNC_CONCURRENCY, int)
+        self.async_engine = None
         self.scanExist = 0
-        self.push_data_to_xnat(data_dirs)
+        if self.dry_run:
+            self.write_plan(data_dirs, args.plan)
+        elif getattr(args, 'execute_plan', None):
+            self.push_plan_to_xnat(plan.load_plan(args.execute_plan))
+        else:
+            self.push_data_to_xnat(data_dirs)
 
     def scan_root_dir(self):
+        """Data directories of the working directory: the ones holding
+        config.ini and projects/ (not the xnat_transfer, tests, ... packages)"""
         data_dirs = []
-        for item in os.listdir('.'):
+        for item in sorted(os.listdir('.')):
             if (os.path.isdir(item)):
-                if (item[:1] != '.'):
+                if (item[:1] != '.' and os.path.isfile(os.path.join(item, self.XNAT_CONF_NAME))
+                        and os.path.isdir(os.path.join(item, 'projects'))):
                     data_dirs.append(os.path.abspath(
                         os.path.join(os.getcwd(), item)))
 
+        if not data_dirs:
+            logging.error('no data directory with {0} and projects/ in {1}'.format(self.XNAT_CONF_NAME, os.getcwd()))
+            sys.exit('please run the importer next to data/{0} and data/projects/'.format(self.XNAT_CONF_NAME))
         return data_dirs
 
     def load_config(self, dir):
@@ -78,6 +215,8 @@ class XnatImporter:
         try:
             config = configparser.ConfigParser()
             config.read(config_path)
+            self.config = config
+            self.config_path = config_path
 
             username = config.get('xnat', 'username')
             password = config.get('xnat', 'password')
@@ -93,59 +232,118 @@ class XnatImporter:
         except:
             raise
 
-    def session_request(self):
-        if self.authErr >= 2:
-            raise
-
-        auth_info = self.auth_info
-        api_url = '/'.join([self.XNAT_BASE_URL, 'data', 'JSESSION'])
-        r = requests.get(api_url, auth=(auth_info[0], auth_info[1]), verify=False)
-        if r.status_code < 400:
-            self.session_id = r.text
-            self.authErr = 0
-            return True
-        elif r.status_code == 401:
-            logging.error('please check the status of api {0}'.format(api_url))
-            logging.error(r.status_code)
-            logging.error(r.text)
-            print(r.text)
-            self.authErr = self.authErr + 1
-            raise EOFError
-        else:
-            logging.error('please check the status of api {0}'.format(api_url))
-            logging.error(r.status_code)
-            logging.error(r.text)
-            print(r.text)
-            raise EOFError
-
-    def xnatapi_upload(self, api, file_data, base_filename):
-        cookies = dict(JSESSIONID=self.session_id)
+    def get_option(self, name, section, key, default, cast=str):
+        """Command line argument first, then config.ini, then the default"""
+        value = getattr(self.args, name, None)
+        if value is not None:
+            return value
+        if self.config is not None and self.config.has_option(section, key):
+            if cast is bool:
+                return self.config.getboolean(section, key)
+            return cast(self.config.get(section, key))
+        return default
+
+    def record_result(self, kind, entry, md5=None, replaces=None):
+        # entry is a file name, or [file name, reason] for a failure
+        file_name, reason = (entry[0], entry[1]) if isinstance(entry, list) else (entry, None)
+        self.results.record(kind, file_name, reason, md5, replaces)
+        if self.journal is not None and not self.dry_run:
+            self.journal.record(file_name, kind, md5)
+        if self.directory_index is not None and kind in ('success', 'exist'):
+            self.directory_index.release(file_name)
+
+    def record_transfer(self, file_name):
+        count = self.metrics.add_transfer(os.path.getsize(file_name))
+        if count % 100 == 0 and self.progress_line is None:
+            logging.info('throughput: ' + self.stats.report())
+
+    def xnatapi_upload(self, api, file_data, base_filename, extract=False, content_encoding=None, overwrite=False):
         api_url = api
-
-        r = requests.put(
+        query = {'file': base_filename}
+        content_type = 'text/plain'
+        headers = {}
+        if extract:
+            query['extract'] = 'true'
+            content_type = 'application/zip'
+        if overwrite:
+            query['overwrite'] = 'true'
+        headers['content-type'] = content_type
+        if content_encoding is not None:
+            headers['content-encoding'] = content_encoding
+
+        # the client re-authenticates and resends on 401
+        r = self.client.put(
             api_url,
             data=file_data,
-            headers={'content-type': 'text/plain'},
-            params={'file': base_filename},
-            cookies=cookies,
-            verify=False
+            headers=headers,
+            params=query
         )
-
-        if r.status_code == 401:
-            if self.session_request() == True:
-                return self.xnatapi_upload(api, file_data, base_filename)
         return r
 
+    def upload_file(self, api_url, file_name, params, overwrite=False):
+        """PUT one file, gzip-encoded when compression is on and pays off
+        for its modality. Returns the response and the MD5 of the file.
+        """
+        base_filename = os.path.basename(file_name)
+        compressor = self.compressor
+        if compressor is not None and compressor.mode == 'gzip' and compressor.gzip_accepted is not False:
+            modality = compression.modality(file_name, params)
+            if compressor.should_compress(file_name, modality):
+                if compressor.gzip_accepted is None:
+                    with compressor.probe_lock:
+                        if compressor.gzip_accepted is None:
+                            return self.probe_gzip_upload(api_url, file_name, params, modality, overwrite)
+                if compressor.gzip_accepted:
+                    with self.metrics.stage('compression'):
+                        body = compressor.gzip_body(file_name, modality)
+                    with body, self.metrics.stage('upload'):
+                        r = self.xnatapi_upload(api_url, body, base_filename, content_encoding='gzip',
+                                                overwrite=overwrite)
+                    return r, body.hexdigest()
+
+        with FileBody(file_name, digest=self.journal is not None or self.digest_check) as fh:
+            with self.metrics.stage('upload'):
+                r = self.xnatapi_upload(api_url, fh, base_filename, overwrite=overwrite)
+            return r, fh.hexdigest()
+
+    def probe_gzip_upload(self, api_url, file_name, params, modality, overwrite=False):
+        """First gzip upload of the run. XNAT stores a body it does not
+        decode as is, so the stored size is compared with the file size:
+        if they differ (or gzip is refused), gzip is turned off for the run
+        and the file is sent again uncompressed.
+        """
+        base_filename = os.path.basename(file_name)
+        compressor = self.compressor
+        with self.metrics.stage('compression'):
+            body = compressor.gzip_body(file_name, modality)
+        with body, self.metrics.stage('upload'):
+            r = self.xnatapi_upload(api_url, body, base_filename, content_encoding='gzip', overwrite=overwrite)
+        if r.status_code >= 400 and r.status_code not in (400, 415):
+            # inconclusive: the next gzip upload probes again
+            return r, body.hexdigest()
+        if r.status_code < 400:
+            listing = self.xnat_fetch_listing(api_url.rsplit('/', 1)[0])
+            stored = listing.get(api_url.split('/')[-3], base_filename) if listing is not None else None
+            if stored is not None and int(stored.get('Size', -1)) == body.raw_size:
+                logging.info('the server decodes gzip request bodies: compression on')
+                compressor.gzip_accepted = True
+                return r, body.hexdigest()
+        logging.warning('the server does not decode gzip request bodies: compression off, {0} sent again'.format(base_filename))
+        compressor.gzip_accepted = False
+        with FileBody(file_name, digest=self.journal is not None or self.digest_check) as fh:
+            with self.metrics.stage('upload'):
+                r = self.xnatapi_upload(api_url, fh, base_filename, overwrite=True)
+            return r, fh.hexdigest()
+
     def xnatapi(self, api, action='get', raw=0):
-        cookies = dict(JSESSIONID=self.session_id)
         api_url = api
         #print(api_url)
 
         if action == 'get':
             api_url = '{0}?format=json'.format(api_url)
-            r = requests.get(api_url, cookies=cookies, verify=False)
+            r = self.client.get(api_url)
         elif action == 'put':
-            r = requests.put(api_url, cookies=cookies, verify=False)
+            r = self.client.put(api_url)
         else:
             logging.error('please check api action {0}'.format(action))
             raise EOFError
@@ -154,9 +352,6 @@ class XnatImporter:
             logging.info('api:{0} successfully!'.format(api_url))
             if raw == 1:
                 return r
-        elif r.status_code == 401:
-            if self.session_request() == True:
-                return self.xnatapi(api, action, raw)
         else:
             if raw == 1:
                 return r
@@ -170,7 +365,7 @@ class XnatImporter:
     def build_full_file_path(self, dir_info):
         return [os.path.join(dir_info[0], file_name) for file_name in dir_info[2]]
 
-    def build_restapi_parameter_through_dicom(self, dir_info):
+    def build_restapi_parameter_through_dicom(self, dir_info, header=None):
         dir_structure = dir_info[0].split(os.sep)
         start_pos = dir_structure.index('projects')
         file_full_names = self.build_full_file_path(dir_info)
@@ -180,16 +375,18 @@ class XnatImporter:
         enabled_data_type = ['cr', 'ct', 'mr', 'hd']
 
         # DICOM images in the same series should be in same date (session), project, subject, scan type
-        ds = pydicom.dcmread(file_full_names[0])
+        if header is None:
+            header = dicom.read_routing_header(file_full_names[0])
+        study_date = header['StudyDate']
 
         params = {
             'project_id': dir_structure[start_pos + 1],
-            'subject_id': str(ds.PatientName),
-            'session_id': ds.StudyDate[0:4] + '_' + ds.StudyDate[4:6] + '_' + ds.StudyDate[6:8],
+            'subject_id': header['PatientName'],
+            'session_id': study_date[0:4] + '_' + study_date[4:6] + '_' + study_date[6:8],
             'session_data_type': 'RAW',
             'scan_id': dir_structure[start_pos + 3],
-            'xnat_data_type': ds.Modality.lower() + 'ScanData',
-            'data_type': ds.Modality.lower(),
+            'xnat_data_type': header['Modality'].lower() + 'ScanData',
+            'data_type': header['Modality'].lower(),
             'scan_data_type': 'DICOM',
             'file_names': file_full_names
         }
@@ -232,21 +429,149 @@ class XnatImporter:
 
         return params
 
-    def retry(self, name, function, max_retries=1000):
-        """Retries a certain function for at most max_retry times
-        Assumes the function returns true on success.
+    def retry(self, name, function):
+        """Retries a certain function with capped exponential backoff
+        Assumes the function returns true on success, and raises
+        PermanentError when another attempt cannot help.
+        """
+        return self.retry_policy.call(name, function)
+
+    def check_permanent(self, r, name):
+        """Stop retrying on answers like 403 / 404 / 409 that will not change"""
+        if r.status_code != 401 and classify(r) == 'permanent':
+            raise PermanentError('{0}: {1} {2}'.format(name, r.status_code, r.text[:200]))
+
+    def warm_hierarchy(self, project_id):
+        """Fill the hierarchy cache with the subjects and sessions of a project
+        (two listing calls), so existing entities are not checked one by one.
+        """
+        project_url = '/'.join([self.XNAT_BASE_URL, 'data', 'projects', project_id])
+        r = self.xnatapi(project_url + '/subjects', 'get', 1)
+        if r.status_code >= 400:
+            # no such project yet (or no access): nothing to warm
+            return
+        subjects = r.json()['ResultSet']['Result']
+        labels = dict((row['ID'], row['label']) for row in subjects)
+
+        # the default columns of the listing do not say which subject a session belongs to
+        r = self.client.get(project_url + '/experiments',
+                            params={'format': 'json', 'columns': 'ID,label,subject_ID,subject_label'})
+        sessions = []
+        unknown = 0
+        if r.status_code < 400:
+            for row in r.json()['ResultSet']['Result']:
+                subject = row.get('subject_label') or labels.get(row.get('subject_ID'))
+                if subject:
+                    sessions.append((subject, row['label']))
+                else:
+                    unknown += 1
+        if unknown:
+            logging.warning('{0} sessions of {1} listed without their subject: they are checked one by one'.format(
+                unknown, project_id))
+        self.hierarchy.warm(project_id, labels.values(), sessions)
+        logging.info('hierarchy cache warmed: {0} subjects, {1} sessions in {2}'.format(
+            len(labels), len(sessions), project_id))
+
+    def xnat_create_hierarchy(self, params, auth_info):
+        """Create project, subject, session, scan and resource of a directory,
+        skipping the ones this run already created or found.
+        """
+        with self.metrics.stage('hierarchy'):
+            self.create_hierarchy(params, auth_info)
+
+    def create_hierarchy(self, params, auth_info):
+        if self.warm_hierarchy_cache and self.hierarchy.needs_warming(params['project_id']):
+            self.warm_hierarchy(params['project_id'])
+
+        self.scanExist = 0
+        steps = [
+            ('project', 'create_project', self.xnat_create_project),
+            ('subject', 'create_subject', self.xnat_create_subject),
+            ('session', 'create_session', self.xnat_create_session),
+            ('scan', 'create_scan', self.xnat_create_scan),
+            ('resource', 'create_resource_for_scan', self.xnat_create_resource_for_scan),
+        ]
+        for level, name, function in steps:
+            key = self.hierarchy.key(level, params)
+            if key in self.hierarchy:
+                if level == 'scan':
+                    self.scanExist = 1
+                continue
+            if self.retry(name, functools.partial(function, params, auth_info)):
+                self.hierarchy.add(key)
+
+    def xnat_create_sessions(self, scans, auth_info):
+        """hierarchy_mode xml: create the session of scans (directories of
+        one session) with all of them in one request. Reconstruction
+        resources, which belong to the session, are still created one by one.
         """
-        retry_count = 0
-        while retry_count < max_retries:
-            # Execute
-            ret = function()
-            if ret:
+        with self.metrics.stage('hierarchy'):
+            params = scans[0]
+            if self.warm_hierarchy_cache and self.hierarchy.needs_warming(params['project_id']):
+                self.warm_hierarchy(params['project_id'])
+            for level, name, function in [('project', 'create_project', self.xnat_create_project),
+                                          ('subject', 'create_subject', self.xnat_create_subject)]:
+                key = self.hierarchy.key(level, params)
+                if key not in self.hierarchy and self.retry(name, functools.partial(function, params, auth_info)):
+                    self.hierarchy.add(key)
+
+            missing = [scan for scan in scans if self.hierarchy.key('resource', scan) not in self.hierarchy]
+            existing = set()
+            if not missing or not self.retry('create_session', functools.partial(self.xnat_put_session_xml, missing, existing)):
                 return
-            # Sleep and try again
-            retry_count += 1
-            print("Retry({0}) {1}...".format(retry_count, name))
-            time.sleep(retry_count / 10)
-        print("Retry count exceeds max retries({0})!!".format(max_retries))
+            for scan in missing:
+                self.hierarchy.add(self.hierarchy.key('session', scan))
+                self.hierarchy.add(self.hierarchy.key('scan', scan))
+                if scan['scan_id'] in existing:
+                    # as in calls mode, the resources of an existing scan are only created for non RAW directories
+                    needs_resource = scan['session_data_type'] != 'RAW'
+                else:
+                    needs_resource = scan['session_data_type'] == 'RECON'
+                if not needs_resource or \
+                        self.retry('create_resource_for_scan', functools.partial(self.xnat_create_resource_for_scan, scan, auth_info)):
+                    self.hierarchy.add(self.hierarchy.key('resource', scan))
+
+    def xnat_put_session_xml(self, scans, existing):
+        """PUT the session document of scans. The IDs of the scans the
+        session already holds are added to existing and left out of it.
+        """
+        params = scans[0]
+        api_url = '/'.join([self.XNAT_BASE_URL, 'data', 'projects', params['project_id'],
+                            'subjects', params['subject_id'], 'experiments', params['session_id']])
+        session_key = self.hierarchy.key('session', params)
+        new_session = session_key in self.new_sessions
+        if not new_session:
+            # one listing tells whether the session exists and which of its scans do
+            r = self.xnatapi(api_url + '/scans', 'get', 1)
+            if r.status_code >= 400 and r.status_code != 404:
+                self.check_permanent(r, 'create_session')
+                return False
+            new_session = r.status_code == 404
+            if not new_session:
+                existing.update(row['ID'] for row in r.json()['ResultSet']['Result'])
+        scans = [scan for scan in scans if scan['scan_id'] not in existing]
+        if not scans:
+            return True
+
+        # added to the session as it is: allowDataDeletion=false keeps the scans not listed
+        date = datetime.date.today().isoformat() if new_session else None
+        r = self.client.put(api_url, data=session_xml(scans, date),
+                            headers={'content-type': 'text/xml'},
+                            params={'inbody': 'true', 'allowDataDeletion': 'false'})
+        if r.status_code < 400:
+            logging.info('create session with {0} directories successfully!'.format(len(scans)))
+            if new_session:
+                self.new_sessions.add(session_key)
+                # nothing stored in a new session: the uploads need no listing
+                for scan in scans:
+                    if scan['session_data_type'] != 'RECON':
+                        self.listings.put(self.xnat_scan_url(scan) + '/files', FileListing(True))
+            return True
+        logging.error('please check the status of xnat_put_session_xml')
+        logging.error(r.status_code)
+        logging.error(r.text)
+        self.check_permanent(r, 'create_session')
+        return False
 
     def xnat_create_project(self, params, auth_info):
         api_url = '/'.join([self.XNAT_BASE_URL, 'data',
@@ -260,6 +585,7 @@ class XnatImporter:
             logging.error('please check the status of xnat_create_project')
             logging.error(r.status_code)
             logging.error(r.text)
+            self.check_permanent(r, 'create_project')
         return False
 
     def xnat_create_subject(self, params, auth_info):
@@ -280,6 +606,7 @@ class XnatImporter:
             logging.error('please check the status of xnat_create_subject')
             logging.error(r.status_code)
             logging.error(r.text)
+            self.check_permanent(r, 'create_subject')
         return False
 
     def xnat_create_session(self, params, auth_info):
@@ -303,20 +630,19 @@ class XnatImporter:
             logging.error('please check the status of xnat_create_session')
             logging.error(r.status_code)
             logging.error(r.text)
+            self.check_permanent(r, 'create_session')
         return False
 
     def xnat_create_scan(self, params, auth_info):
         #query_params = '?xsiType=xnat:' + params['xnat_data_type'] + '&xnat:' + params['xnat_data_type'] + '/type=' + params['scan_data_type']
         query_params = '?xsiType=xnat:' + params['xnat_data_type']
-        api_url = '/'.join([
-            self.XNAT_BASE_URL, 'data',
-            'projects', params['project_id'],
-            'subjects', params['subject_id'],
-            'experiments', params['session_id'],
-            'scans', params['scan_id']
-        ])
-        r = self.xnatapi(api_url, 'get', 1)
-        if r.status_code == 200:
+        api_url = self.xnat_scan_url(params)
+        # the file listing of the scan tells whether it exists, and is
+        # reused by the uploads to skip files already stored
+        listing = self.listings.get(api_url + '/files')
+        if listing is None:
+            return False
+        if listing.exists:
             logging.info('{0} exist!'.format(api_url))
             self.scanExist = 1
             return True
@@ -327,69 +653,34 @@ class XnatImporter:
         r = self.xnatapi(api_url, 'put', 1)
         if r.status_code < 400:
             logging.info('create scan successfully!')
+            self.listings.put(self.xnat_scan_url(params) + '/files', FileListing(True))
             return True
         else:
             logging.info('please check the status of xnat_create_scan')
+            self.check_permanent(r, 'create_scan')
         return False
 
-    def xnat_create_resource_for_scan(self, params, auth_info):
+    def resource_create_urls(self, params):
+        """Resources PUT for a directory; the last answer tells the outcome"""
+        scan_url = self.xnat_scan_url(params)
         if params['session_data_type'] == 'DICOM':
-            api_url = '/'.join([
-                self.XNAT_BASE_URL, 'data',
-                'projects', params['project_id'],
-                'subjects', params['subject_id'],
-                'experiments', params['session_id'],
-                'scans', params['scan_id'],
-                'resources/DICOM?format=DICOM&content=' +
-                params['scan_data_type'] + '_RAW',
-            ])
-            #r = requests.put(api_url, auth=(
-            #    auth_info[0], auth_info[1]), verify=False)
-            r = self.xnatapi(api_url, 'put', 1)
-
+            return [scan_url + '/resources/DICOM?format=DICOM&content=' + params['scan_data_type'] + '_RAW']
         elif params['session_data_type'] == 'RECON':
-            api_url = '/'.join([
-                self.XNAT_BASE_URL, 'data',
-                'projects', params['project_id'],
-                'subjects', params['subject_id'],
-                'experiments', params['session_id'],
-                'scans', params['scan_id'],
-                'reconstructions/' +
-                params['scan_id'] + '/resources/NIFTI?format=NIFTI',
-            ])
-            #r = requests.put(api_url, auth=(
-            #    auth_info[0], auth_info[1]), verify=False)
-            r = self.xnatapi(api_url, 'put', 1)
-
+            return [scan_url + '/reconstructions/' + params['scan_id'] + '/resources/NIFTI?format=NIFTI']
         elif params['session_data_type'] == 'RAW':
-            if self.scanExist == 1:
-                logging.info('scan exist, skip resource!')
-                return True
+            return [scan_url + '/resources/DICOM', scan_url + '/resources/METADATA']
+        return []
 
-            api_url = '/'.join([
-                self.XNAT_BASE_URL, 'data',
-                'projects', params['project_id'],
-                'subjects', params['subject_id'],
-                'experiments', params['session_id'],
-                'scans', params['scan_id'],
-                'resources/DICOM',
-            ])
-            #r = requests.put(api_url, auth=(
-            #    auth_info[0], auth_info[1]), verify=False)
-            r = self.xnatapi(api_url, 'put', 1)
+    def xnat_create_resource_for_scan(self, params, auth_info):
+        if params['session_data_type'] == 'RAW' and self.scanExist == 1:
+            logging.info('scan exist, skip resource!')
+            return True
 
-            api_url = '/'.join([
-                self.XNAT_BASE_URL, 'data',
-                'projects', params['project_id'],
-                'subjects', params['subject_id'],
-                'experiments', params['session_id'],
-                'scans', params['scan_id'],
-                'resources/METADATA',
-            ])
-            #r = requests.put(api_url, auth=(
-            #    auth_info[0], auth_info[1]), verify=False)
+        for api_url in self.resource_create_urls(params):
             r = self.xnatapi(api_url, 'put', 1)
+        return self.check_resource_created(r, api_url)
 
+    def check_resource_created(self, r, api_url):
         if r.status_code < 400:
             logging.info('create resource successfully!')
             return True
@@ -399,181 +690,565 @@ class XnatImporter:
         else:
             logging.info('please check the status of creation')
             logging.info(r.status_code)
+            self.check_permanent(r, 'create_resource_for_scan')
         return False
 
     def check_with_lxml(self, file_name):
-        xsd = etree.parse(self.AIM_SCHEMA_XSD)
-        xmlschema = etree.XMLSchema(xsd)
-        xml_content = etree.parse(file_name)
-
-        if xmlschema.validate(xml_content):
-            return True
-        else:
-            return False
+        # the compiled schema is cached per process
+        return aim.check_with_lxml(file_name, self.AIM_SCHEMA_XSD)
 
     def check_with_xmllint(self, file_name):
-        cmds = ' '.join(
-            ['xmllint', '--schema', self.AIM_SCHEMA_XSD,  file_name, '--noout'])
-        try:
-            ret = subprocess.check_output(
-                cmds, shell=True, stderr=subprocess.STDOUT)
-            if ret.decode('utf-8').find('validates') > 0:
-                return True
-            else:
-                logging.error(ret)
-                return False
-        except subprocess.CalledProcessError:
-            return False
+        return aim.check_with_xmllint(file_name, self.AIM_SCHEMA_XSD)
 
     def verify_xml(self, file_name):
-        if self.check_with_xmllint(file_name) and self.check_with_lxml(file_name):
-            return True
-        else:
-            return False
+        with self.metrics.stage('xml_validation'):
+            # submitted to the validator when its scan entered the pipeline
+            if self.xml_validator is not None:
+                ok = self.xml_validator.result(file_name)
+                if ok is not None:
+                    return ok
+            return aim.verify_xml(file_name, self.AIM_SCHEMA_XSD, self.use_xmllint)
+
+    def validate_ahead(self, params_list):
+        """Start validating the AIM files of the scans about to be uploaded,
+        i.e. those left after the journal and the shard filters"""
+        for params in params_list:
+            self.xml_validator.submit([name for name in params['file_names'] if self.needs_xml_validation(name)])
+            yield params
+
+    def start_xml_validator(self):
+        if self.xml_workers > 0:
+            self.xml_validator = aim.BatchValidator(self.AIM_SCHEMA_XSD, self.use_xmllint, self.xml_workers)
+
+    def xnat_scan_url(self, params):
+        return '/'.join([
+            self.XNAT_BASE_URL, 'data',
+            'projects', params['project_id'],
+            'subjects', params['subject_id'],
+            'experiments', params['session_id'],
+            'scans', params['scan_id']
+        ])
 
-    def xnat_upload_raw_file(self, file_name, params, auth_info):
-        base_filename = os.path.basename(file_name)
+    def xnat_fetch_listing(self, files_url):
+        """One listing call for every file of a scan, None on error"""
+        return self.listing_from_response(self.xnatapi(files_url, 'get', 1), files_url)
+
+    def listing_from_response(self, r, files_url):
+        if r.status_code == 404:
+            return FileListing(False)
+        if r.status_code >= 400:
+            logging.error('please check the status of api {0}'.format(files_url))
+            logging.error(r.status_code)
+            return None
+        return FileListing(True, r.json()['ResultSet']['Result'])
+
+    def xnat_resource_url(self, params, file_name):
+        """URL of the scan resource a file is uploaded into"""
+        scan_url = self.xnat_scan_url(params)
+        if params['session_data_type'] == 'RECON':
+            return scan_url + '/reconstructions/' + params['scan_id'] + '/resources/NIFTI'
 
-        logging.info('File Extension: ' + base_filename[-3:])
         abspardir = os.path.abspath(os.path.join(file_name, os.pardir))
         pardir = os.path.basename(abspardir)
-
         # if base_filename[-3:] == 'dcm':
         if pardir == 'DICOM':
-            api_url = '/'.join([
-                self.XNAT_BASE_URL, 'data',
-                'projects', params['project_id'],
-                'subjects', params['subject_id'],
-                'experiments', params['session_id'],
-                'scans', params['scan_id'],
-                'resources/DICOM/files/' + base_filename
-            ])
+            return scan_url + '/resources/DICOM'
         elif pardir == 'METADATA':
-            api_url = '/'.join([
-                self.XNAT_BASE_URL, 'data',
-                'projects', params['project_id'],
-                'subjects', params['subject_id'],
-                'experiments', params['session_id'],
-                'scans', params['scan_id'],
-                'resources/METADATA/files/' + base_filename
-            ])
-        else:
-            api_url = '/'.join([
-                self.XNAT_BASE_URL, 'data',
-                'projects', params['project_id'],
-                'subjects', params['subject_id'],
-                'experiments', params['session_id'],
-                'scans', params['scan_id'],
-                'resources/OTHERS/files/' + base_filename
-            ])
+            return scan_url + '/resources/METADATA'
+        return scan_url + '/resources/OTHERS'
 
-        r = self.xnatapi(api_url, 'get', 1)
-        if r.status_code == 200:
+    def needs_xml_validation(self, file_name):
+        pardir = os.path.basename(os.path.abspath(os.path.join(file_name, os.pardir)))
+        return file_name[-7:] == 'aim.xml' and pardir == 'METADATA'
+
+    def is_stored(self, row, file_name, api_url, md5=None):
+        """Whether the file listed by row on the server is the local file.
+        Identical files are recorded as existing; without digest checks any
+        file of the same name is.
+        """
+        if md5 is None and self.digest_check:
+            md5 = self.hasher.md5(file_name)
+        if not self.digest_check or digest.same_content(row, file_name, md5):
             logging.info('{0} exist!'.format(api_url))
-            self.results['exist'].append(file_name)
-            # Continue makes more sense?
-            # return
+            self.record_result('exist', file_name, md5)
             return True
+        logging.info('{0} differs from the local file: replacing it'.format(api_url))
+        self.metrics.inc('files_replaced')
+        return False
 
-        if base_filename[-7:] == 'aim.xml' and pardir == 'METADATA':
-            # verify xml
-            if not self.verify_xml(file_name):
-                self.results['fail'].append(
-                    [file_name, 'xml validate failed'])
-                # Failed but maybe shouldn't retry?
-                return False
+    def verify_listing_url(self, params, file_name):
+        """Listing holding the files of a directory once uploaded"""
+        if params['session_data_type'] == 'RECON':
+            return self.xnat_resource_url(params, file_name) + '/files'
+        return self.xnat_scan_url(params) + '/files'
 
-        with open(file_name, 'rb') as fh:
-            file_data = fh.read()
-            r = self.xnatapi_upload(api_url, file_data, base_filename)
+    def verify_uploads(self, params, uploaded):
+        """Compare the MD5 of the files uploaded for a directory with one
+        fresh listing of them; mismatches are reported as failed (and
+        uploaded again by the next run).
+        """
+        listing = self.xnat_fetch_listing(self.verify_listing_url(params, next(iter(uploaded))))
+        self.check_uploads(params, uploaded, listing)
+
+    def check_uploads(self, params, uploaded, listing):
+        if listing is None:
+            logging.warning('cannot verify the uploads of {0}'.format(os.path.dirname(next(iter(uploaded)))))
+            return
+        for file_name in uploaded:
+            collection = self.xnat_resource_url(params, file_name).rsplit('/', 1)[1]
+            row = listing.get(collection, os.path.basename(file_name))
+            if row is not None and digest.same_content(row, file_name, uploaded[file_name]):
+                self.metrics.inc('files_verified')
+                continue
+            logging.error('{0} on the server does not match the local file after upload'.format(file_name))
+            self.metrics.inc('verify_failures')
+            self.record_result('fail', [file_name, 'digest mismatch after upload'], replaces='success')
+
+    def scan_uploads(self, params):
+        """Start hashing the files of a directory that are already on the
+        server (their digests decide whether to skip them), and return the
+        tracker verifying the directory once all its files are uploaded.
+        """
+        if not self.digest_check or not params['file_names']:
+            return None
+        listing = self.listings.get(self.verify_listing_url(params, params['file_names'][0]))
+        if listing is not None:
+            stored = set(name for (collection, name) in listing.files)
+            self.hasher.prefetch([name for name in params['file_names'] if os.path.basename(name) in stored])
+        return digest.ScanUploads(len(params['file_names']), functools.partial(self.verify_uploads, params))
+
+    def upload_scan_file(self, uploads, name, function, file_name):
+        """Upload a file with retries; a failure is recorded once, when the
+        attempts are used up, not for every attempt"""
+        try:
+            if self.needs_xml_validation(file_name) and not self.verify_xml(file_name):
+                # the file will not become valid by sending it again
+                self.record_result('fail', [file_name, 'xml validate failed'])
+            elif not self.retry(name, function):
+                self.record_result('fail', file_name)
+        finally:
+            if self.compressor is not None:
+                self.compressor.discard(file_name)
+            if uploads is not None:
+                uploads.done()
+
+    def xnat_upload_raw_file(self, file_name, params, auth_info, uploads=None):
+        base_filename = os.path.basename(file_name)
 
-            if r.status_code < 400:
-                self.results['success'].append(file_name)
+        logging.info('File Extension: ' + base_filename[-3:])
+        resource_url = self.xnat_resource_url(params, file_name)
+        api_url = resource_url + '/files/' + base_filename
 
-                logging.info('upload ' + base_filename +
-                                ' successuflly!')
-                logging.info(r.text)
-                return True
-            else:
-                self.results['fail'].append(file_name)
+        listing = self.listings.get(self.xnat_scan_url(params) + '/files')
+        if listing is None:
+            return False
+        stored = listing.get(resource_url.rsplit('/', 1)[1], base_filename)
+        replace = stored is not None
+        if stored is not None and self.is_stored(stored, file_name, api_url):
+            # Continue makes more sense?
+            # return
+            return True
 
-                logging.error('upload failed: ' + file_name)
-                logging.error(r.text)
+        r, md5 = self.upload_file(api_url, file_name, params, overwrite=replace)
+        if r.status_code < 400:
+            self.record_result('success', file_name, md5)
+            self.record_transfer(file_name)
+            if uploads is not None:
+                uploads.uploaded_file(file_name, md5)
+
+            logging.info('upload ' + base_filename +
+                            ' successuflly!')
+            logging.info(r.text)
+            return True
+        else:
+            logging.error('upload failed: ' + file_name)
+            logging.error(r.text)
+            self.check_permanent(r, 'upload ' + file_name)
         return False
 
-    def xnat_upload_recon_file(self, file_name, params, auth_info):
+    def xnat_upload_recon_file(self, file_name, params, auth_info, uploads=None):
         base_filename = os.path.basename(file_name)
-        api_url = '/'.join([
-            self.XNAT_BASE_URL, 'data',
-            'projects', params['project_id'],
-            'subjects', params['subject_id'],
-            'experiments', params['session_id'],
-            'scans', params['scan_id'],
-            'reconstructions/' +
-            params['scan_id'] +
-            '/resources/NIFTI/files/' + base_filename
-        ])
+        resource_url = self.xnat_resource_url(params, file_name)
+        api_url = resource_url + '/files/' + base_filename
 
-        with open(file_name, 'rb') as fh:
-            file_data = fh.read()
-            r = requests.put(
-                api_url,
-                data=file_data,
-                headers={'content-type': 'text/plain'},
-                params={'file': base_filename},
-                auth=(auth_info[0], auth_info[1]),
-                verify=False)
-
-            if r.status_code < 400:
-                # logging.info('upload ' + base_filename + ' successuflly!')
-                # logging.info(r.text)
+        replace = False
+        if self.digest_check:
+            listing = self.listings.get(resource_url + '/files')
+            if listing is None:
+                return False
+            stored = listing.get('NIFTI', base_filename)
+            replace = stored is not None
+            if stored is not None and self.is_stored(stored, file_name, api_url):
                 return True
+
+        r, md5 = self.upload_file(api_url, file_name, params, overwrite=replace)
+        if r.status_code < 400:
+            self.record_result('success', file_name, md5)
+            self.record_transfer(file_name)
+            if uploads is not None:
+                uploads.uploaded_file(file_name, md5)
+            # logging.info('upload ' + base_filename + ' successuflly!')
+            # logging.info(r.text)
+            return True
+        else:
+            logging.error('upload failed' + file_name)
+            logging.error(r.text)
+            self.check_permanent(r, 'upload ' + file_name)
+        return False
+
+    def xnat_list_resource_files(self, resource_url):
+        """Listing rows of the files already stored in a resource, by name; None on error"""
+        r = self.xnatapi(resource_url + '/files', 'get', 1)
+        if r.status_code == 404:
+            return {}
+        if r.status_code >= 400:
+            logging.error('please check the status of api {0}'.format(resource_url))
+            logging.error(r.status_code)
+            return None
+        return dict((row['Name'], row) for row in r.json()['ResultSet']['Result'])
+
+    def xnat_upload_archive(self, file_names, params, auth_info, index):
+        """Upload a batch of files of one directory as a single zip.
+        XNAT extracts the zip into the resource (?extract=true); the file
+        listing is checked afterwards, so only files missing on the server
+        are sent again when the batch is retried.
+        """
+        resource_url = self.xnat_resource_url(params, file_names[0])
+        if params['session_data_type'] == 'RAW':
+            listing = self.listings.get(self.xnat_scan_url(params) + '/files')
+            existing = listing.rows(resource_url.rsplit('/', 1)[1]) if listing is not None else {}
+        else:
+            existing = self.xnat_list_resource_files(resource_url) or {}
+        if self.digest_check:
+            # the whole batch is compared with the server after the upload
+            self.hasher.prefetch(file_names)
+
+        pending = []
+        replace = False
+        for file_name in file_names:
+            stored = existing.get(os.path.basename(file_name))
+            if stored is not None and self.is_stored(stored, file_name, file_name):
+                continue
+            if stored is not None:
+                replace = True
+            if self.needs_xml_validation(file_name) and not self.verify_xml(file_name):
+                self.record_result('fail', [file_name, 'xml validate failed'])
             else:
-                logging.error('upload failed' + file_name)
+                pending.append(file_name)
+
+        archive_name = '{0}_{1}.zip'.format(params['scan_id'], index)
+        api_url = resource_url + '/files/' + archive_name
+        # files stored with other content are replaced; a resent batch may
+        # replace files of the previous attempt that did not match
+        overwrite = [replace]
+
+        def upload_pending():
+            if not pending:
+                return True
+            with self.metrics.stage('archive'):
+                fh = self.build_upload_archive(pending, params)
+            with fh, self.metrics.stage('upload'):
+                r = self.xnatapi_upload(api_url, fh, archive_name, extract=True, overwrite=overwrite[0])
+            if r.status_code >= 400:
+                logging.error('upload failed: ' + archive_name)
                 logging.error(r.text)
-        return False
+                self.check_permanent(r, 'upload ' + archive_name)
+                return False
+
+            uploaded = self.xnat_list_resource_files(resource_url)
+            if uploaded is None:
+                return False
+            for file_name in list(pending):
+                row = uploaded.get(os.path.basename(file_name))
+                if row is None:
+                    continue
+                md5 = self.hasher.md5(file_name) if self.digest_check else None
+                if self.digest_check and not digest.same_content(row, file_name, md5):
+                    logging.error('{0} on the server does not match the local file after upload'.format(file_name))
+                    self.metrics.inc('verify_failures')
+                    # resent with the next attempt
+                    self.hasher.prefetch([file_name])
+                    overwrite[0] = True
+                    continue
+                if self.digest_check:
+                    self.metrics.inc('files_verified')
+                pending.remove(file_name)
+                self.record_result('success', file_name, md5)
+                self.record_transfer(file_name)
+            if pending:
+                logging.error('{0} files of {1} missing or different on server after upload'.format(len(pending), archive_name))
+                return False
+            logging.info('upload ' + archive_name + ' successuflly!')
+            return True
+
+        self.retry('upload_files:archive', upload_pending)
+        if self.digest_check:
+            self.hasher.discard(file_names)
+        for file_name in pending:
+            self.record_result('fail', [file_name, 'missing or different after archive upload'])
+
+    def build_upload_archive(self, file_names, params):
+        """Zip bundle of a batch, with deflated entries in zip compression"""
+        compressor = self.compressor
+        if compressor is None or compressor.mode != 'zip':
+            return archive.build_archive(file_names)
+        infos = []
+        store = lambda file_name: not compressor.should_compress(file_name, compression.modality(file_name, params))
+        fh = compressor.run(archive.build_archive, file_names, zipfile.ZIP_DEFLATED, compressor.level, store, infos)
+        compressor.record_archive(file_names, infos, params)
+        return fh
 
     def xnat_upload_files(self, params, auth_info):
-        if params['session_data_type'] == 'RAW':
+        """Queue every file of the scan on the transfer pool.
+        Returns as soon as the files are queued, so the next scan can be
+        created while this one is still uploading. Each file is retried
+        on its own.
+        """
+        if self.upload_mode == 'archive':
+            for index, file_names in enumerate(archive.batches(params['file_names'], self.archive_batch_size)):
+                self.pool.submit(self.xnat_upload_archive, file_names, params, auth_info, index)
+        elif params['session_data_type'] == 'RAW':
+            uploads = self.scan_uploads(params)
             for file_name in params['file_names']:
-                self.retry('upload_files:raw', functools.partial(self.xnat_upload_raw_file, file_name, params, auth_info))
+                self.compress_ahead(file_name, params)
+                self.pool.submit(self.upload_scan_file, uploads, 'upload_files:raw', functools.partial(self.xnat_upload_raw_file, file_name, params, auth_info, uploads), file_name)
         elif params['session_data_type'] == 'RECON':
+            uploads = self.scan_uploads(params)
             for file_name in params['file_names']:
-                self.retry('upload_files:recon', functools.partial(self.xnat_upload_recon_file, file_name, params, auth_info))
-
-    def do_api_request(self, auth_info, data_dir):
-
-        for index, dir_info in enumerate(os.walk(data_dir)):
+                self.compress_ahead(file_name, params)
+                self.pool.submit(self.upload_scan_file, uploads, 'upload_files:recon', functools.partial(self.xnat_upload_recon_file, file_name, params, auth_info, uploads), file_name)
+
+    def compress_ahead(self, file_name, params):
+        if self.compressor is not None:
+            self.compressor.compress_ahead(file_name, compression.modality(file_name, params))
+
+    def walk(self, data_dir):
+        """os.walk of data_dir; with a directory index, the files of the
+        directories unchanged since the last run are not listed"""
+        if self.directory_index is not None:
+            return self.directory_index.walk(data_dir)
+        return os.walk(data_dir)
+
+    def walk_data_dir(self, data_dir):
+        for index, dir_info in enumerate(self.metrics.timed_iter('walk', self.walk(data_dir))):
             logging.info('dir_info >> ')
             logging.info(list(dir_info))
             dir_info = list(dir_info)
             dir_info[2] = list(filter(lambda x: x != '.DS_Store', dir_info[2]))
 
+            if index > 1 and len(dir_info[2]) > 0 and self.journal is not None:
+                # files uploaded by an earlier run are skipped without any request
+                done = self.journal.done_files(self.build_full_file_path(dir_info))
+                if done:
+                    logging.info('{0} files already uploaded in {1}'.format(len(done), dir_info[0]))
+                    dir_info[2] = [name for name in dir_info[2] if os.path.join(dir_info[0], name) not in done]
+
             if index > 1 and len(dir_info[2]) > 0:
                 # This is only entered on *.dcm, *.xml, ... files (When file count > 0)
-                params = self.build_restapi_parameter_through_dicom(dir_info)
+                if self.directory_index is not None:
+                    # indexed once all its files are handled
+                    self.directory_index.hold(dir_info[0], dir_info[2])
+                yield dir_info
+
+    def extract_metadata(self, dir_infos):
+        # DICOM headers are read in a process pool, a few directories ahead
+        for dir_info, result, error in self.metrics.timed_iter('dicom_parse', self.header_reader.read(dir_infos)):
+            if error is None:
+                header, mismatched = result
                 try:
-                    self.scanExist = 0
-                    self.retry('create_project', functools.partial(self.xnat_create_project, params, auth_info))
-                    self.retry('create_subject', functools.partial(self.xnat_create_subject, params, auth_info))
-                    self.retry('create_session', functools.partial(self.xnat_create_session, params, auth_info))
-                    self.retry('create_scan', functools.partial(self.xnat_create_scan, params, auth_info))
-                    self.retry('create_resource_for_scan', functools.partial(self.xnat_create_resource_for_scan, params, auth_info))
-                    self.xnat_upload_files(params, auth_info) # Already retry by itself.
-                except Exception:
-                    traceback.print_exc()
+                    params = self.build_restapi_parameter_through_dicom(dir_info, header)
+                except Exception as e:
+                    error = e
+            if error is not None:
+                # only this directory is skipped, the other scans go on
+                logging.error('cannot route {0}: {1!r}'.format(dir_info[0], error))
+                for file_name in self.build_full_file_path(dir_info):
+                    self.record_result('fail', [file_name, 'dicom header unreadable'])
+                continue
+            for file_name in mismatched:
+                logging.error('DICOM routing tags differ from the series: ' + file_name)
+                self.record_result('fail', [file_name, 'dicom routing tags mismatch'])
+                params['file_names'].remove(file_name)
+            yield params
+
+    def owned_scans(self, params_list):
+        """Scans of the subjects this shard handles (all without sharding)"""
+        for params in params_list:
+            if not self.shard.active or self.shard.owns(params['project_id'], params['subject_id'], claim=not self.dry_run):
+                yield params
+            elif self.directory_index is not None:
+                for file_name in params['file_names']:
+                    self.directory_index.release(file_name)
+
+    def prepare_hierarchy(self, params_list, auth_info):
+        for params in params_list:
+            try:
+                self.xnat_create_hierarchy(params, auth_info)
+            except Exception:
+                traceback.print_exc()
+                continue
+            yield params
+
+    def prepare_sessions(self, params_list, auth_info):
+        """prepare_hierarchy of hierarchy_mode xml: the directories of a
+        session found one after the other are created together"""
+        for scans in session_batches(params_list):
+            try:
+                self.xnat_create_sessions(scans, auth_info)
+            except Exception:
+                traceback.print_exc()
+                continue
+            for params in scans:
+                yield params
+
+    def dispatch_uploads(self, params_list, auth_info):
+        for params in params_list:
+            try:
+                self.xnat_upload_files(params, auth_info) # Already retry by itself.
+            except Exception:
+                traceback.print_exc()
 
-    def push_data_to_xnat(self, data_dirs):
-        for data_dir in data_dirs:
-            auth_info = self.load_config(data_dir)
+    def do_api_request(self, auth_info, data_dir):
+        """Walk, parse, create and upload as a pipeline: while a scan is
+        uploading, the next ones are discovered, parsed and created.
+        """
+        self.run_pipeline(self.walk_data_dir(data_dir),
+                          [lambda dir_infos: self.owned_scans(self.extract_metadata(dir_infos))],
+                          auth_info)
+
+    def run_pipeline(self, source, stages, auth_info):
+        """Run source and stages followed by the upload stages. Behind the
+        scheduler the queues hold a single scan, so the scan it picks is the
+        next one uploaded.
+        """
+        if self.xml_validator is not None:
+            stages = stages + [self.validate_ahead]
+        queue_sizes = [self.pipeline_queue_size] * len(stages)
+        if self.scheduler.active:
+            stages = stages + [self.scheduler.order]
+            queue_sizes.append(self.pipeline_queue_size)
+        upload_stages = self.upload_stages(auth_info)
+        queue_sizes.extend([1 if self.scheduler.active else self.pipeline_queue_size] * len(upload_stages))
+        Pipeline(self.pipeline_queue_size).run(source, *(stages + upload_stages), queue_sizes=queue_sizes)
+
+    def upload_stages(self, auth_info):
+        """Last stages of the pipeline: hierarchy creation then uploads on
+        the transfer pool, or both as tasks of the asyncio engine"""
+        if self.async_engine is not None:
+            return [self.async_engine.import_scans]
+        prepare = self.prepare_sessions if self.hierarchy_mode == 'xml' else self.prepare_hierarchy
+        return [functools.partial(prepare, auth_info=auth_info),
+                functools.partial(self.dispatch_uploads, auth_info=auth_info)]
+
+    def start_engine(self):
+        if self.engine == 'async':
+            self.async_engine = AsyncImportEngine(self, self.async_concurrency)
+        else:
+            self.pool = TransferPool(self.workers, name='upload')
 
-            self.do_api_request(auth_info, data_dir)
+    def select_data_dir(self, data_dir):
+        """Config of a data directory, for the clients of both engines"""
+        auth_info = self.load_config(data_dir)
+        self.client.base_url = self.XNAT_BASE_URL
+        if self.async_engine is not None:
+            self.async_engine.client.base_url = self.XNAT_BASE_URL
+        return auth_info
 
-    def output_result_csv(self):
-        with open('fail.csv', 'w') as csvfh:
-            csv_writer = csv.writer(csvfh, delimiter=',')
-            for row in self.results['fail']:
-                csv_writer.writerow(row)
+    def start_progress(self):
+        if self.progress:
+            self.progress_line = ProgressLine(self.metrics).start()
+
+    def push_data_to_xnat(self, data_dirs):
+        self.start_progress()
+        self.start_xml_validator()
+        self.start_engine()
+        self.header_reader = dicom.HeaderReader(self.parse_workers, self.verify_all_headers)
+        try:
+            for data_dir in data_dirs:
+                auth_info = self.select_data_dir(data_dir)
+
+                self.do_api_request(auth_info, data_dir)
+        finally:
+            self.header_reader.shutdown()
+            self.finish()
+        # only after a complete walk, and once every upload has ended
+        if self.directory_index is not None:
+            self.directory_index.save()
+
+    def finish(self):
+        if self.async_engine is not None:
+            self.async_engine.shutdown()
+        else:
+            self.pool.shutdown()
+        if self.xml_validator is not None:
+            self.xml_validator.shutdown()
+        if self.compressor is not None:
+            self.compressor.shutdown()
+        if self.hasher is not None:
+            self.hasher.shutdown()
+        if self.progress_line is not None:
+            self.progress_line.stop()
+        if self.journal is not None:
+            self.journal.close()
+        self.results.close()
+        logging.info('throughput: ' + self.stats.report())
+        plan.append_history(self.history, self.stats.files, self.stats.bytes, self.stats.elapsed())
+        if self.metrics_json:
+            self.metrics.write_json(self.metrics_json)
+        if self.metrics_prometheus:
+            self.metrics.write_prometheus(self.metrics_prometheus)
+
+    def write_plan(self, data_dirs, plan_file):
+        """Dry run: walk and parse like an import, but only write the plan"""
+        scans = []
+        self.header_reader = dicom.HeaderReader(self.parse_workers, self.verify_all_headers)
+        try:
+            for data_dir in data_dirs:
+                self.load_config(data_dir)
+                for params in self.owned_scans(self.extract_metadata(self.walk_data_dir(data_dir))):
+                    params['data_dir'] = data_dir
+                    params['bytes'] = sum(os.path.getsize(file_name) for file_name in params['file_names'])
+                    scans.append(params)
+        finally:
+            self.header_reader.shutdown()
+            if self.journal is not None:
+                self.journal.close()
+
+        import_plan = plan.build_plan(scans, self.upload_mode, self.archive_batch_size,
+                                      self.warm_hierarchy_cache, plan.load_history(self.history),
+                                      self.digest_check, self.hierarchy_mode == 'xml')
+        plan.save_plan(import_plan, plan_file)
+        totals = import_plan['totals']
+        print('plan written to {0}: {1} projects, {2} subjects, {3} sessions, {4} scans, {5} files, {6:.2f} MB, '
+              'at most {7} requests'.format(plan_file, totals['projects'], totals['subjects'], totals['sessions'],
+                                            totals['scans'], totals['files'], totals['bytes'] / 1e6,
+                                            import_plan['requests']['total']))
+        if import_plan['estimated_seconds'] is not None:
+            print('estimated duration: {0}'.format(datetime.timedelta(seconds=int(import_plan['estimated_seconds']))))
+        else:
+            print('no throughput history yet ({0}), no duration estimate'.format(self.history))
+
+    def planned_scans(self, scans):
+        for params in scans:
+            if self.journal is not None:
+                done = self.journal.done_files(params['file_names'])
+                params['file_names'] = [name for name in params['file_names'] if name not in done]
+            if params['file_names']:
+                yield params
+
+    def push_plan_to_xnat(self, import_plan):
+        """Run a saved plan: no walk and no DICOM parsing"""
+        scans = import_plan['scans']
+        self.start_progress()
+        self.start_xml_validator()
+        self.start_engine()
+        try:
+            for data_dir, data_dir_scans in itertools.groupby(scans, key=lambda scan: scan['data_dir']):
+                auth_info = self.select_data_dir(data_dir)
+
+                self.run_pipeline(self.owned_scans(self.planned_scans(data_dir_scans)), [], auth_info)
+        finally:
+            self.finish()
 
     # def get_failed(self):
     #     """Get last failed results
@@ -597,12 +1272,439 @@ class XnatImporter:
 
 
 
+class AsyncImportEngine:
+    """Hierarchy creation and uploads of XnatImporter as asyncio tasks.
+
+    The walk and DICOM parse stages feed scans from their threads; each
+    scan becomes a task on one event loop thread, whose uploads share
+    `concurrency` connections of an AsyncXnatClient. Hundreds of small
+    files can be in flight without a thread each. Entities needed by
+    several scans at once are checked or created by a single task, the
+    others wait for it.
+    """
+    MAX_LISTINGS = ListingCache.DEFAULT_MAX_ENTRIES
+
+    def __init__(self, importer, concurrency):
+        from xnat_transfer.aclient import AsyncXnatClient, TRANSIENT_EXCEPTIONS
+        self.transient_exceptions = TRANSIENT_EXCEPTIONS
+        self.importer = importer
+        self.metrics = importer.metrics
+        self.client = AsyncXnatClient(importer.XNAT_BASE_URL, importer.auth_info, concurrency,
+                                      retry_policy=RetryPolicy(4, max_delay=importer.retry_policy.max_delay,
+                                                               breaker=importer.retry_policy.breaker),
+                                      metrics=importer.metrics, limiter=importer.limiter,
+                                      sessions=importer.client.sessions)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='async-engine', daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.client.start(), self.loop).result()
+        self.upload_slots = schedule.PrioritySlots(concurrency)
+        self.tasks = {}
+        self.listings = collections.OrderedDict()
+        # scans handed over and not finished: bounds how far the walk runs ahead
+        self.scan_slots = threading.Semaphore(max(importer.pipeline_queue_size, concurrency // 4))
+        self.pending = set()
+        self.pending_lock = threading.Lock()
+        logging.info('async engine started with {0} connections'.format(concurrency))
+
+    def import_scans(self, params_list):
+        """Last pipeline stage: hand every scan over to the event loop"""
+        for params in params_list:
+            self.scan_slots.acquire()
+            future = asyncio.run_coroutine_threadsafe(self.import_scan(params), self.loop)
+            with self.pending_lock:
+                self.pending.add(future)
+            future.add_done_callback(self.scan_done)
+
+    def scan_done(self, future):
+        with self.pending_lock:
+            self.pending.discard(future)
+        self.scan_slots.release()
+        if not future.cancelled() and future.exception() is not None:
+            traceback.print_exception(future.exception())
+
+    def shutdown(self):
+        """Wait for the scans handed over, then close the connections"""
+        while True:
+            with self.pending_lock:
+                pending = list(self.pending)
+            if not pending:
+                break
+            concurrent.futures.wait(pending)
+        asyncio.run_coroutine_threadsafe(self.client.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    async def retry(self, name, function):
+        """RetryPolicy.call for coroutine functions"""
+        policy = self.importer.retry_policy
+        for attempt in range(policy.max_attempts):
+            await self.client.wait_breaker()
+            token = in_task.set(True)
+            try:
+                if await function():
+                    return True
+            except PermanentError as e:
+                logging.error('{0} failed permanently: {1}'.format(name, e))
+                return False
+            except self.transient_exceptions as e:
+                logging.error('{0}: {1!r}'.format(name, e))
+            finally:
+                in_task.reset(token)
+            if attempt + 1 < policy.max_attempts:
+                self.metrics.inc('task_retries')
+                delay = policy.delay(attempt)
+                print("Retry({0}) {1} in {2:.1f}s...".format(attempt + 1, name, delay))
+                await asyncio.sleep(delay)
+        print("Retry count exceeds max retries({0})!!".format(policy.max_attempts))
+        return False
+
+    async def once(self, key, function):
+        """Run function for the first caller of key; callers arriving
+        while it runs wait for its result instead of running it again"""
+        task = self.tasks.get(key)
+        if task is None:
+            task = self.tasks[key] = asyncio.ensure_future(function())
+        try:
+            return await asyncio.shield(task)
+        finally:
+            if task.done() and self.tasks.get(key) is task:
+                del self.tasks[key]
+
+    async def xnatapi(self, api_url, action='get'):
+        if action == 'get':
+            return await self.client.get('{0}?format=json'.format(api_url))
+        return await self.client.put(api_url)
+
+    async def listing(self, files_url):
+        """File listing shared by the tasks of a scan, fetched once"""
+        entry = self.listings.get(files_url)
+        if entry is None:
+            entry = self.listings[files_url] = asyncio.ensure_future(self.fetch_listing(files_url))
+            while len(self.listings) > self.MAX_LISTINGS:
+                self.listings.popitem(last=False)
+        else:
+            self.listings.move_to_end(files_url)
+        try:
+            listing = await asyncio.shield(entry)
+        except Exception:
+            self.forget_listing(files_url, entry)
+            raise
+        if listing is None:
+            # failed: let the next caller try again
+            self.forget_listing(files_url, entry)
+        return listing
+
+    def forget_listing(self, files_url, entry):
+        if self.listings.get(files_url) is entry:
+            del self.listings[files_url]
+
+    def put_listing(self, files_url, listing):
+        entry = self.loop.create_future()
+        entry.set_result(listing)
+        self.listings[files_url] = entry
+
+    async def fetch_listing(self, files_url):
+        return self.importer.listing_from_response(await self.xnatapi(files_url, 'get'), files_url)
+
+    async def import_scan(self, params):
+        importer = self.importer
+        start = time.perf_counter()
+        try:
+            await self.create_hierarchy(params)
+        finally:
+            self.metrics.add_stage_time('hierarchy', time.perf_counter() - start)
+
+        file_names = params['file_names']
+        uploaded = {}
+        if importer.digest_check and file_names:
+            # files already on the server are compared by digest: hash them now
+            listing = await self.listing(importer.verify_listing_url(params, file_names[0]))
+            if listing is not None:
+                stored = set(name for (collection, name) in listing.files)
+                importer.hasher.prefetch([name for name in file_names if os.path.basename(name) in stored])
+        name = 'upload_files:' + params['session_data_type'].lower()
+        await asyncio.gather(*[self.upload_scan_file(name, file_name, params, uploaded) for file_name in file_names])
+        if importer.digest_check and uploaded:
+            listing = await self.fetch_listing(importer.verify_listing_url(params, next(iter(uploaded))))
+            importer.check_uploads(params, uploaded, listing)
+
+    async def create_hierarchy(self, params):
+        importer = self.importer
+        project_id = params['project_id']
+        if importer.warm_hierarchy_cache:
+            await self.once(('warm', project_id), functools.partial(self.warm_hierarchy, project_id))
+
+        state = {'scan_exists': False}
+        steps = [
+            ('project', 'create_project', self.create_project),
+            ('subject', 'create_subject', self.create_subject),
+            ('session', 'create_session', self.create_session),
+            ('scan', 'create_scan', self.create_scan),
+            ('resource', 'create_resource_for_scan', self.create_resource),
+        ]
+        for level, name, function in steps:
+            key = importer.hierarchy.key(level, params)
+            if key in importer.hierarchy:
+                if level == 'scan':
+                    state['scan_exists'] = True
+                continue
+            if await self.once(key, functools.partial(self.retry, name, functools.partial(function, params, state))):
+                importer.hierarchy.add(key)
+
+    async def warm_hierarchy(self, project_id):
+        if self.importer.hierarchy.needs_warming(project_id):
+            # two listing calls per project: not worth an async version
+            await self.loop.run_in_executor(None, self.importer.warm_hierarchy, project_id)
+
+    async def create_project(self, params, state):
+        api_url = '/'.join([self.importer.XNAT_BASE_URL, 'data', 'projects', params['project_id']])
+        r = await self.xnatapi(api_url, 'put')
+        if r.status_code < 400:
+            return True
+        logging.error('please check the status of xnat_create_project')
+        logging.error(r.status_code)
+        self.importer.check_permanent(r, 'create_project')
+        return False
+
+    async def create_subject(self, params, state):
+        api_url = '/'.join([self.importer.XNAT_BASE_URL, 'data', 'projects',
+                            params['project_id'], 'subjects', params['subject_id']])
+        r = await self.xnatapi(api_url, 'get')
+        if r.status_code == 200:
+            return True
+        r = await self.xnatapi(api_url, 'put')
+        if r.status_code < 400:
+            return True
+        logging.error('please check the status of xnat_create_subject')
+        logging.error(r.status_code)
+        self.importer.check_permanent(r, 'create_subject')
+        return False
+
+    async def create_session(self, params, state):
+        query_params = '?xnat:' + params['data_type'] + 'SessionData/date=' + datetime.date.today().isoformat()
+        api_url = '/'.join([self.importer.XNAT_BASE_URL, 'data', 'projects', params['project_id'],
+                            'subjects', params['subject_id'], 'experiments', params['session_id']])
+        r = await self.xnatapi(api_url + query_params, 'put')
+        if r.status_code < 400:
+            return True
+        logging.error('please check the status of xnat_create_session')
+        logging.error(r.status_code)
+        self.importer.check_permanent(r, 'create_session')
+        return False
+
+    async def create_scan(self, params, state):
+        scan_url = self.importer.xnat_scan_url(params)
+        listing = await self.listing(scan_url + '/files')
+        if listing is None:
+            return False
+        if listing.exists:
+            state['scan_exists'] = True
+            return True
+        r = await self.xnatapi(scan_url + '?xsiType=xnat:' + params['xnat_data_type'], 'put')
+        if r.status_code < 400:
+            self.put_listing(scan_url + '/files', FileListing(True))
+            return True
+        logging.info('please check the status of xnat_create_scan')
+        self.importer.check_permanent(r, 'create_scan')
+        return False
+
+    async def create_resource(self, params, state):
+        if params['session_data_type'] == 'RAW' and state['scan_exists']:
+            return True
+        for api_url in self.importer.resource_create_urls(params):
+            r = await self.xnatapi(api_url, 'put')
+        return self.importer.check_resource_created(r, api_url)
+
+    async def upload_scan_file(self, name, file_name, params, uploaded):
+        importer = self.importer
+        if importer.needs_xml_validation(file_name):
+            if not await self.loop.run_in_executor(None, importer.verify_xml, file_name):
+                # the file will not become valid by sending it again
+                importer.record_result('fail', [file_name, 'xml validate failed'])
+                return
+        # the files of the scans in flight take the free connections in
+        # the scheduler's order, the order they were handed over without it
+        async with self.upload_slots.slot(params.get('priority', ())):
+            if not await self.retry(name, functools.partial(self.upload_file, file_name, params, uploaded)):
+                importer.record_result('fail', file_name)
+
+    async def upload_file(self, file_name, params, uploaded):
+        """xnat_upload_raw_file / xnat_upload_recon_file of one file"""
+        importer = self.importer
+        base_filename = os.path.basename(file_name)
+        resource_url = importer.xnat_resource_url(params, file_name)
+        api_url = resource_url + '/files/' + base_filename
+        raw = params['session_data_type'] == 'RAW'
+
+        replace = False
+        if raw or importer.digest_check:
+            listing = await self.listing(importer.verify_listing_url(params, file_name))
+            if listing is None:
+                return False
+            stored = listing.get(resource_url.rsplit('/', 1)[1], base_filename)
+            replace = stored is not None
+            if stored is not None:
+                md5 = await asyncio.wrap_future(importer.hasher.future(file_name)) if importer.digest_check else None
+                if importer.is_stored(stored, file_name, api_url, md5):
+                    return True
+
+        query = {'file': base_filename}
+        if replace:
+            query['overwrite'] = 'true'
+        start = time.perf_counter()
+        try:
+            r, md5 = await self.client.put_file(api_url, file_name, importer.journal is not None or importer.digest_check,
+                                                headers={'content-type': 'text/plain'}, params=query)
+        finally:
+            self.metrics.add_stage_time('upload', time.perf_counter() - start)
+        if r.status_code < 400:
+            importer.record_result('success', file_name, md5)
+            importer.record_transfer(file_name)
+            uploaded[file_name] = md5
+            return True
+        logging.error('upload failed: ' + file_name)
+        logging.error(r.text)
+        importer.check_permanent(r, 'upload ' + file_name)
+        return False
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='batch import files into XNAT')
+    parser.add_argument('project', nargs='?',
+                        help='project name typed in upload.cmd (informational)')
+    parser.add_argument('--workers', type=int,
+                        help='number of parallel uploads (default: [transfer] workers in config.ini, or {0})'.format(XnatImporter.DEFAULT_WORKERS))
+    parser.add_argument('--upload-mode', choices=XnatImporter.UPLOAD_MODES,
+                        help='"file": one request per file; "archive": one zip per scan directory (or batch)')
+    parser.add_argument('--archive-batch-size', type=int,
+                        help='maximum number of files per zip in archive mode, 0 for one zip per directory (default: {0})'.format(XnatImporter.DEFAULT_ARCHIVE_BATCH_SIZE))
+    parser.add_argument('--engine', choices=XnatImporter.ENGINES,
+                        help='"thread": transfer pool of --workers threads; "async": asyncio tasks on one thread, for many small files (needs aiohttp)')
+    parser.add_argument('--async-concurrency', type=int,
+                        help='uploads in flight with --engine async (default: {0})'.format(XnatImporter.DEFAULT_ASYNC_CONCURRENCY))
+    parser.add_argument('--compression', choices=compression.COMPRESSION_MODES,
+                        help='"gzip": gzip-encoded request bodies; "zip": deflated zip bundles per scan (archive mode) (default: none)')
+    parser.add_argument('--compression-workers', type=int,
+                        help='threads compressing upload bodies, 0 to compress in the upload workers (default: {0})'.format(XnatImporter.DEFAULT_COMPRESSION_WORKERS))
+    parser.add_argument('--parse-workers', type=int,
+                        help='processes reading DICOM headers ahead of the uploads, 0 to read them inline (default: {0})'.format(XnatImporter.DEFAULT_PARSE_WORKERS))
+    parser.add_argument('--verify-all-headers', action='store_true', default=None,
+                        help='check the routing tags of every DICOM file, not only the first of each series')
+    parser.add_argument('--xml-workers', type=int,
+                        help='processes validating all AIM files before the uploads, 0 to validate each file when uploaded (default: {0})'.format(XnatImporter.DEFAULT_XML_WORKERS))
+    parser.add_argument('--xmllint', action='store_true', default=None,
+                        help='also cross-check AIM files with the xmllint command')
+    parser.add_argument('--hierarchy-mode', choices=XnatImporter.HIERARCHY_MODES,
+                        help='"calls": create sessions, scans and resources one call at a time; "xml": each session with all its scans in one XML document (default: calls)')
+    parser.add_argument('--warm-cache', action='store_true', default=None,
+                        help='list the subjects and sessions of each project once before creating them')
+    parser.add_argument('--journal',
+                        help='SQLite file recording the uploads, used to resume an interrupted import; "" to disable (default: {0})'.format(XnatImporter.DEFAULT_JOURNAL))
+    parser.add_argument('--no-digest-check', dest='digest_check', action='store_const', const=False,
+                        help='treat every file of the same name on the server as uploaded, and do not verify uploads by MD5')
+    parser.add_argument('--directory-index', metavar='FILE',
+                        help='JSON index of the directories walked; later runs only list the directories changed since, "" to disable (default: none)')
+    parser.add_argument('--full-scan', action='store_true',
+                        help='list every directory and rebuild the directory index')
+    parser.add_argument('--schedule', metavar='POLICIES',
+                        help='order of the uploads, policies compared in turn: session, smallest, metadata, subjects, e.g. "metadata,session" (default: walk order)')
+    parser.add_argument('--priority-subjects', metavar='LIST',
+                        help='subjects uploaded first, in this order: S1,S2,... or @FILE with one subject per line')
+    parser.add_argument('--schedule-window', type=int,
+                        help='scans read ahead of the uploads to choose from (default: {0})'.format(schedule.DEFAULT_WINDOW))
+    parser.add_argument('--shard', metavar='i/N',
+                        help='import only the subjects of shard i of N (by project/subject hash), e.g. one shard per machine')
+    parser.add_argument('--processes', type=int,
+                        help='run the import in N importer processes on this machine, one shard each')
+    parser.add_argument('--claim-dir',
+                        help='directory on the shared filesystem where importers claim subjects, so each is imported by one of them')
+    parser.add_argument('--claim-owner',
+                        help='name written in the claim files (default: host name and shard); a run with the same name takes its claims again')
+    # set by --processes for its children: their share of the bandwidth limit
+    parser.add_argument('--local-processes', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--bandwidth-limit', metavar='RATE',
+                        help='bytes/s shared by all uploads, e.g. 500k or 2M, 0 for none; overrides [bandwidth] in config.ini')
+    parser.add_argument('--max-retries', type=int,
+                        help='attempts per file or hierarchy call before giving up (default: {0})'.format(XnatImporter.DEFAULT_MAX_RETRIES))
+    parser.add_argument('--queue-size', dest='pipeline_queue_size', type=int,
+                        help='directories buffered between the walk, parse, hierarchy and upload stages (default: {0})'.format(XnatImporter.DEFAULT_PIPELINE_QUEUE_SIZE))
+    parser.add_argument('--plan', metavar='FILE',
+                        help='dry run: write what would be imported (JSON) with a request count and duration estimate, upload nothing')
+    parser.add_argument('--execute-plan', metavar='FILE',
+                        help='import the scans of a plan written by --plan, without walking the tree again')
+    parser.add_argument('--report', metavar='FILE',
+                        help='report receiving the result of every file as JSON lines (CSV if FILE ends in .csv), "" to disable (default: {0})'.format(XnatImporter.DEFAULT_REPORT))
+    parser.add_argument('--history',
+                        help='JSON file of measured throughput used for plan estimates (default: {0})'.format(XnatImporter.DEFAULT_HISTORY))
+    parser.add_argument('--metrics-json',
+                        help='file receiving the JSON summary of the run (default: import-metrics.json, "" to disable)')
+    parser.add_argument('--prometheus-textfile', dest='metrics_prometheus',
+                        help='also write the metrics in the Prometheus textfile-collector format')
+    parser.add_argument('--progress', action='store_const', const=True,
+                        help='show a live progress line (default: when stderr is a terminal)')
+    parser.add_argument('--no-progress', dest='progress', action='store_const', const=False)
+    parser.add_argument('--pool-size', type=int,
+                        help='size of the HTTP connection pool (default: [xnat] pool_size in config.ini, or {0})'.format(XnatClient.DEFAULT_POOL_SIZE))
+    args = parser.parse_args(argv)
+    if args.shard is not None:
+        try:
+            parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+    try:
+        schedule.parse_policies(args.schedule)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.processes is not None and args.processes > 1 and args.plan is not None:
+        parser.error('--plan writes one plan, run it without --processes')
+    return args
+
+
+def strip_options(argv, names):
+    """argv without the options in names and their values"""
+    result = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in names:
+            skip = True
+        elif not any(arg.startswith(name + '=') for name in names):
+            result.append(arg)
+    return result
+
+
+def launch_processes(args, argv):
+    """Local launcher: split the run (or its --shard) between --processes
+    importers, each one importing its own subjects; returns the exit code"""
+    index, count = parse_shard(args.shard) if args.shard else (1, 1)
+    child_argv = strip_options(argv, ('--processes', '--shard', '--local-processes'))
+    children = []
+    for shard in split_shard(index, count, args.processes):
+        print('starting importer for shard {0}'.format(shard))
+        children.append(subprocess.Popen(
+            [sys.executable, os.path.abspath(sys.argv[0])] + child_argv +
+            ['--shard', shard, '--local-processes', str(args.processes)]))
+    exit_codes = [child.wait() for child in children]
+    for shard, exit_code in zip(split_shard(index, count, args.processes), exit_codes):
+        if exit_code != 0:
+            logging.error('importer for shard {0} exited with {1}'.format(shard, exit_code))
+    return max(exit_codes, key=abs)
+
+
 if __name__ == '__main__':
     progName=sys.argv[0]
+    args = parse_args()
+    if args.processes is not None and args.processes > 1:
+        sys.exit(launch_processes(args, sys.argv[1:]))
     print("{0} ({1}): ready to import files.".format(progName, VER))
-    xnat_importer = XnatImporter()
+    xnat_importer = XnatImporter(args)
+    if args.plan is not None:
+        sys.exit(0)
 
-    pprint.pprint(xnat_importer.results)
+    pprint.pprint(xnat_importer.results.summary())
+    print("throughput: " + xnat_importer.stats.report())
 
     print("{0} ({1}): import files finish".format(progName, VER))
-    xnat_importer.output_result_csv()
@@ -0,0 +1,147 @@
+"""
+    upload bodies of xnat_transfer.streams: reads are capped at chunk_size,
+    and a multi-GB file goes through XnatClient to a local server without
+    the memory of the process growing with the file
+
+    python -m unittest discover tests (XNAT_TEST_UPLOAD_MB sets the size
+    of the large upload, 2048 by default)
+"""
+import hashlib
+import http.server
+import os
+import resource
+import sys
+import tempfile
+import threading
+import unittest
+
+from xnat_transfer.client import XnatClient
+from xnat_transfer.ratelimit import BandwidthLimiter
+from xnat_transfer.streams import FileBody, GzipBody, ThrottledBody
+
+UPLOAD_MB = int(os.environ.get('XNAT_TEST_UPLOAD_MB', '2048'))
+# growth of the peak RSS allowed while the large file is sent
+MAX_RSS_GROWTH = 64 * 1024 * 1024
+
+
+def peak_rss():
+    """Peak resident memory of the process, in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class SinkHandler(http.server.BaseHTTPRequestHandler):
+    """Answers /data/JSESSION and reads PUT bodies 1 MB at a time, keeping only their size"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, text):
+        body = text.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.reply('SINKSESSION')
+
+    def do_PUT(self):
+        remaining = int(self.headers['Content-Length'])
+        received = 0
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                break
+            received += len(chunk)
+            remaining -= len(chunk)
+        self.server.received.append(received)
+        self.reply(str(received))
+
+
+class ChunkSizeTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.file_name = tempfile.mkstemp()
+        self.data = os.urandom(300 * 1024 + 17)
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(self.data)
+
+    def tearDown(self):
+        os.remove(self.file_name)
+
+    def check_reads(self, body, chunk_size):
+        content = b''
+        for size in (-1, None, 1, chunk_size, chunk_size + 1, 10 * 1024 * 1024, -1):
+            chunk = body.read(size)
+            self.assertLessEqual(len(chunk), chunk_size)
+            content += chunk
+        while True:
+            chunk = body.read(10 * 1024 * 1024)
+            if not chunk:
+                break
+            self.assertLessEqual(len(chunk), chunk_size)
+            content += chunk
+        return content
+
+    def test_file_body(self):
+        with FileBody(self.file_name, chunk_size=4096, digest=True) as body:
+            self.assertEqual(len(body), len(self.data))
+            self.assertEqual(self.check_reads(body, 4096), self.data)
+            self.assertEqual(body.hexdigest(), hashlib.md5(self.data).hexdigest())
+            body.seek(0)
+            self.assertTrue(all(len(chunk) <= 4096 for chunk in body))
+
+    def test_throttled_body(self):
+        limiter = BandwidthLimiter(limit=0)
+        with FileBody(self.file_name, chunk_size=65536) as source:
+            body = ThrottledBody(source, limiter, chunk_size=1000)
+            self.assertEqual(len(body), len(self.data))
+            self.assertEqual(self.check_reads(body, 1000), self.data)
+
+    def test_gzip_body(self):
+        with GzipBody(self.file_name, chunk_size=2048) as body:
+            self.assertEqual(body.raw_size, len(self.data))
+            self.check_reads(body, 2048)
+            self.assertEqual(body.hexdigest(), hashlib.md5(self.data).hexdigest())
+
+
+class LargeUploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), SinkHandler)
+        self.server.received = []
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.base_url = 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+        self.dir = tempfile.TemporaryDirectory()
+        self.file_name = os.path.join(self.dir.name, 'large.dcm')
+        self.size = UPLOAD_MB * 1024 * 1024
+        # sparse: written in no time, read through the page cache like any file
+        with open(self.file_name, 'wb') as fh:
+            fh.truncate(self.size)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.dir.cleanup()
+
+    def test_memory_stays_flat(self):
+        client = XnatClient(self.base_url, ('user', 'password'), limiter=BandwidthLimiter(limit=0))
+        # warm up: imports and the connection pool
+        with FileBody(__file__) as body:
+            self.assertEqual(client.put(self.base_url + '/warmup', data=body).status_code, 200)
+        before = peak_rss()
+        with FileBody(self.file_name) as body:
+            r = client.put(self.base_url + '/data/files/large.dcm', data=body)
+        growth = peak_rss() - before
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.server.received[-1], self.size)
+        self.assertLess(growth, MAX_RSS_GROWTH,
+                        'peak RSS grew by {0:.0f} MB sending {1} MB'.format(growth / 1e6, UPLOAD_MB))
+
+
+if __name__ == '__main__':
+    unittest.main()
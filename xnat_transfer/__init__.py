@@ -0,0 +1,3 @@
+"""
+    shared helpers for the XNAT import / export scripts
+"""
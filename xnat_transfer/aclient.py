@@ -0,0 +1,255 @@
+"""
+    asyncio counterpart of XnatClient on aiohttp, used by the importer's
+    async engine: same JSESSIONID cookie, one re-authentication for all
+    tasks hitting a 401, the same retries, circuit breaker, metrics and
+    bandwidth limit
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+    print('please type "pip install aiohttp" for installing aiohttp package (used by --engine async)')
+
+from xnat_transfer.client import XnatClient
+from xnat_transfer.retry import RetryPolicy, TransientError, classify, request_attempts, retry_after
+from xnat_transfer.session import SessionManager
+from xnat_transfer.streams import FileBody
+
+if aiohttp is not None:
+    TRANSIENT_EXCEPTIONS = (aiohttp.ClientError, asyncio.TimeoutError, TransientError)
+else:
+    TRANSIENT_EXCEPTIONS = (asyncio.TimeoutError, TransientError)
+
+
+class Response:
+    """What the importer reads of a requests.Response: status_code,
+    headers, text and json(), with the body already read"""
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class AsyncXnatClient:
+    """Keep-alive aiohttp client for the importer's async engine.
+
+    Up to `concurrency` connections are open at once; every request of
+    the engine is a task on one event loop instead of a thread, so
+    hundreds of small uploads can be in flight. A body is given as a
+    function returning a fresh payload, so it can be sent again after a
+    401 or a retry. The SessionManager may be the one of the threaded
+    client, so both use (and refresh) the same session.
+    """
+    DEFAULT_CONCURRENCY = 100
+
+    def __init__(self, base_url, auth_info, concurrency=DEFAULT_CONCURRENCY, verify=False,
+                 retry_policy=None, timeout=XnatClient.DEFAULT_TIMEOUT, metrics=None, limiter=None, sessions=None):
+        if aiohttp is None:
+            raise RuntimeError('the async engine needs the aiohttp package')
+        self.base_url = base_url
+        self.auth_info = auth_info
+        self.concurrency = concurrency
+        self.verify = verify
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy(max_attempts=4)
+        self.timeout = timeout
+        self.metrics = metrics
+        self.limiter = limiter
+        self.sessions = sessions if sessions is not None else SessionManager('{0}@{1}'.format(auth_info[0], base_url))
+        self.authErr = 0
+        self.auth_lock = None
+        self.session = None
+
+    async def start(self):
+        """Open the connection pool; called on the loop running the client"""
+        self.auth_lock = asyncio.Lock()
+        connector = aiohttp.TCPConnector(limit=self.concurrency, ssl=None if self.verify else False)
+        # the JSESSIONID is sent explicitly, like XnatClient does
+        self.session = aiohttp.ClientSession(
+            connector=connector, cookie_jar=aiohttp.DummyCookieJar(),
+            timeout=aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1]))
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    @property
+    def session_id(self):
+        return self.sessions.session_id
+
+    async def session_request(self):
+        """Ask the server for a new JSESSIONID with basic auth"""
+        if self.authErr >= 2:
+            raise EOFError('authentication failed {0} times'.format(self.authErr))
+
+        api_url = '/'.join([self.base_url, 'data', 'JSESSION'])
+        r = await self.timed_request('GET', api_url, auth=aiohttp.BasicAuth(self.auth_info[0], self.auth_info[1]))
+        if r.status_code < 400:
+            self.sessions.set(r.text)
+            self.authErr = 0
+            return True
+        elif r.status_code == 401:
+            logging.error('please check the status of api {0}'.format(api_url))
+            logging.error(r.status_code)
+            logging.error(r.text)
+            self.authErr = self.authErr + 1
+            raise EOFError
+        elif classify(r) == 'transient':
+            raise TransientError('{0}: {1}'.format(api_url, r.status_code))
+        else:
+            logging.error('please check the status of api {0}'.format(api_url))
+            logging.error(r.status_code)
+            logging.error(r.text)
+            raise EOFError
+
+    async def check_session(self):
+        """Confirm a cached session, see XnatClient.check_session"""
+        session_id = self.session_id
+        try:
+            r = await self.timed_request('GET', '/'.join([self.base_url, 'data', 'JSESSION']))
+        except TRANSIENT_EXCEPTIONS:
+            return False
+        if r.status_code < 400 and r.text.strip() == session_id:
+            self.sessions.touch(session_id)
+            return True
+        self.sessions.invalidate(session_id)
+        return False
+
+    async def ensure_session(self, body=False):
+        """Authenticate before the request rather than after its 401"""
+        if self.sessions.usable(body):
+            return
+        async with self.auth_lock:
+            if self.sessions.usable(body):
+                return
+            if self.sessions.usable() and await self.check_session():
+                return
+            if self.metrics is not None:
+                self.metrics.inc('authentications')
+            await self.session_request()
+
+    async def reauthenticate(self, stale_session_id):
+        """Re-authenticate once for all tasks that got a 401 with the same session"""
+        async with self.auth_lock:
+            if self.session_id is not None and self.session_id != stale_session_id:
+                return True
+            if self.metrics is not None:
+                self.metrics.inc('reauthentications')
+            return await self.session_request()
+
+    async def timed_request(self, method, url, headers=None, **kwargs):
+        headers = dict(headers or {})
+        if self.session_id is not None and 'auth' not in kwargs:
+            headers['Cookie'] = 'JSESSIONID={0}'.format(self.session_id)
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            async with self.session.request(method, url, headers=headers, **kwargs) as answer:
+                r = Response(answer.status, answer.headers, await answer.read())
+            status = r.status_code
+            return r
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe_request(method, url, time.perf_counter() - start, status)
+
+    async def send(self, method, url, body=None, **kwargs):
+        await self.ensure_session(body is not None)
+        session_id = self.session_id
+        r = await self.timed_request(method, url, data=body() if body is not None else None, **kwargs)
+        if r.status_code == 401:
+            self.sessions.invalidate(session_id)
+            if await self.reauthenticate(session_id):
+                session_id = self.session_id
+                r = await self.timed_request(method, url, data=body() if body is not None else None, **kwargs)
+        if r.status_code != 401:
+            self.sessions.touch(session_id)
+        return r
+
+    async def wait_breaker(self):
+        while True:
+            remaining = self.retry_policy.breaker.remaining()
+            if remaining <= 0:
+                return
+            await asyncio.sleep(remaining)
+
+    async def request(self, method, url, body=None, **kwargs):
+        policy = self.retry_policy
+        # once within a task retried by the engine, see XnatClient
+        max_attempts = request_attempts(policy)
+        attempt = 0
+        while True:
+            await self.wait_breaker()
+            try:
+                r = await self.send(method, url, body, **kwargs)
+            except TRANSIENT_EXCEPTIONS as e:
+                policy.breaker.record(True)
+                if attempt + 1 >= max_attempts:
+                    raise
+                logging.warning('{0} {1}: {2!r}'.format(method, url, e))
+                r = None
+            else:
+                transient = classify(r) == 'transient'
+                policy.breaker.record(transient)
+                if not transient or attempt + 1 >= max_attempts:
+                    if transient and retry_after(r) is not None:
+                        policy.breaker.pause(retry_after(r))
+                    return r
+                logging.warning('{0} {1}: {2}'.format(method, url, r.status_code))
+
+            if self.metrics is not None:
+                self.metrics.inc('request_retries')
+            await asyncio.sleep(policy.delay(attempt, r))
+            attempt += 1
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def put(self, url, **kwargs):
+        return await self.request('PUT', url, **kwargs)
+
+    async def file_chunks(self, file_name, md5=None, chunk_size=FileBody.DEFAULT_CHUNK_SIZE):
+        """Chunks of a file, paced by the bandwidth limit.
+        Reads of one chunk hit the page cache and are not worth a thread."""
+        with open(file_name, 'rb') as fh:
+            while True:
+                chunk = fh.read(chunk_size)
+                if not chunk:
+                    return
+                if md5 is not None:
+                    md5.update(chunk)
+                if self.limiter is not None:
+                    wait = self.limiter.reserve(len(chunk))
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                yield chunk
+
+    async def put_file(self, url, file_name, digest=False, headers=None, **kwargs):
+        """PUT a file streamed chunk by chunk; returns the response and,
+        with digest=True, the MD5 of the file computed while sending it"""
+        digests = []
+
+        def body():
+            md5 = hashlib.md5() if digest else None
+            digests.append(md5)
+            return self.file_chunks(file_name, md5)
+
+        headers = dict(headers or {})
+        # a streamed body is sent chunked without it
+        headers['Content-Length'] = str(os.path.getsize(file_name))
+        r = await self.request('PUT', url, body=body, headers=headers, **kwargs)
+        md5 = digests[-1] if digests else None
+        return r, md5.hexdigest() if md5 is not None else None
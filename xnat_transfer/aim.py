@@ -0,0 +1,97 @@
+import concurrent.futures
+import logging
+import os
+import subprocess
+import threading
+
+try:
+    from lxml import etree
+except:
+    print('please type "pip install lxml" for installing lxml package')
+
+# compiled schemas of this process, by XSD path
+_schemas = {}
+
+
+def load_schema(xsd_path):
+    """Parse and compile an XSD once per process"""
+    key = os.path.abspath(xsd_path)
+    schema = _schemas.get(key)
+    if schema is None:
+        schema = _schemas[key] = etree.XMLSchema(etree.parse(key))
+    return schema
+
+
+def check_with_lxml(file_name, xsd_path):
+    xmlschema = load_schema(xsd_path)
+    try:
+        xml_content = etree.parse(file_name)
+    except etree.XMLSyntaxError as e:
+        logging.error('{0}: {1}'.format(file_name, e))
+        return False
+
+    if xmlschema.validate(xml_content):
+        return True
+    else:
+        return False
+
+
+def check_with_xmllint(file_name, xsd_path):
+    cmds = ' '.join(
+        ['xmllint', '--schema', xsd_path,  file_name, '--noout'])
+    try:
+        ret = subprocess.check_output(
+            cmds, shell=True, stderr=subprocess.STDOUT)
+        if ret.decode('utf-8').find('validates') > 0:
+            return True
+        else:
+            logging.error(ret)
+            return False
+    except subprocess.CalledProcessError:
+        return False
+
+
+def verify_xml(file_name, xsd_path, use_xmllint=False):
+    """Validate an AIM file against the schema; xmllint is an optional cross-check"""
+    if use_xmllint and not check_with_xmllint(file_name, xsd_path):
+        return False
+    return check_with_lxml(file_name, xsd_path)
+
+
+def _verify_batch(file_names, xsd_path, use_xmllint):
+    return [verify_xml(file_name, xsd_path, use_xmllint) for file_name in file_names]
+
+
+class BatchValidator(object):
+    """Validates AIM files in a process pool ahead of their uploads: submit()
+    starts the files of a scan, result() waits for the answer of one file.
+    Every worker compiles the schema once and reuses it for all its files.
+    """
+
+    def __init__(self, xsd_path, use_xmllint=False, processes=None):
+        self.xsd_path = xsd_path
+        self.use_xmllint = use_xmllint
+        self.executor = concurrent.futures.ProcessPoolExecutor(processes)
+        self.lock = threading.Lock()
+        # file_name -> (future of its batch, index in the batch)
+        self.pending = {}
+
+    def submit(self, file_names):
+        if not file_names:
+            return
+        future = self.executor.submit(_verify_batch, file_names, self.xsd_path, self.use_xmllint)
+        with self.lock:
+            for index, file_name in enumerate(file_names):
+                self.pending[file_name] = (future, index)
+
+    def result(self, file_name):
+        """True or False once validated, None if the file was not submitted"""
+        with self.lock:
+            entry = self.pending.pop(file_name, None)
+        if entry is None:
+            return None
+        future, index = entry
+        return future.result()[index]
+
+    def shutdown(self):
+        self.executor.shutdown()
@@ -0,0 +1,37 @@
+import os
+import tempfile
+import zipfile
+
+
+def batches(items, size):
+    """Split items into lists of at most size entries (size <= 0: one list)"""
+    if size <= 0:
+        yield list(items)
+        return
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def build_archive(file_names, compression=zipfile.ZIP_STORED, compresslevel=None, store=None, infos=None):
+    """Write file_names into a zip on a temporary file and return it rewound.
+
+    Files are copied into the archive chunk by chunk, so memory use does not
+    depend on the size of the series. The temporary file is removed when the
+    returned file object is closed.
+
+    Files for which store(file_name) is true are stored uncompressed. The
+    ZipInfo of every entry is appended to infos when given.
+    """
+    fh = tempfile.TemporaryFile(suffix='.zip')
+    try:
+        with zipfile.ZipFile(fh, 'w', compression, allowZip64=True, compresslevel=compresslevel) as zf:
+            for file_name in file_names:
+                compress_type = zipfile.ZIP_STORED if store is not None and store(file_name) else compression
+                zf.write(file_name, os.path.basename(file_name), compress_type=compress_type)
+            if infos is not None:
+                infos.extend(zf.infolist())
+        fh.seek(0)
+    except:
+        fh.close()
+        raise
+    return fh
@@ -0,0 +1,252 @@
+import logging
+import os
+import threading
+import time
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+except:
+    print('please type "pip install requests" for installing request package')
+
+requests.packages.urllib3.disable_warnings()
+
+from xnat_transfer.retry import RetryPolicy, TRANSIENT_EXCEPTIONS, TransientError, classify, request_attempts, retry_after
+from xnat_transfer.session import SessionManager
+from xnat_transfer.streams import FileBody, ThrottledBody
+
+
+class XnatClient:
+    """Keep-alive HTTP client shared by the XNAT import / export scripts.
+
+    All requests go through one requests.Session, so TCP and TLS
+    connections are reused from a connection pool, and the JSESSIONID
+    returned by /data/JSESSION is sent as a cookie instead of basic auth.
+    The session is kept by a SessionManager: it may come from the cache of
+    an earlier run, is obtained before the first request and replaced
+    before it expires, and a cached one is confirmed before a body is sent
+    with it. A 401 answer still triggers one re-authentication (shared by
+    all threads) and a resend.
+
+    Timeouts, dropped connections and transient answers (5xx, 429, ...)
+    are retried following retry_policy, whose circuit breaker is shared by
+    every thread using the client. Permanent errors are returned at once.
+    Within a task retried by RetryPolicy.call, a request is sent once and
+    the task's attempts are the only retries.
+
+    With a limiter (xnat_transfer.ratelimit.BandwidthLimiter), file bodies
+    and downloads read through iter_content() share its bandwidth.
+    """
+    DEFAULT_POOL_SIZE = 10
+    # (connect, read) seconds
+    DEFAULT_TIMEOUT = (30, 600)
+
+    def __init__(self, base_url, auth_info, pool_size=DEFAULT_POOL_SIZE, verify=False,
+                 retry_policy=None, timeout=DEFAULT_TIMEOUT, metrics=None, limiter=None, sessions=None):
+        self.base_url = base_url
+        self.metrics = metrics
+        self.limiter = limiter
+        self.auth_info = auth_info
+        self.sessions = sessions if sessions is not None else SessionManager('{0}@{1}'.format(auth_info[0], base_url))
+        self.authErr = 0
+        self.auth_lock = threading.Lock()
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy(max_attempts=4)
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self.session.verify = verify
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    @property
+    def session_id(self):
+        return self.sessions.session_id
+
+    def session_request(self):
+        """Ask the server for a new JSESSIONID with basic auth"""
+        if self.authErr >= 2:
+            raise EOFError('authentication failed {0} times'.format(self.authErr))
+
+        auth_info = self.auth_info
+        api_url = '/'.join([self.base_url, 'data', 'JSESSION'])
+        r = self.timed_request('GET', api_url, auth=(auth_info[0], auth_info[1]), timeout=self.timeout)
+        if r.status_code < 400:
+            self.set_session_id(r.text)
+            self.authErr = 0
+            return True
+        elif r.status_code == 401:
+            logging.error('please check the status of api {0}'.format(api_url))
+            logging.error(r.status_code)
+            logging.error(r.text)
+            print(r.text)
+            self.authErr = self.authErr + 1
+            raise EOFError
+        elif classify(r) == 'transient':
+            # the whole request is retried, authentication included
+            raise TransientError('{0}: {1}'.format(api_url, r.status_code))
+        else:
+            logging.error('please check the status of api {0}'.format(api_url))
+            logging.error(r.status_code)
+            logging.error(r.text)
+            print(r.text)
+            raise EOFError
+
+    def set_session_id(self, session_id):
+        self.sessions.set(session_id)
+
+    def check_session(self):
+        """Confirm a cached session: /data/JSESSION answers with the
+        session of the cookie when it is still valid"""
+        session_id = self.session_id
+        api_url = '/'.join([self.base_url, 'data', 'JSESSION'])
+        try:
+            r = self.timed_request('GET', api_url, timeout=self.timeout)
+        except TRANSIENT_EXCEPTIONS:
+            return False
+        if r.status_code < 400 and r.text.strip() == session_id:
+            self.sessions.touch(session_id)
+            return True
+        self.sessions.invalidate(session_id)
+        return False
+
+    def ensure_session(self, body=False):
+        """Authenticate before a request instead of after its 401: when
+        there is no session, when it is about to expire, or when a body
+        would be sent with a cached session not confirmed yet"""
+        if self.sessions.usable(body):
+            return
+        with self.auth_lock:
+            if self.sessions.usable(body):
+                return
+            if self.sessions.usable() and self.check_session():
+                return
+            if self.metrics is not None:
+                self.metrics.inc('authentications')
+            self.session_request()
+
+    def reauthenticate(self, stale_session_id):
+        """Re-authenticate once for all threads that got a 401 with the same session"""
+        with self.auth_lock:
+            if self.session_id is not None and self.session_id != stale_session_id:
+                return True
+            if self.metrics is not None:
+                self.metrics.inc('reauthentications')
+            return self.session_request()
+
+    def timed_request(self, method, url, **kwargs):
+        # An explicit Cookie header keeps cookies set by the server (possibly
+        # for another domain spelling) from being sent alongside it; it is
+        # read for every request, as the session may be replaced meanwhile.
+        session_id = self.session_id
+        if session_id is not None and 'auth' not in kwargs:
+            kwargs['headers'] = dict(kwargs.get('headers') or {}, Cookie='JSESSIONID={0}'.format(session_id))
+        if self.metrics is None:
+            return self.session.request(method, url, **kwargs)
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            r = self.session.request(method, url, **kwargs)
+            status = r.status_code
+            return r
+        finally:
+            self.metrics.observe_request(method, url, time.perf_counter() - start, status)
+
+    def send(self, method, url, **kwargs):
+        self.ensure_session(kwargs.get('data') is not None)
+        session_id = self.session_id
+        r = self.timed_request(method, url, **kwargs)
+        if r.status_code == 401:
+            self.sessions.invalidate(session_id)
+            if self.reauthenticate(session_id):
+                r.close()
+                self.rewind(kwargs.get('data'))
+                session_id = self.session_id
+                r = self.timed_request(method, url, **kwargs)
+        if r.status_code != 401:
+            self.sessions.touch(session_id)
+        return r
+
+    def rewind(self, data):
+        if hasattr(data, 'seek'):
+            data.seek(0)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        if self.limiter is not None and hasattr(kwargs.get('data'), 'read'):
+            kwargs['data'] = ThrottledBody(kwargs['data'], self.limiter)
+        policy = self.retry_policy
+        max_attempts = request_attempts(policy)
+        attempt = 0
+        while True:
+            policy.breaker.wait()
+            try:
+                r = self.send(method, url, **kwargs)
+            except TRANSIENT_EXCEPTIONS as e:
+                policy.breaker.record(True)
+                if attempt + 1 >= max_attempts:
+                    raise
+                logging.warning('{0} {1}: {2}'.format(method, url, e))
+                r = None
+            else:
+                transient = classify(r) == 'transient'
+                policy.breaker.record(transient)
+                if not transient or attempt + 1 >= max_attempts:
+                    if transient and retry_after(r) is not None:
+                        # the caller's next attempt waits for the breaker
+                        policy.breaker.pause(retry_after(r))
+                    return r
+                logging.warning('{0} {1}: {2}'.format(method, url, r.status_code))
+                # hands a streamed answer's connection back to the pool
+                r.close()
+
+            if self.metrics is not None:
+                self.metrics.inc('request_retries')
+            time.sleep(policy.delay(attempt, r))
+            self.rewind(kwargs.get('data'))
+            attempt += 1
+
+    def iter_content(self, r, chunk_size=FileBody.DEFAULT_CHUNK_SIZE):
+        """Body of a response requested with stream=True, paced by the limiter"""
+        for chunk in r.iter_content(chunk_size):
+            if self.limiter is not None:
+                self.limiter.consume(len(chunk))
+            yield chunk
+
+    def download(self, url, file_name, **kwargs):
+        """Stream the answer to url into file_name, one chunk in memory at a
+        time; returns (response, size). A connection lost in the middle of
+        the body fetches the file again. An error answer (status >= 400)
+        is not written: file_name is left untouched and size is None."""
+        max_attempts = request_attempts(self.retry_policy)
+        attempt = 0
+        while True:
+            r = self.get(url, stream=True, **kwargs)
+            try:
+                if r.status_code >= 400:
+                    return r, None
+                size = 0
+                with open(file_name, 'wb') as fh:
+                    for chunk in self.iter_content(r):
+                        fh.write(chunk)
+                        size += len(chunk)
+                return r, size
+            except TRANSIENT_EXCEPTIONS as e:
+                attempt += 1
+                if attempt >= max_attempts:
+                    # no truncated copy is left behind
+                    if os.path.exists(file_name):
+                        os.remove(file_name)
+                    raise
+                logging.warning('GET {0}: {1}'.format(url, e))
+                if self.metrics is not None:
+                    self.metrics.inc('request_retries')
+                time.sleep(self.retry_policy.delay(attempt))
+            finally:
+                r.close()
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
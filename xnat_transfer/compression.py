@@ -0,0 +1,197 @@
+"""
+    optional on-the-wire compression of uploads: gzip-encoded request
+    bodies (file mode) or deflated entries in the per-scan zip bundles
+    (archive mode), measured per modality and skipped for data that is
+    already compressed
+"""
+import concurrent.futures
+import logging
+import os
+import threading
+
+try:
+    from pydicom.filereader import read_file_meta_info
+except:
+    print('please type "pip install pydicom" for installing pydicom package')
+
+from xnat_transfer.streams import GzipBody
+
+COMPRESSION_MODES = ('none', 'gzip', 'zip')
+
+# containers and images that another deflate pass does not shrink
+COMPRESSED_EXTENSIONS = ('.gz', '.tgz', '.zip', '.bz2', '.xz', '.zst', '.7z',
+                         '.jpg', '.jpeg', '.jp2', '.j2k', '.png', '.gif', '.mp4', '.mpg')
+
+
+def modality(file_name, params):
+    """Key the compression ratio is measured under: the DICOM modality
+    for files of the DICOM resource, else the kind of file"""
+    name = file_name.lower()
+    if os.path.basename(os.path.dirname(file_name)) == 'DICOM':
+        return params.get('data_type') or 'dicom'
+    if name.endswith('.nii') or name.endswith('.nii.gz'):
+        return 'nifti'
+    extension = os.path.splitext(name)[1]
+    return extension[1:] if extension else 'other'
+
+
+def dicom_compressed(file_name):
+    """True for DICOM files with a compressed (JPEG, RLE, deflated, ...) transfer syntax"""
+    try:
+        transfer_syntax = read_file_meta_info(file_name).get('TransferSyntaxUID')
+    except Exception:
+        # no file meta (or no DICOM at all): raw data
+        return False
+    return transfer_syntax is not None and (transfer_syntax.is_compressed or transfer_syntax.is_deflated)
+
+
+def already_compressed(file_name):
+    name = file_name.lower()
+    if name.endswith(COMPRESSED_EXTENSIONS):
+        return True
+    if name.endswith('.dcm') or os.path.basename(os.path.dirname(file_name)) == 'DICOM':
+        return dicom_compressed(file_name)
+    return False
+
+
+class CompressionStats:
+    """Bytes before and after compression, per modality.
+
+    Once sample_files files of a modality were compressed, the modality is
+    turned off if they did not shrink below max_ratio of their size: the
+    CPU is better spent elsewhere.
+    """
+
+    def __init__(self, max_ratio=0.9, sample_files=20):
+        self.max_ratio = max_ratio
+        self.sample_files = sample_files
+        self.lock = threading.Lock()
+        self.modalities = {}
+
+    def entry(self, modality):
+        entry = self.modalities.get(modality)
+        if entry is None:
+            entry = self.modalities[modality] = {
+                'files': 0, 'raw_bytes': 0, 'wire_bytes': 0, 'skipped_files': 0, 'disabled': False}
+        return entry
+
+    def enabled(self, modality):
+        with self.lock:
+            entry = self.modalities.get(modality)
+            return entry is None or not entry['disabled']
+
+    def record(self, modality, raw_bytes, wire_bytes):
+        with self.lock:
+            entry = self.entry(modality)
+            entry['files'] += 1
+            entry['raw_bytes'] += raw_bytes
+            entry['wire_bytes'] += wire_bytes
+            if (not entry['disabled'] and entry['files'] >= self.sample_files
+                    and entry['wire_bytes'] > self.max_ratio * entry['raw_bytes']):
+                entry['disabled'] = True
+                logging.info('compression of {0} files only reaches {1:.2f}: turned off'.format(
+                    modality, entry['wire_bytes'] / entry['raw_bytes']))
+
+    def skip(self, modality):
+        with self.lock:
+            self.entry(modality)['skipped_files'] += 1
+
+    def to_dict(self):
+        with self.lock:
+            result = {}
+            for modality, entry in sorted(self.modalities.items()):
+                result[modality] = dict(entry)
+                if entry['raw_bytes']:
+                    result[modality]['ratio'] = round(entry['wire_bytes'] / entry['raw_bytes'], 4)
+            return result
+
+
+class Compressor:
+    """Compresses upload bodies on a few worker threads.
+
+    The number of workers bounds the CPU used for compression whatever the
+    number of upload workers is. In gzip mode, files queued for upload are
+    compressed ahead (compress_ahead, up to `ahead` bodies at once), so an
+    upload worker finds its body ready instead of compressing it between
+    two sends; zlib releases the GIL, so this runs next to the uploads.
+
+    gzip_accepted stays None until the first gzip upload showed whether
+    the server decodes Content-Encoding: gzip bodies.
+    """
+
+    def __init__(self, mode, level=6, workers=2, max_ratio=0.9, sample_files=20, ahead=8):
+        if mode not in COMPRESSION_MODES:
+            raise ValueError('unknown compression {0}, expected one of {1}'.format(mode, COMPRESSION_MODES))
+        self.mode = mode
+        self.level = level
+        self.stats = CompressionStats(max_ratio, sample_files)
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='compress') \
+            if workers > 0 else None
+        self.gzip_accepted = None
+        self.probe_lock = threading.Lock()
+        self.ahead_lock = threading.Lock()
+        self.ahead = {}
+        self.ahead_slots = threading.BoundedSemaphore(ahead) if ahead > 0 and self.executor is not None else None
+
+    def run(self, function, *args, **kwargs):
+        """Run function on a compression worker and wait for its result"""
+        if self.executor is None:
+            return function(*args, **kwargs)
+        return self.executor.submit(function, *args, **kwargs).result()
+
+    def should_compress(self, file_name, modality):
+        if self.mode == 'none' or not self.stats.enabled(modality):
+            return False
+        if already_compressed(file_name):
+            self.stats.skip(modality)
+            return False
+        return True
+
+    def compress_ahead(self, file_name, modality):
+        """Start compressing a file queued for upload, if a slot is free"""
+        if self.ahead_slots is None or self.mode != 'gzip' or not self.gzip_accepted:
+            return
+        if not self.stats.enabled(modality) or already_compressed(file_name):
+            return
+        if not self.ahead_slots.acquire(blocking=False):
+            return
+        future = self.executor.submit(GzipBody, file_name, self.level)
+        with self.ahead_lock:
+            previous = self.ahead.pop(file_name, None)
+            self.ahead[file_name] = future
+        if previous is not None:
+            self.close_ahead(previous)
+
+    def take_ahead(self, file_name):
+        with self.ahead_lock:
+            future = self.ahead.pop(file_name, None)
+        if future is not None:
+            self.ahead_slots.release()
+        return future
+
+    def close_ahead(self, future):
+        self.ahead_slots.release()
+        future.add_done_callback(lambda done: done.exception() is None and done.result().close())
+
+    def discard(self, file_name):
+        """Drop the body compressed ahead for a file not sent after all"""
+        with self.ahead_lock:
+            future = self.ahead.pop(file_name, None)
+        if future is not None:
+            self.close_ahead(future)
+
+    def gzip_body(self, file_name, modality):
+        future = self.take_ahead(file_name)
+        body = future.result() if future is not None else self.run(GzipBody, file_name, self.level)
+        self.stats.record(modality, body.raw_size, len(body))
+        return body
+
+    def record_archive(self, file_names, infos, params):
+        """Ratio of the deflated entries of a zip bundle"""
+        for file_name, info in zip(file_names, infos):
+            if info.compress_type != 0:
+                self.stats.record(modality(file_name, params), info.file_size, info.compress_size)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
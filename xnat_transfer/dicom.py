@@ -0,0 +1,87 @@
+import collections
+import concurrent.futures
+import os
+
+try:
+    import pydicom
+except:
+    print('please type "pip install pydicom" for installing pydicom package')
+
+# the only tags needed to route a series to project / subject / session / scan type
+ROUTING_TAGS = ['PatientName', 'StudyDate', 'Modality']
+
+
+def read_routing_header(file_name):
+    """Read the routing tags of a DICOM file without loading the pixel data"""
+    ds = pydicom.dcmread(file_name, stop_before_pixels=True, specific_tags=ROUTING_TAGS)
+    return {
+        'PatientName': str(ds.PatientName),
+        'StudyDate': ds.StudyDate,
+        'Modality': ds.Modality,
+    }
+
+
+def read_directory_header(file_names, verify_all=False):
+    """Routing header of a series directory, taken from its first file.
+    With verify_all every file is read and the ones whose routing tags
+    differ from the first file are returned as well.
+    Returns (header, mismatched_file_names).
+    """
+    header = read_routing_header(file_names[0])
+    mismatched = []
+    if verify_all:
+        for file_name in file_names[1:]:
+            if read_routing_header(file_name) != header:
+                mismatched.append(file_name)
+    return header, mismatched
+
+
+class HeaderReader:
+    """Reads the routing headers of series directories in a process pool,
+    a few directories ahead of the one being uploaded.
+    processes <= 0 reads them in the calling process instead.
+    """
+
+    def __init__(self, processes, verify_all=False):
+        self.processes = processes
+        self.verify_all = verify_all
+        self.executor = None
+        if processes > 0:
+            self.executor = concurrent.futures.ProcessPoolExecutor(processes)
+
+    def read(self, dir_infos):
+        """Yield (dir_info, (header, mismatched), error) in the order of
+        dir_infos. error is the exception raised reading a directory (e.g.
+        its first file is no DICOM file), whose result is then None.
+        """
+        if self.executor is None:
+            for dir_info in dir_infos:
+                try:
+                    result = read_directory_header(self.file_names(dir_info), self.verify_all)
+                except Exception as e:
+                    yield dir_info, None, e
+                else:
+                    yield dir_info, result, None
+            return
+
+        window = collections.deque()
+        for dir_info in dir_infos:
+            window.append((dir_info, self.executor.submit(
+                read_directory_header, self.file_names(dir_info), self.verify_all)))
+            if len(window) >= self.processes * 4:
+                yield self.result(*window.popleft())
+        while window:
+            yield self.result(*window.popleft())
+
+    def result(self, dir_info, future):
+        try:
+            return dir_info, future.result(), None
+        except Exception as e:
+            return dir_info, None, e
+
+    def file_names(self, dir_info):
+        return [os.path.join(dir_info[0], file_name) for file_name in dir_info[2]]
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
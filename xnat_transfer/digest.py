@@ -0,0 +1,109 @@
+"""
+    MD5 digests of local files, compared with the `digest` and `Size`
+    columns of the XNAT file listings
+"""
+import concurrent.futures
+import hashlib
+import os
+import threading
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_md5(file_name):
+    with open(file_name, 'rb') as fh:
+        if hasattr(hashlib, 'file_digest'):
+            # python 3.11+: reads into one reused buffer
+            return hashlib.file_digest(fh, 'md5').hexdigest()
+        md5 = hashlib.md5()
+        for chunk in iter(lambda: fh.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+        return md5.hexdigest()
+
+
+def same_content(row, file_name, md5):
+    """True when the listing row describes the local file.
+
+    The digest is compared when the server has one; XNAT leaves it empty
+    for files it did not checksum, and then only the size can be compared.
+    """
+    digest = (row.get('digest') or '').lower()
+    if digest and md5:
+        return digest == md5
+    size = row.get('Size')
+    return size in (None, '') or int(size) == os.path.getsize(file_name)
+
+
+class Hasher:
+    """Hashes files on worker threads ahead of the uploads needing them.
+
+    hashlib releases the GIL while hashing, so the threads run next to
+    the upload workers. prefetch() starts hashing a file; md5() returns
+    its digest, hashing it now if it was not prefetched.
+    """
+
+    def __init__(self, workers=2):
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='hash') \
+            if workers > 0 else None
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def prefetch(self, file_names):
+        if self.executor is None:
+            return
+        with self.lock:
+            for file_name in file_names:
+                if file_name not in self.pending:
+                    self.pending[file_name] = self.executor.submit(file_md5, file_name)
+
+    def md5(self, file_name):
+        with self.lock:
+            future = self.pending.pop(file_name, None)
+        if future is None:
+            return file_md5(file_name)
+        return future.result()
+
+    def future(self, file_name):
+        """concurrent.futures.Future of the digest, for asyncio callers"""
+        with self.lock:
+            future = self.pending.pop(file_name, None)
+        if future is not None:
+            return future
+        if self.executor is not None:
+            return self.executor.submit(file_md5, file_name)
+        future = concurrent.futures.Future()
+        future.set_result(file_md5(file_name))
+        return future
+
+    def discard(self, file_names):
+        with self.lock:
+            for file_name in file_names:
+                self.pending.pop(file_name, None)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+class ScanUploads:
+    """Counts the outstanding uploads of one scan; the thread finishing
+    the last one gets the digests of every uploaded file, to check them
+    against a single listing of the scan.
+    """
+
+    def __init__(self, count, on_complete):
+        self.remaining = count
+        self.on_complete = on_complete
+        self.lock = threading.Lock()
+        self.uploaded = {}
+
+    def uploaded_file(self, file_name, md5):
+        with self.lock:
+            self.uploaded[file_name] = md5
+
+    def done(self):
+        with self.lock:
+            self.remaining -= 1
+            last = self.remaining == 0
+        if last and self.uploaded:
+            self.on_complete(self.uploaded)
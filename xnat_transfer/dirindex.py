@@ -0,0 +1,147 @@
+"""
+    incremental walk of the data directories: the mtime, file count and
+    subdirectories of every directory are kept in a local index, and a
+    later run lists only the directories whose mtime changed since, so a
+    nightly import of a large (NFS) tree only reads the newly arrived series
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+# a directory modified this close to its listing may change again within
+# the same mtime tick (whole seconds on some file systems): it is listed
+# again by the next run
+SETTLE_SECONDS = 2.0
+
+
+class DirectoryIndex:
+    """Index of a walk: {directory: [mtime_ns, file count, subdirectories]}.
+
+    walk() yields the same directories in the same order as os.walk
+    (top-down, links to directories not followed), but only lists the
+    directories whose mtime differs from the index of the last run; the
+    others are yielded without files and their subdirectories are taken
+    from the index, at the cost of one stat. Adding, removing or renaming
+    an entry changes the mtime of its directory; files rewritten in place
+    do not, a full scan (full=True) finds them.
+
+    A directory whose files were handed to the import (hold) is only
+    written to the index once each of them was handled (release), so the
+    files of a failed or interrupted import are listed again next time.
+    """
+    VERSION = 1
+
+    def __init__(self, path, full=False):
+        self.path = path
+        self.previous = {} if full else self.load()
+        self.entries = {}
+        self.held = {}
+        self.lock = threading.Lock()
+        self.stats = {
+            'directories_listed': 0,
+            'directories_unchanged': 0,
+            'files_listed': 0,
+            'files_unchanged': 0,
+        }
+
+    def load(self):
+        try:
+            with open(self.path) as fh:
+                index = json.load(fh)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.warning('cannot read the directory index {0}, scanning the whole tree: {1}'.format(self.path, e))
+            return {}
+        if index.get('version') != self.VERSION:
+            return {}
+        return index['directories']
+
+    def list_dir(self, dir_path):
+        """(subdirectories, files) of dir_path, None if it cannot be read"""
+        dir_names = []
+        file_names = []
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if not is_dir:
+                        file_names.append(entry.name)
+                    elif not entry.is_symlink():
+                        dir_names.append(entry.name)
+        except OSError:
+            return None
+        return dir_names, file_names
+
+    def walk(self, top):
+        """Like os.walk(top); the files of an unchanged directory are not listed"""
+        stack = [top]
+        while stack:
+            dir_path = stack.pop()
+            try:
+                mtime_ns = os.stat(dir_path).st_mtime_ns
+            except OSError:
+                continue
+            entry = self.previous.get(dir_path)
+            # a second walk of the run (e.g. for XML validation) is not counted again
+            counted = dir_path in self.entries
+            if entry is not None and entry[0] == mtime_ns:
+                file_names = []
+                if not counted:
+                    self.stats['directories_unchanged'] += 1
+                    self.stats['files_unchanged'] += entry[1]
+            else:
+                listing = self.list_dir(dir_path)
+                if listing is None:
+                    continue
+                dir_names, file_names = listing
+                if time.time() - mtime_ns / 1e9 < SETTLE_SECONDS:
+                    mtime_ns = None
+                entry = [mtime_ns, len(file_names), dir_names]
+                if not counted:
+                    self.stats['directories_listed'] += 1
+                    self.stats['files_listed'] += len(file_names)
+            with self.lock:
+                self.entries[dir_path] = entry
+            dir_names = list(entry[2])
+            yield dir_path, dir_names, file_names
+            stack.extend(os.path.join(dir_path, name) for name in reversed(dir_names))
+
+    def hold(self, dir_path, file_names):
+        """Keep dir_path out of the index until each of file_names is released"""
+        if file_names:
+            with self.lock:
+                self.held.setdefault(dir_path, set()).update(file_names)
+
+    def release(self, file_name):
+        """file_name was uploaded, found on the server or left to another importer"""
+        dir_path, name = os.path.split(file_name)
+        with self.lock:
+            names = self.held.get(dir_path)
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del self.held[dir_path]
+
+    def save(self):
+        """Write the index of this run's walk, without the directories still held"""
+        with self.lock:
+            directories = dict((dir_path, entry) for dir_path, entry in self.entries.items()
+                               if dir_path not in self.held)
+            held = len(self.held)
+        tmp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as fh:
+            json.dump({'version': self.VERSION, 'directories': directories}, fh)
+        os.replace(tmp_path, self.path)
+        logging.info('directory index {0}: {1} directories, {2} with files left to import'.format(
+            self.path, len(directories), held))
+
+    def to_dict(self):
+        stats = dict(self.stats)
+        stats['directories_held'] = len(self.held)
+        return stats
@@ -0,0 +1,132 @@
+"""
+    what the importer knows exists on the server, and the session
+    documents creating a session with all its scans in one request
+"""
+import collections
+import threading
+import xml.etree.ElementTree as ET
+
+XNAT_NS = 'http://nrg.wustl.edu/xnat'
+XSI_NS = 'http://www.w3.org/2001/XMLSchema-instance'
+# root element of the session document by data_type of the params
+SESSION_ELEMENTS = {
+    'ct': 'CTSession',
+    'mr': 'MRSession',
+    'cr': 'CRSession',
+    'otherDicom': 'OtherDicomSession',
+}
+
+
+class HierarchyCache:
+    """In-process record of the projects, subjects, sessions, scans and
+    resources known to exist on the server.
+
+    Entries are keyed by the path tuple of the params built by
+    XnatImporter, e.g. ('scan', project_id, subject_id, session_id, scan_id),
+    so every entity is checked or created at most once per run.
+    """
+    LEVELS = {
+        'project': ('project_id',),
+        'subject': ('project_id', 'subject_id'),
+        'session': ('project_id', 'subject_id', 'session_id'),
+        'scan': ('project_id', 'subject_id', 'session_id', 'scan_id'),
+        'resource': ('project_id', 'subject_id', 'session_id', 'scan_id', 'session_data_type'),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.known = set()
+        self.warmed_projects = set()
+
+    def key(self, level, params):
+        return (level,) + tuple(params[name] for name in self.LEVELS[level])
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.known
+
+    def add(self, key):
+        with self.lock:
+            self.known.add(key)
+
+    def warm(self, project_id, subject_labels, session_labels):
+        """Record what one listing of a project returned.
+        session_labels are (subject_label, session_label) pairs.
+        """
+        with self.lock:
+            self.known.add(('project', project_id))
+            for subject_label in subject_labels:
+                self.known.add(('subject', project_id, subject_label))
+            for subject_label, session_label in session_labels:
+                self.known.add(('session', project_id, subject_label, session_label))
+
+    def needs_warming(self, project_id):
+        with self.lock:
+            if project_id in self.warmed_projects:
+                return False
+            self.warmed_projects.add(project_id)
+            return True
+
+
+def session_batches(params_list, max_batch=200):
+    """Lists of the params met one after the other with the same session"""
+    fields = HierarchyCache.LEVELS['session']
+    batch = []
+    for params in params_list:
+        if batch and (len(batch) >= max_batch or
+                      any(params[name] != batch[0][name] for name in fields)):
+            yield batch
+            batch = []
+        batch.append(params)
+    if batch:
+        yield batch
+
+
+def scan_resources(params):
+    """(label, format, content) of the resources of a directory, as
+    XnatImporter.resource_create_urls creates them one by one"""
+    if params['session_data_type'] == 'DICOM':
+        return [('DICOM', 'DICOM', params['scan_data_type'] + '_RAW')]
+    if params['session_data_type'] == 'RAW':
+        return [('DICOM', None, None), ('METADATA', None, None)]
+    return []
+
+
+def session_xml(scans, date=None):
+    """xnat:*SessionData document of one session with the scans and scan
+    resources of the directories in scans (the params of XnatImporter,
+    all of the same session; directories of one scan are merged). PUT
+    with allowDataDeletion=false it adds them to an existing session;
+    without date the date of the session is left as it is.
+    """
+    ET.register_namespace('xnat', XNAT_NS)
+    ET.register_namespace('xsi', XSI_NS)
+    first = scans[0]
+    element = SESSION_ELEMENTS.get(first['data_type'], first['data_type'].upper() + 'Session')
+    session = ET.Element('{%s}%s' % (XNAT_NS, element), project=first['project_id'], label=first['session_id'])
+    if date is not None:
+        ET.SubElement(session, '{%s}date' % XNAT_NS).text = date
+    ET.SubElement(session, '{%s}subject_ID' % XNAT_NS).text = first['subject_id']
+
+    by_scan = collections.OrderedDict()
+    for params in scans:
+        by_scan.setdefault(params['scan_id'], []).append(params)
+    scans_element = ET.SubElement(session, '{%s}scans' % XNAT_NS)
+    for scan_id, directories in by_scan.items():
+        params = directories[0]
+        scan = ET.SubElement(scans_element, '{%s}scan' % XNAT_NS, ID=scan_id, type=params['scan_data_type'])
+        scan.set('{%s}type' % XSI_NS, 'xnat:' + params['xnat_data_type'])
+        ET.SubElement(scan, '{%s}quality' % XNAT_NS).text = 'usable'
+        labels = set()
+        for directory in directories:
+            for label, file_format, content in scan_resources(directory):
+                if label in labels:
+                    continue
+                labels.add(label)
+                resource = ET.SubElement(scan, '{%s}file' % XNAT_NS, label=label)
+                resource.set('{%s}type' % XSI_NS, 'xnat:resourceCatalog')
+                if file_format:
+                    resource.set('format', file_format)
+                if content:
+                    resource.set('content', content)
+    return ET.tostring(session, encoding='utf-8', xml_declaration=True)
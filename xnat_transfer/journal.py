@@ -0,0 +1,75 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+class UploadJournal:
+    """On-disk record of every file handled by the importer.
+
+    Each file is stored with its size, mtime and (when known) MD5 as soon
+    as its upload completes. A resumed run skips files recorded as uploaded
+    or existing whose size and mtime did not change, without asking the
+    server; pending and failed files are handled again.
+    """
+    DONE = ('success', 'exist')
+    QUERY_BATCH = 500
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # one file per process: each shard of a sharded run opens its own
+        # (upload-journal.shard<i>of<N>.db), SQLite does not lock over NFS
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        # WAL without a sync on every commit: a crash of the importer
+        # loses nothing, only a power loss may drop the last records
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            ' path TEXT PRIMARY KEY,'
+            ' size INTEGER,'
+            ' mtime_ns INTEGER,'
+            ' md5 TEXT,'
+            ' status TEXT,'
+            ' updated REAL)')
+        self.db.commit()
+
+    def record(self, file_name, status, md5=None):
+        try:
+            st = os.stat(file_name)
+        except OSError:
+            return
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO files (path, size, mtime_ns, md5, status, updated)'
+                ' VALUES (?, ?, ?, ?, ?, ?)',
+                (file_name, st.st_size, st.st_mtime_ns, md5, status, time.time()))
+            self.db.commit()
+
+    def done_files(self, file_names):
+        """Subset of file_names already uploaded and unchanged since"""
+        recorded = {}
+        with self.lock:
+            for start in range(0, len(file_names), self.QUERY_BATCH):
+                batch = file_names[start:start + self.QUERY_BATCH]
+                rows = self.db.execute(
+                    'SELECT path, size, mtime_ns FROM files WHERE status IN (?, ?) AND path IN ({0})'.format(
+                        ','.join('?' * len(batch))),
+                    self.DONE + tuple(batch))
+                for path, size, mtime_ns in rows:
+                    recorded[path] = (size, mtime_ns)
+
+        done = set()
+        for file_name, (size, mtime_ns) in recorded.items():
+            try:
+                st = os.stat(file_name)
+            except OSError:
+                continue
+            if st.st_size == size and st.st_mtime_ns == mtime_ns:
+                done.add(file_name)
+        return done
+
+    def close(self):
+        with self.lock:
+            self.db.close()
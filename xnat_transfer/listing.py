@@ -0,0 +1,72 @@
+import collections
+import threading
+
+
+class FileListing:
+    """Files of one scan as returned by a single .../files listing call"""
+
+    def __init__(self, exists, rows=()):
+        self.exists = exists
+        self.files = dict(((row.get('collection'), row['Name']), row) for row in rows)
+
+    def get(self, collection, name):
+        """Listing row (Name, Size, digest, ...) of a stored file, or None"""
+        return self.files.get((collection, name))
+
+    def names(self, collection):
+        return set(name for (row_collection, name) in self.files if row_collection == collection)
+
+    def rows(self, collection):
+        """Listing rows of one collection (resource), by file name"""
+        return dict((name, row) for (row_collection, name), row in self.files.items() if row_collection == collection)
+
+
+class ListingCache:
+    """Fetches each file listing once and shares it between threads.
+
+    Concurrent callers asking for the same URL wait for a single request.
+    At most max_entries listings are kept; an evicted listing is simply
+    fetched again when it is needed later.
+    """
+    DEFAULT_MAX_ENTRIES = 256
+
+    def __init__(self, fetch, max_entries=DEFAULT_MAX_ENTRIES):
+        self.fetch = fetch
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def get(self, url):
+        with self.lock:
+            entry = self.entries.get(url)
+            owner = entry is None
+            if owner:
+                entry = self.entries[url] = [threading.Event(), None]
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+            else:
+                self.entries.move_to_end(url)
+
+        if not owner:
+            entry[0].wait()
+            return entry[1]
+
+        try:
+            entry[1] = self.fetch(url)
+        finally:
+            if entry[1] is None:
+                # failed: let the next caller try again
+                with self.lock:
+                    if self.entries.get(url) is entry:
+                        del self.entries[url]
+            entry[0].set()
+        return entry[1]
+
+    def put(self, url, listing):
+        with self.lock:
+            event = threading.Event()
+            event.set()
+            self.entries[url] = [event, listing]
+            self.entries.move_to_end(url)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
@@ -0,0 +1,239 @@
+"""
+    transfer metrics: per-stage timing, request latency histograms per
+    endpoint type, counters, a live progress line, and a final summary
+    written as JSON and optionally as a Prometheus textfile
+"""
+import collections
+import contextlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+from xnat_transfer.stats import TransferStats
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+_FILE = re.compile(r'/files/[^/]+$')
+
+
+def endpoint_type(method, url):
+    """Group a request URL into the kind of XNAT call it is"""
+    path = url.split('?', 1)[0].rstrip('/')
+    if path.endswith('/JSESSION'):
+        return 'auth'
+    if _FILE.search(path):
+        return 'file_upload' if method == 'PUT' else 'file_download'
+    if path.endswith('/files'):
+        return 'file_listing'
+    parts = path.split('/')
+    for name, kind in (('resources', 'resource'), ('reconstructions', 'resource'), ('scans', 'scan'),
+                       ('experiments', 'session'), ('subjects', 'subject'), ('projects', 'project')):
+        if name in parts:
+            index = parts.index(name)
+            listing = index == len(parts) - 1
+            return kind + ('_listing' if listing else '')
+    return 'other'
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                return
+        self.counts[-1] += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile"""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum_seconds': round(self.sum, 6),
+            'mean_seconds': round(self.sum / self.count, 6) if self.count else None,
+            'p50_seconds': self.quantile(0.5),
+            'p95_seconds': self.quantile(0.95),
+            'p99_seconds': self.quantile(0.99),
+            'buckets': dict(zip([str(bound) for bound in self.buckets] + ['+Inf'], self.counts)),
+        }
+
+
+class Metrics:
+    """Thread-safe metrics of one import / export run"""
+
+    def __init__(self, tool):
+        self.tool = tool
+        self.lock = threading.Lock()
+        self.transfers = TransferStats()
+        self.stages = collections.OrderedDict()
+        self.latency = {}
+        self.status = collections.Counter()
+        self.counters = collections.Counter()
+        self.sections = collections.OrderedDict()
+
+    def register(self, name, function):
+        """Add the dict returned by function to the summary, under name"""
+        self.sections[name] = function
+
+    def add_stage_time(self, name, seconds, count=1):
+        with self.lock:
+            stage = self.stages.setdefault(name, [0.0, 0])
+            stage[0] += seconds
+            stage[1] += count
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time a block of work as part of a stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage_time(name, time.perf_counter() - start)
+
+    def timed_iter(self, name, iterable):
+        """Yield from iterable, timing each step as part of a stage"""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_stage_time(name, time.perf_counter() - start, 0)
+                return
+            self.add_stage_time(name, time.perf_counter() - start)
+            yield item
+
+    def observe_request(self, method, url, seconds, status):
+        kind = endpoint_type(method, url)
+        with self.lock:
+            histogram = self.latency.get(kind)
+            if histogram is None:
+                histogram = self.latency[kind] = Histogram()
+            histogram.observe(seconds)
+            self.status[str(status)] += 1
+            self.counters['requests'] += 1
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def add_transfer(self, nbytes):
+        return self.transfers.add(nbytes)
+
+    def progress(self):
+        stats = self.transfers
+        with stats.lock:
+            files, nbytes = stats.files, stats.bytes
+        elapsed = stats.elapsed()
+        with self.lock:
+            requests, retries = self.counters['requests'], self.counters['request_retries'] + self.counters['task_retries']
+        return '[{0}] {1} files, {2:.1f} MB, {3:.1f} files/s, {4:.2f} MB/s, {5} requests, {6} retries, {7:.0f}s'.format(
+            self.tool, files, nbytes / 1e6, files / elapsed, nbytes / 1e6 / elapsed, requests, retries, elapsed)
+
+    def summary(self):
+        stats = self.transfers
+        elapsed = stats.elapsed()
+        sections = [(name, function()) for name, function in self.sections.items()]
+        with self.lock:
+            summary = {
+                'tool': self.tool,
+                'elapsed_seconds': round(elapsed, 3),
+                'files': stats.files,
+                'bytes': stats.bytes,
+                'files_per_second': round(stats.files / elapsed, 3),
+                'bytes_per_second': round(stats.bytes / elapsed, 1),
+                'counters': dict(self.counters),
+                'status_codes': dict(self.status),
+                'stages': collections.OrderedDict(
+                    (name, {'seconds': round(seconds, 6), 'count': count})
+                    for name, (seconds, count) in self.stages.items()),
+                'latency': dict((kind, histogram.to_dict()) for kind, histogram in sorted(self.latency.items())),
+            }
+        summary.update(sections)
+        return summary
+
+    def write_json(self, path):
+        with open(path, 'w') as fh:
+            json.dump(self.summary(), fh, indent=1)
+
+    def write_prometheus(self, path):
+        """Write the summary in the Prometheus textfile-collector format"""
+        summary = self.summary()
+        prefix = 'xnat_{0}'.format(self.tool)
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP {0}_{1} {2}'.format(prefix, name, help_text))
+            lines.append('# TYPE {0}_{1} {2}'.format(prefix, name, kind))
+            for labels, value in samples:
+                lines.append('{0}_{1}{2} {3}'.format(prefix, name, labels, value))
+
+        metric('elapsed_seconds', 'gauge', 'Duration of the run.', [('', summary['elapsed_seconds'])])
+        metric('files_total', 'counter', 'Files transferred.', [('', summary['files'])])
+        metric('bytes_total', 'counter', 'Bytes transferred.', [('', summary['bytes'])])
+        metric('events_total', 'counter', 'Requests, retries and re-authentications.',
+               [('{{event="{0}"}}'.format(name), value) for name, value in sorted(summary['counters'].items())])
+        metric('stage_seconds_total', 'counter', 'Time spent in each stage.',
+               [('{{stage="{0}"}}'.format(name), stage['seconds']) for name, stage in summary['stages'].items()])
+        lines.append('# HELP {0}_request_seconds Request latency per endpoint type.'.format(prefix))
+        lines.append('# TYPE {0}_request_seconds histogram'.format(prefix))
+        with self.lock:
+            histograms = sorted(self.latency.items())
+        for kind, histogram in histograms:
+            cumulative = 0
+            for bound, count in zip([str(bound) for bound in histogram.buckets] + ['+Inf'], histogram.counts):
+                cumulative += count
+                lines.append('{0}_request_seconds_bucket{{endpoint="{1}",le="{2}"}} {3}'.format(prefix, kind, bound, cumulative))
+            lines.append('{0}_request_seconds_sum{{endpoint="{1}"}} {2}'.format(prefix, kind, round(histogram.sum, 6)))
+            lines.append('{0}_request_seconds_count{{endpoint="{1}"}} {2}'.format(prefix, kind, histogram.count))
+        # the textfile collector may read at any time: replace the file atomically
+        with open(path + '.tmp', 'w') as fh:
+            fh.write('\n'.join(lines) + '\n')
+        os.replace(path + '.tmp', path)
+
+
+class ProgressLine:
+    """Rewrites one status line on stderr every interval seconds"""
+
+    def __init__(self, metrics, interval=1.0, stream=sys.stderr):
+        self.metrics = metrics
+        self.interval = interval
+        self.stream = stream
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='progress', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.stream.write('\r' + self.metrics.progress() + '\033[K')
+            self.stream.flush()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.stream.write('\r' + self.metrics.progress() + '\033[K\n')
+        self.stream.flush()
@@ -0,0 +1,94 @@
+import logging
+import queue
+import threading
+
+_END = object()
+
+
+class Pipeline:
+    """Runs a source and a chain of stages concurrently, one thread each,
+    connected by bounded queues.
+
+    Every stage is a function taking an iterable of items from the stage
+    before and returning an iterable for the next one (usually a generator),
+    so a stage may drop, split or reorder items. The last stage's output is
+    discarded. A full queue blocks the stage feeding it, so a fast stage
+    never runs more than queue_size items ahead of a slow one and memory
+    stays bounded whatever the size of the source.
+
+    queue_sizes, when given, sets the size of the queue in front of each
+    stage instead.
+
+    An exception in any stage stops the whole pipeline and is raised again
+    by run().
+    """
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, queue_size=8):
+        self.queue_size = queue_size
+        self.stop = threading.Event()
+        self.error = None
+
+    def run(self, source, *stages, queue_sizes=None):
+        queues = [queue.Queue(size) for size in queue_sizes or [self.queue_size] * len(stages)]
+        threads = [threading.Thread(target=self._feed, args=(source, queues[0]),
+                                    name='pipeline-source', daemon=True)]
+        for index, stage in enumerate(stages):
+            out_queue = queues[index + 1] if index + 1 < len(stages) else None
+            threads.append(threading.Thread(
+                target=self._run_stage, args=(stage, queues[index], out_queue),
+                name='pipeline-{0}'.format(getattr(stage, '__name__', index)), daemon=True))
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _put(self, out_queue, item):
+        while not self.stop.is_set():
+            try:
+                out_queue.put(item, timeout=self.POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _items(self, in_queue):
+        while not self.stop.is_set():
+            try:
+                item = in_queue.get(timeout=self.POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if item is _END:
+                return
+            yield item
+
+    def _fail(self, e):
+        if self.error is None:
+            self.error = e
+        logging.error('pipeline stopped: {0!r}'.format(e))
+        self.stop.set()
+
+    def _feed(self, source, out_queue):
+        try:
+            for item in source:
+                if not self._put(out_queue, item):
+                    return
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._put(out_queue, _END)
+
+    def _run_stage(self, stage, in_queue, out_queue):
+        try:
+            results = stage(self._items(in_queue))
+            for item in results if results is not None else ():
+                if out_queue is not None and not self._put(out_queue, item):
+                    return
+        except Exception as e:
+            self._fail(e)
+        finally:
+            if out_queue is not None:
+                self._put(out_queue, _END)
@@ -0,0 +1,147 @@
+"""
+    dry-run import plans and the throughput history used to estimate them
+
+    A plan is a JSON document listing every scan the importer would create
+    (its params, files and bytes), the totals, an upper bound of the number
+    of requests and a duration estimate. It can be executed later without
+    walking the tree again.
+"""
+import datetime
+import json
+import os
+
+PLAN_VERSION = 1
+# runs of the history used for the estimate
+HISTORY_RUNS = 10
+
+
+def load_history(path):
+    if not path or not os.path.exists(path):
+        return []
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def append_history(path, files, nbytes, elapsed):
+    """Remember the throughput of a finished run"""
+    if not path or files == 0:
+        return
+    history = load_history(path)
+    history.append({
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'files': files,
+        'bytes': nbytes,
+        'seconds': round(elapsed, 3),
+    })
+    # written aside and renamed: the shards of a run finish at the same time
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as fh:
+        json.dump(history[-100:], fh, indent=1)
+    os.replace(tmp_path, path)
+
+
+def measured_throughput(history):
+    """files/s and bytes/s over the last runs, None without history"""
+    runs = history[-HISTORY_RUNS:]
+    seconds = sum(run['seconds'] for run in runs)
+    if not runs or seconds <= 0:
+        return None
+    return {
+        'runs': len(runs),
+        'files_per_second': sum(run['files'] for run in runs) / seconds,
+        'bytes_per_second': sum(run['bytes'] for run in runs) / seconds,
+    }
+
+
+def count_requests(scans, upload_mode, archive_batch_size, warm_cache, digest_check=False, session_xml=False):
+    """Upper bound of the requests the importer sends for the scans"""
+    projects = set()
+    subjects = set()
+    sessions = set()
+    scan_keys = set()
+    resources = set()
+    reconstructions = 0
+    files = 0
+    archives = 0
+    for scan in scans:
+        projects.add(scan['project_id'])
+        subjects.add((scan['project_id'], scan['subject_id']))
+        sessions.add((scan['project_id'], scan['subject_id'], scan['session_id']))
+        scan_keys.add((scan['project_id'], scan['subject_id'], scan['session_id'], scan['scan_id']))
+        resources.add((scan['project_id'], scan['subject_id'], scan['session_id'], scan['scan_id'],
+                       scan['session_data_type']))
+        if scan['session_data_type'] == 'RECON':
+            reconstructions += 1
+        files += len(scan['file_names'])
+        if archive_batch_size > 0:
+            archives += (len(scan['file_names']) + archive_batch_size - 1) // archive_batch_size
+        else:
+            archives += 1
+
+    requests = {
+        # one JSESSION before the first request, or the check of a cached session
+        'authentication': 1,
+        'warm_cache': 2 * len(projects) if warm_cache else 0,
+        'project': len(projects),
+        # GET + PUT
+        'subject': 2 * len(subjects),
+        'session': 2 * len(sessions),
+        # file listing + PUT
+        'scan': 2 * len(scan_keys),
+        # DICOM + METADATA resources
+        'resource': 2 * len(resources),
+    }
+    if session_xml:
+        # the session document creates the scans and their resources: the
+        # file listings of the scans and reconstruction resources remain
+        requests['scan'] = len(scan_keys)
+        requests['resource'] = reconstructions
+    if upload_mode == 'archive':
+        # PUT of the zip + listing to check it
+        requests['upload'] = 2 * archives
+    else:
+        requests['upload'] = files
+        if digest_check:
+            # one listing per directory to check the digests once uploaded
+            requests['verify'] = len(scans)
+    requests['total'] = sum(requests.values())
+    return requests
+
+
+def build_plan(scans, upload_mode, archive_batch_size, warm_cache, history, digest_check=False, session_xml=False):
+    totals = {
+        'projects': len(set(scan['project_id'] for scan in scans)),
+        'subjects': len(set((scan['project_id'], scan['subject_id']) for scan in scans)),
+        'sessions': len(set((scan['project_id'], scan['subject_id'], scan['session_id']) for scan in scans)),
+        'scans': len(scans),
+        'files': sum(len(scan['file_names']) for scan in scans),
+        'bytes': sum(scan['bytes'] for scan in scans),
+    }
+    throughput = measured_throughput(history)
+    estimate = None
+    if throughput is not None:
+        estimate = max(totals['files'] / max(throughput['files_per_second'], 1e-9),
+                       totals['bytes'] / max(throughput['bytes_per_second'], 1e-9))
+    return {
+        'version': PLAN_VERSION,
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'upload_mode': upload_mode,
+        'totals': totals,
+        'requests': count_requests(scans, upload_mode, archive_batch_size, warm_cache, digest_check, session_xml),
+        'throughput': throughput,
+        'estimated_seconds': None if estimate is None else round(estimate, 1),
+        'scans': scans,
+    }
+
+
+def save_plan(plan, path):
+    with open(path, 'w') as fh:
+        json.dump(plan, fh, indent=1)
+
+
+def load_plan(path):
+    with open(path) as fh:
+        plan = json.load(fh)
+    if plan.get('version') != PLAN_VERSION:
+        raise ValueError('unsupported plan version {0} in {1}'.format(plan.get('version'), path))
+    return plan
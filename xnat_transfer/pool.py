@@ -0,0 +1,52 @@
+import queue
+import threading
+import traceback
+import logging
+
+
+class TransferPool:
+    """Bounded pool of worker threads running transfer tasks.
+
+    submit() blocks once `queue_size` tasks are waiting, so the directory
+    walk never runs far ahead of the transfers and memory stays bounded.
+    """
+
+    def __init__(self, workers, queue_size=None, name='transfer'):
+        self.workers = max(1, int(workers))
+        self.name = name
+        self.queue = queue.Queue(queue_size or self.workers * 4)
+        self.threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._run, name='{0}-{1}'.format(name, i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        logging.info('{0} pool started with {1} workers'.format(name, self.workers))
+
+    def submit(self, function, *args, **kwargs):
+        self.queue.put((function, args, kwargs))
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                function, args, kwargs = task
+                try:
+                    function(*args, **kwargs)
+                except Exception:
+                    traceback.print_exc()
+            finally:
+                self.queue.task_done()
+
+    def join(self):
+        """Wait until every submitted task is done"""
+        self.queue.join()
+
+    def shutdown(self):
+        self.queue.join()
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
@@ -0,0 +1,190 @@
+"""
+    bandwidth limit shared by every transfer of a run: a token bucket
+    whose rate follows a time-of-day schedule from config.ini
+
+    [bandwidth]
+    limit=0
+    schedule=mon-fri 08:00-18:00 2M, mon-fri 18:00-20:00 10M
+"""
+import configparser
+import datetime
+import logging
+import os
+import re
+import threading
+import time
+
+DAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+UNITS = {'': 1, 'k': 1e3, 'm': 1e6, 'g': 1e9}
+# a chunk of FileBody: the largest burst allowed after an idle period
+DEFAULT_BURST = 64 * 1024
+
+_RATE = re.compile(r'^\s*([0-9.]+)\s*([kmg]?)(?:i?b)?(?:/s)?\s*$', re.IGNORECASE)
+_ENTRY = re.compile(r'^\s*(?:([a-z]{3})(?:-([a-z]{3}))?\s+)?(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s+(\S+)\s*$',
+                    re.IGNORECASE)
+
+
+def parse_rate(text):
+    """Bytes/s of '2M', '500k', '1.5MB/s', ...; 0 (or 'unlimited') for no limit"""
+    if text is None or text.strip().lower() in ('', 'unlimited', 'none', 'off'):
+        return 0.0
+    match = _RATE.match(text)
+    if match is None:
+        raise ValueError('bad bandwidth {0!r}, expected e.g. 500k, 2M or 1.5MB/s'.format(text))
+    return float(match.group(1)) * UNITS[match.group(2).lower()]
+
+
+def parse_schedule(text):
+    """Entries '[day[-day]] HH:MM-HH:MM rate' separated by commas or new lines"""
+    entries = []
+    for part in re.split(r'[,\n;]', text or ''):
+        if not part.strip():
+            continue
+        match = _ENTRY.match(part)
+        if match is None:
+            raise ValueError('bad bandwidth schedule entry {0!r}, expected e.g. "mon-fri 08:00-18:00 2M"'.format(part))
+        first, last, start_h, start_m, end_h, end_m, rate = match.groups()
+        if first is None:
+            days = set(range(7))
+        else:
+            start_day = DAYS.index(first.lower())
+            end_day = DAYS.index((last or first).lower())
+            days = set((start_day + offset) % 7 for offset in range((end_day - start_day) % 7 + 1))
+        entries.append((days, int(start_h) * 60 + int(start_m), int(end_h) * 60 + int(end_m), parse_rate(rate)))
+    return entries
+
+
+def scheduled_rate(entries, default, when):
+    """Rate of the first entry covering `when`, else default"""
+    minute = when.hour * 60 + when.minute
+    weekday = when.weekday()
+    for days, start, end, rate in entries:
+        if start <= end:
+            if weekday in days and start <= minute < end:
+                return rate
+        # across midnight: the part after midnight belongs to the day before
+        elif (weekday in days and minute >= start) or ((weekday - 1) % 7 in days and minute < end):
+            return rate
+    return default
+
+
+class TokenBucket:
+    """Paces bytes at `rate` bytes/s for every thread sharing it.
+
+    consume() books the bytes on the bucket and sleeps until they are
+    covered; the balance may go negative, so callers are served one after
+    the other at exactly the rate, without bursts above it (beyond `burst`
+    bytes saved up while idle) and without idle gaps between them.
+    """
+
+    def __init__(self, rate=0.0, burst=DEFAULT_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.waited = 0.0
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.refill()
+            self.rate = rate
+
+    def refill(self):
+        now = time.monotonic()
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        else:
+            self.tokens = self.burst
+        self.updated = now
+
+    def reserve(self, nbytes):
+        """Book nbytes; returns the seconds to wait before sending them"""
+        with self.lock:
+            if self.rate <= 0:
+                return 0.0
+            self.refill()
+            self.tokens -= nbytes
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.waited += wait
+        return wait
+
+    def consume(self, nbytes):
+        wait = self.reserve(nbytes)
+        if wait > 0:
+            time.sleep(wait)
+
+
+class BandwidthLimiter:
+    """Token bucket whose rate follows the [bandwidth] section of config.ini.
+
+    The schedule is evaluated again every check_interval seconds, and
+    config.ini is read again when it changed, so the limit can be edited
+    while a transfer runs. A fixed limit (command line) overrides both.
+    share is the part of the limit this process gets when several
+    processes of one machine split it.
+    """
+    CHECK_INTERVAL = 5.0
+
+    def __init__(self, config_path=None, limit=None, check_interval=CHECK_INTERVAL, burst=DEFAULT_BURST, share=1.0):
+        self.config_path = config_path
+        self.fixed = limit
+        self.share = share
+        self.check_interval = check_interval
+        self.bucket = TokenBucket(0.0, burst)
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.default = 0.0
+        self.entries = []
+        self.next_check = 0.0
+        self.update()
+
+    def load(self):
+        try:
+            mtime = os.stat(self.config_path).st_mtime_ns
+        except (OSError, TypeError):
+            return
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+        config = configparser.ConfigParser()
+        config.read(self.config_path)
+        try:
+            self.default = parse_rate(config.get('bandwidth', 'limit', fallback='0'))
+            self.entries = parse_schedule(config.get('bandwidth', 'schedule', fallback=''))
+        except ValueError as e:
+            # keep the previous settings when an edit during the run is wrong
+            logging.error('[bandwidth] in {0}: {1}'.format(self.config_path, e))
+
+    def update(self):
+        if self.fixed is not None:
+            rate = self.fixed
+        else:
+            self.load()
+            rate = scheduled_rate(self.entries, self.default, datetime.datetime.now())
+        rate *= self.share
+        if rate != self.bucket.rate:
+            logging.info('bandwidth limit: {0}'.format('{0:.2f} MB/s'.format(rate / 1e6) if rate > 0 else 'none'))
+            self.bucket.set_rate(rate)
+
+    def reserve(self, nbytes):
+        """Seconds to wait before sending nbytes, for callers that cannot
+        block in consume() (the asyncio engine)"""
+        now = time.monotonic()
+        if now >= self.next_check:
+            with self.lock:
+                if now >= self.next_check:
+                    self.next_check = now + self.check_interval
+                    self.update()
+        return self.bucket.reserve(nbytes)
+
+    def consume(self, nbytes):
+        wait = self.reserve(nbytes)
+        if wait > 0:
+            time.sleep(wait)
+
+    def to_dict(self):
+        return {
+            'limit_bytes_per_second': self.bucket.rate,
+            'throttled_seconds': round(self.bucket.waited, 3),
+        }
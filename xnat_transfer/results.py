@@ -0,0 +1,101 @@
+"""
+    results of an import streamed to disk as they happen: one JSON line (or
+    CSV row) per file in a rotating report, and every failure in fail.csv;
+    memory only holds counters and the first failures, however large the run
+"""
+import collections
+import csv
+import io
+import json
+import logging
+import logging.handlers
+import threading
+import time
+
+DEFAULT_MAX_BYTES = 100 * 1024 * 1024
+DEFAULT_BACKUPS = 5
+# failures kept in memory for the summary printed at the end
+DEFAULT_MAX_FAILURES = 100
+
+KINDS = ('success', 'exist', 'fail')
+
+
+class ResultLog:
+    """Counters of the files handled by a run, by result and failure reason.
+
+    Each result is appended to the report (`.csv` for CSV rows, JSON lines
+    otherwise), renamed to report.1, .2, ... past max_bytes like a rotating
+    log, and failures are written to fail.csv (file name and reason) as
+    soon as they happen. Without paths only the counters are kept.
+    """
+
+    def __init__(self, report_path=None, fail_path=None, max_bytes=DEFAULT_MAX_BYTES,
+                 backups=DEFAULT_BACKUPS, max_failures=DEFAULT_MAX_FAILURES):
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.reasons = collections.Counter()
+        self.failures = collections.OrderedDict()
+        self.failures_not_kept = 0
+        self.max_failures = max_failures
+        self.report_csv = bool(report_path) and report_path.endswith('.csv')
+        self.report = None
+        if report_path:
+            self.report = logging.handlers.RotatingFileHandler(
+                report_path, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+        self.fail_fh = None
+        if fail_path:
+            self.fail_fh = open(fail_path, 'w', newline='')
+            self.fail_writer = csv.writer(self.fail_fh, delimiter=',')
+
+    def record(self, kind, file_name, reason=None, md5=None, replaces=None):
+        """One result; replaces is the result it corrects (a success whose
+        upload turned out different on the server)"""
+        with self.lock:
+            self.counts[kind] += 1
+            if replaces is not None:
+                self.counts[replaces] -= 1
+            if kind == 'fail':
+                self.reasons[reason or 'upload failed'] += 1
+                if len(self.failures) < self.max_failures:
+                    self.failures[file_name] = reason
+                elif file_name not in self.failures:
+                    self.failures_not_kept += 1
+                if self.fail_fh is not None:
+                    self.fail_writer.writerow([file_name, reason] if reason else [file_name])
+                    self.fail_fh.flush()
+        if self.report is not None:
+            self.report.handle(logging.makeLogRecord({'msg': self.format(kind, file_name, reason, md5)}))
+
+    def format(self, kind, file_name, reason, md5):
+        now = round(time.time(), 3)
+        if self.report_csv:
+            line = io.StringIO()
+            csv.writer(line, lineterminator='').writerow([now, kind, file_name, reason or '', md5 or ''])
+            return line.getvalue()
+        entry = {'time': now, 'status': kind, 'file': file_name}
+        if reason:
+            entry['reason'] = reason
+        if md5:
+            entry['md5'] = md5
+        return json.dumps(entry)
+
+    def to_dict(self):
+        with self.lock:
+            counts = dict((kind, self.counts[kind]) for kind in KINDS)
+            counts['fail_reasons'] = dict(self.reasons)
+        return counts
+
+    def summary(self):
+        """Counters and the first failures, printed at the end of a run"""
+        summary = self.to_dict()
+        with self.lock:
+            summary['failures'] = list(self.failures.items())
+            if self.failures_not_kept:
+                summary['failures_not_listed'] = self.failures_not_kept
+        return summary
+
+    def close(self):
+        if self.report is not None:
+            self.report.close()
+        if self.fail_fh is not None:
+            self.fail_fh.close()
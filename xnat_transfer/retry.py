@@ -0,0 +1,164 @@
+import collections
+import contextvars
+import email.utils
+import logging
+import random
+import threading
+import time
+
+try:
+    import requests
+except:
+    print('please type "pip install requests" for installing request package')
+
+# answers worth another try; any other status >= 400 is permanent
+TRANSIENT_STATUS = (408, 425, 429, 500, 502, 503, 504)
+
+
+class PermanentError(Exception):
+    """A failure another attempt cannot fix, e.g. a 403 or an invalid file"""
+
+
+class TransientError(Exception):
+    """A failure worth another try that is not a requests exception,
+    e.g. a 503 answer to the JSESSION call made in the middle of a request"""
+
+
+TRANSIENT_EXCEPTIONS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    TransientError,
+)
+
+
+# set while RetryPolicy.call runs a task (in its thread or asyncio task):
+# the requests of the task are then sent once, its attempts are the retries,
+# so a failing server sees max_attempts requests per task, not their product
+in_task = contextvars.ContextVar('in_task', default=False)
+
+
+def request_attempts(policy):
+    """Attempts the client makes for one request under policy"""
+    return 1 if in_task.get() else policy.max_attempts
+
+
+def classify(response):
+    """'ok', 'transient' or 'permanent'"""
+    if response.status_code < 400:
+        return 'ok'
+    if response.status_code in TRANSIENT_STATUS or response.status_code >= 500:
+        return 'transient'
+    return 'permanent'
+
+
+def retry_after(response):
+    """Seconds asked for by a Retry-After header (delay or HTTP date), or None"""
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """Pauses every worker when the server error rate spikes.
+
+    The outcome of the last `window` requests is kept. When at least
+    `threshold` of them failed with a transient error, the breaker opens
+    and wait() blocks all callers for `cooldown` seconds, so a struggling
+    server is not hammered by every worker at once. A Retry-After answer
+    pauses everyone the same way.
+    """
+
+    def __init__(self, window=50, threshold=0.5, cooldown=30.0, min_requests=10):
+        self.window = window
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.min_requests = min_requests
+        self.lock = threading.Lock()
+        self.outcomes = collections.deque(maxlen=window)
+        self.open_until = 0.0
+
+    def record(self, failed):
+        with self.lock:
+            self.outcomes.append(failed)
+            if len(self.outcomes) < self.min_requests:
+                return
+            if sum(self.outcomes) >= self.threshold * len(self.outcomes):
+                self.open_until = max(self.open_until, time.time() + self.cooldown)
+                self.outcomes.clear()
+                logging.warning('server error rate too high, pausing all transfers for {0:.0f}s'.format(self.cooldown))
+
+    def pause(self, seconds):
+        with self.lock:
+            self.open_until = max(self.open_until, time.time() + seconds)
+
+    def remaining(self):
+        """Seconds until the breaker closes again, 0 when closed"""
+        with self.lock:
+            return max(0.0, self.open_until - time.time())
+
+    def wait(self):
+        while True:
+            remaining = self.remaining()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+
+class RetryPolicy:
+    """Capped exponential backoff with full jitter.
+
+    delay(attempt) is a random value between 0 and
+    min(max_delay, base_delay * 2 ** attempt), or the server's Retry-After
+    when that is longer.
+    """
+
+    def __init__(self, max_attempts=8, base_delay=0.5, max_delay=60.0, breaker=None, metrics=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.metrics = metrics
+
+    def delay(self, attempt, response=None):
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        asked = retry_after(response)
+        if asked is not None:
+            self.breaker.pause(asked)
+            return max(backoff, asked)
+        return backoff
+
+    def call(self, name, function):
+        """Call function until it returns something true.
+        PermanentError stops at once; transient network errors are retried.
+        Returns whether it eventually succeeded.
+        """
+        for attempt in range(self.max_attempts):
+            self.breaker.wait()
+            token = in_task.set(True)
+            try:
+                if function():
+                    return True
+            except PermanentError as e:
+                logging.error('{0} failed permanently: {1}'.format(name, e))
+                return False
+            except TRANSIENT_EXCEPTIONS as e:
+                logging.error('{0}: {1}'.format(name, e))
+            finally:
+                in_task.reset(token)
+            if attempt + 1 < self.max_attempts:
+                if self.metrics is not None:
+                    self.metrics.inc('task_retries')
+                delay = self.delay(attempt)
+                print("Retry({0}) {1} in {2:.1f}s...".format(attempt + 1, name, delay))
+                time.sleep(delay)
+        print("Retry count exceeds max retries({0})!!".format(self.max_attempts))
+        return False
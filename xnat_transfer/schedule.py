@@ -0,0 +1,170 @@
+"""
+    order in which the importer uploads the scans it found: a pipeline
+    stage reading ahead of the uploads and handing over the best scan
+    known so far whenever the uploads take the next one
+"""
+import asyncio
+import contextlib
+import heapq
+import itertools
+import os
+import threading
+
+# walk: the order of the directory walk
+POLICIES = ('walk', 'session', 'smallest', 'metadata', 'subjects')
+DEFAULT_WINDOW = 100
+
+
+def parse_policies(text):
+    """['metadata', 'session'] of 'metadata,session'"""
+    policies = [name.strip() for name in (text or '').split(',') if name.strip()]
+    for name in policies:
+        if name not in POLICIES:
+            raise ValueError('unknown schedule policy {0!r}, expected some of {1}'.format(name, ', '.join(POLICIES)))
+    return [name for name in policies if name != 'walk']
+
+
+def parse_subjects(text):
+    """Subject ids of 'S1,S2', or of a file given as @FILE (one per line)"""
+    if not text:
+        return []
+    if text.startswith('@'):
+        with open(text[1:]) as fh:
+            return [line.strip() for line in fh if line.strip() and not line.startswith('#')]
+    return [name.strip() for name in text.split(',') if name.strip()]
+
+
+def is_metadata(params):
+    """METADATA resources (AIM annotations, ...) of a scan"""
+    file_names = params['file_names']
+    return bool(file_names) and (os.path.basename(os.path.dirname(file_names[0])) == 'METADATA'
+                                 or file_names[0].endswith('aim.xml'))
+
+
+class Scheduler:
+    """Orders scans by a list of policies, compared in turn:
+
+    - session: scans of the session seen first go first, so sessions are
+      completed one after the other instead of all at once
+    - smallest: scans with fewer bytes first
+    - metadata: METADATA / AIM resources before the images
+    - subjects: subjects of the priority list first, in its order
+
+    Up to `window` scans are read ahead of the uploads. A scan is handed
+    over as soon as the upload stage asks for one, the best one read so
+    far, so the workers never wait for a better scan to show up; scans of
+    equal rank keep the order of the walk.
+    """
+
+    def __init__(self, policies=(), subjects=(), window=DEFAULT_WINDOW):
+        self.policies = list(policies)
+        self.subjects = dict((subject_id, rank) for rank, subject_id in reversed(list(enumerate(subjects))))
+        if self.subjects and 'subjects' not in self.policies:
+            self.policies.insert(0, 'subjects')
+        self.window = max(1, window)
+        self.sessions = {}
+
+    @property
+    def active(self):
+        return bool(self.policies)
+
+    def key(self, params):
+        key = []
+        for policy in self.policies:
+            if policy == 'session':
+                session = (params['project_id'], params['session_id'])
+                key.append(self.sessions.setdefault(session, len(self.sessions)))
+            elif policy == 'smallest':
+                key.append(sum(os.path.getsize(file_name) for file_name in params['file_names']))
+            elif policy == 'metadata':
+                key.append(0 if is_metadata(params) else 1)
+            elif policy == 'subjects':
+                key.append(self.subjects.get(params['subject_id'], len(self.subjects)))
+        return key
+
+    def order(self, params_list):
+        """Pipeline stage: the scans of params_list, best first"""
+        heap = []
+        order = itertools.count()
+        cond = threading.Condition()
+        state = {'done': False, 'closed': False, 'error': None}
+
+        def read_ahead():
+            try:
+                for params in params_list:
+                    key = self.key(params)
+                    with cond:
+                        while len(heap) >= self.window and not state['closed']:
+                            cond.wait()
+                        if state['closed']:
+                            return
+                        heapq.heappush(heap, (key, next(order), params))
+                        cond.notify_all()
+            except Exception as e:
+                state['error'] = e
+            finally:
+                with cond:
+                    state['done'] = True
+                    cond.notify_all()
+
+        thread = threading.Thread(target=read_ahead, name='pipeline-schedule-reader', daemon=True)
+        thread.start()
+        try:
+            while True:
+                with cond:
+                    while not heap and not state['done']:
+                        cond.wait()
+                    if not heap:
+                        break
+                    key, rank, params = heapq.heappop(heap)
+                    cond.notify_all()
+                # ranks the files of the scan against those of scans handed over before
+                params['priority'] = (key, rank)
+                yield params
+        finally:
+            with cond:
+                state['closed'] = True
+                cond.notify_all()
+        thread.join()
+        if state['error'] is not None:
+            raise state['error']
+
+
+class PrioritySlots:
+    """asyncio.Semaphore whose free slots go to the waiter of lowest
+    priority first, then in the order they came"""
+
+    def __init__(self, slots):
+        self.free = slots
+        self.waiters = []
+        self.order = itertools.count()
+
+    async def acquire(self, priority=()):
+        if self.free > 0 and not self.waiters:
+            self.free -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.order), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # cancelled after the slot was handed over: pass it on
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self.waiters:
+            future = heapq.heappop(self.waiters)[2]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.free += 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority=()):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
@@ -0,0 +1,151 @@
+"""
+    JSESSIONID management shared by the clients of the three scripts: the
+    session is cached on disk between runs (readable by its owner only)
+    and replaced before the server lets it expire
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+DEFAULT_CACHE = os.path.join('~', '.xnat_transfer', 'sessions.json')
+# XNAT drops a session after 15 idle minutes by default
+DEFAULT_TIMEOUT = 900.0
+# refreshed this long before it would expire
+DEFAULT_MARGIN = 60.0
+# a session used all the time is written to disk at most this often
+SAVE_INTERVAL = 30.0
+
+
+class SessionStore:
+    """JSON file of sessions by server and user, created with mode 0600 in
+    a 0700 directory; a file others can read is ignored."""
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.lock = threading.Lock()
+
+    def read(self):
+        try:
+            if os.name == 'posix' and os.stat(self.path).st_mode & 0o077:
+                logging.warning('{0} can be read by other users: ignored'.format(self.path))
+                return {}
+            with open(self.path) as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return {}
+
+    def load(self, key):
+        entry = self.read().get(key)
+        if entry is None or entry.get('expires', 0) <= time.time():
+            return None
+        return entry
+
+    def save(self, key, entry):
+        with self.lock:
+            sessions = dict((name, value) for name, value in self.read().items()
+                            if value.get('expires', 0) > time.time())
+            if entry is None:
+                sessions.pop(key, None)
+            else:
+                sessions[key] = entry
+            try:
+                os.makedirs(os.path.dirname(self.path) or '.', mode=0o700, exist_ok=True)
+                tmp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+                fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, 'w') as fh:
+                    json.dump(sessions, fh, indent=1)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                logging.warning('cannot cache the session in {0}: {1}'.format(self.path, e))
+
+
+class SessionManager:
+    """The JSESSIONID of one server and user, shared by every thread.
+
+    The session expires `timeout` seconds after its last use (the server's
+    idle timeout) or `max_age` seconds after it was created (0: never);
+    usable() turns false `margin` seconds before that, so the client
+    authenticates again before the server would answer 401. A session
+    read from the cache is not known to be valid until a request
+    succeeded with it (`verified`); clients confirm it before sending a
+    body with it, so a body is never sent only to be rejected.
+    """
+
+    def __init__(self, key, store=None, timeout=DEFAULT_TIMEOUT, max_age=0.0, margin=DEFAULT_MARGIN):
+        self.key = key
+        self.store = store
+        self.timeout = timeout
+        self.max_age = max_age
+        self.margin = min(margin, timeout / 4, max_age / 4 if max_age else margin)
+        self.lock = threading.Lock()
+        self.session_id = None
+        self.created = 0.0
+        self.last_used = 0.0
+        self.saved = 0.0
+        self.verified = False
+        entry = store.load(key) if store is not None else None
+        if entry is not None:
+            self.session_id = entry['session_id']
+            self.created = entry['created']
+            self.last_used = entry['last_used']
+            logging.info('using the cached session of {0}'.format(key))
+
+    @classmethod
+    def from_config(cls, config, base_url, username):
+        """Settings of the [xnat] section of config.ini"""
+        cache = config.get('xnat', 'session_cache', fallback=DEFAULT_CACHE)
+        return cls('{0}@{1}'.format(username, base_url),
+                   SessionStore(cache) if cache else None,
+                   config.getfloat('xnat', 'session_timeout', fallback=DEFAULT_TIMEOUT),
+                   config.getfloat('xnat', 'session_max_age', fallback=0.0))
+
+    def expires(self):
+        expires = self.last_used + self.timeout
+        if self.max_age:
+            expires = min(expires, self.created + self.max_age)
+        return expires
+
+    def usable(self, body=False):
+        """A session is there and will not expire soon; with body, it is also known to be valid"""
+        with self.lock:
+            return (self.session_id is not None and time.time() < self.expires() - self.margin
+                    and (self.verified or not body))
+
+    def set(self, session_id):
+        """A new session from the server"""
+        with self.lock:
+            self.session_id = session_id
+            self.created = self.last_used = time.time()
+            self.verified = True
+            self.save()
+
+    def touch(self, session_id):
+        """A request with session_id succeeded: the server keeps it alive"""
+        with self.lock:
+            if session_id != self.session_id or session_id is None:
+                return
+            self.last_used = time.time()
+            self.verified = True
+            if self.last_used - self.saved >= SAVE_INTERVAL:
+                self.save()
+
+    def invalidate(self, session_id):
+        """The server answered 401 to session_id"""
+        with self.lock:
+            if session_id != self.session_id or session_id is None:
+                return
+            self.session_id = None
+            self.verified = False
+            self.save()
+
+    def save(self):
+        if self.store is None:
+            return
+        self.saved = time.time()
+        entry = None
+        if self.session_id is not None:
+            entry = {'session_id': self.session_id, 'created': self.created,
+                     'last_used': self.last_used, 'expires': self.expires()}
+        self.store.save(self.key, entry)
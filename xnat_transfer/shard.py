@@ -0,0 +1,108 @@
+"""
+    splitting one import between processes or machines that see the same
+    tree: a fixed partition of the subjects by hash (--shard i/N), and / or
+    a claim directory on the shared filesystem in which the first importer
+    reaching a subject takes it, so two importers never create the same
+    subject, session or scan
+"""
+import hashlib
+import logging
+import os
+import socket
+import threading
+import urllib.parse
+
+
+def parse_shard(text):
+    """(index, count) of 'i/N', with 1 <= i <= N"""
+    try:
+        index, count = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise ValueError('bad shard {0!r}, expected i/N such as 1/4'.format(text))
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError('bad shard {0!r}: i must be between 1 and N'.format(text))
+    return index, count
+
+
+def subject_key(project_id, subject_id):
+    return '{0}/{1}'.format(project_id, subject_id)
+
+
+def shard_of(project_id, subject_id, count):
+    """0-based shard of a subject; MD5 so every machine and python agree"""
+    digest = hashlib.md5(subject_key(project_id, subject_id).encode('utf-8')).hexdigest()
+    return int(digest, 16) % count
+
+
+def split_shard(index, count, processes):
+    """Shards of the processes of one machine running shard index/count:
+    process k takes index + count * k of count * processes, which are
+    exactly the subjects of index/count"""
+    return ['{0}/{1}'.format(index + count * k, count * processes) for k in range(processes)]
+
+
+def shard_path(path, index, count):
+    """fail.csv -> fail.shard2of4.csv, so shards run in one directory keep their own files"""
+    if not path or count == 1:
+        return path
+    root, extension = os.path.splitext(path)
+    return '{0}.shard{1}of{2}{3}'.format(root, index, count, extension)
+
+
+class Shard:
+    """Decides which subjects this importer handles.
+
+    With a claim directory, a subject is taken by creating
+    <claim_dir>/<project>/<subject>.claim with O_CREAT | O_EXCL, which
+    only one importer can win, on a local disk as on NFS. The file holds
+    the owner name; an importer run again with the same owner (by default
+    the host and shard) takes its subjects again, e.g. after a crash.
+    """
+
+    def __init__(self, index=1, count=1, claim_dir=None, owner=None, metrics=None):
+        self.index = index
+        self.count = count
+        self.claim_dir = claim_dir
+        self.owner = owner or '{0}-shard{1}of{2}'.format(socket.gethostname(), index, count)
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.decisions = {}
+
+    @property
+    def active(self):
+        return self.count > 1 or bool(self.claim_dir)
+
+    def owns(self, project_id, subject_id, claim=True):
+        key = subject_key(project_id, subject_id)
+        with self.lock:
+            owned = self.decisions.get(key)
+            if owned is None:
+                owned = shard_of(project_id, subject_id, self.count) == self.index - 1
+                if owned and self.claim_dir and claim:
+                    owned = self.claim(project_id, subject_id)
+                self.decisions[key] = owned
+                if self.metrics is not None:
+                    self.metrics.inc('subjects_owned' if owned else 'subjects_skipped')
+        return owned
+
+    def claim_path(self, project_id, subject_id):
+        return os.path.join(self.claim_dir, urllib.parse.quote(project_id, safe=''),
+                            urllib.parse.quote(subject_id, safe='') + '.claim')
+
+    def claim(self, project_id, subject_id):
+        path = self.claim_path(project_id, subject_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            try:
+                with open(path) as fh:
+                    owner = fh.read().strip()
+            except OSError:
+                return False
+            if owner != self.owner:
+                logging.info('{0} claimed by {1}'.format(subject_key(project_id, subject_id), owner or 'another importer'))
+            return owner == self.owner
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(self.owner + '\n')
+        return True
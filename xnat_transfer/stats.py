@@ -0,0 +1,28 @@
+import threading
+import time
+
+
+class TransferStats:
+    """Thread-safe files/bytes counters used to report transfer throughput"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.files = 0
+        self.bytes = 0
+
+    def add(self, nbytes):
+        with self.lock:
+            self.files += 1
+            self.bytes += nbytes
+            return self.files
+
+    def elapsed(self):
+        return max(time.time() - self.start_time, 1e-6)
+
+    def report(self):
+        with self.lock:
+            files, nbytes = self.files, self.bytes
+        elapsed = self.elapsed()
+        return '{0} files, {1:.2f} MB in {2:.1f}s ({3:.2f} files/s, {4:.2f} MB/s)'.format(
+            files, nbytes / 1e6, elapsed, files / elapsed, nbytes / 1e6 / elapsed)
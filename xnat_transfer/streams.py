@@ -0,0 +1,154 @@
+import gzip
+import hashlib
+import os
+import tempfile
+
+
+class FileBody:
+    """File opened for upload, streamed by requests chunk by chunk.
+
+    requests sends objects with read() and a length as a streamed body with
+    a Content-Length header, so at most one chunk of the file is held in
+    memory per upload whatever the file size is. Reads are capped at
+    chunk_size, and seek() lets the client rewind the body when it has to
+    resend it (e.g. after a 401).
+
+    With digest=True the MD5 of the file is computed on the fly while it
+    is sent, see hexdigest().
+    """
+    DEFAULT_CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, file_name, chunk_size=DEFAULT_CHUNK_SIZE, digest=False):
+        self.name = file_name
+        self.chunk_size = chunk_size
+        self.digest = digest
+        self.md5 = hashlib.md5() if digest else None
+        self.fh = open(file_name, 'rb')
+        self.size = os.fstat(self.fh.fileno()).st_size
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.chunk_size:
+            size = self.chunk_size
+        chunk = self.fh.read(size)
+        if self.md5 is not None:
+            self.md5.update(chunk)
+        return chunk
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        position = self.fh.seek(offset, whence)
+        if self.digest and position == 0:
+            self.md5 = hashlib.md5()
+        return position
+
+    def hexdigest(self):
+        """MD5 of the file once it has been read to the end, else None"""
+        if self.md5 is None or self.fh.tell() != self.size:
+            return None
+        return self.md5.hexdigest()
+
+    def tell(self):
+        return self.fh.tell()
+
+    def close(self):
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class GzipBody(FileBody):
+    """gzip-compressed copy of a file, streamed like FileBody.
+
+    The file is compressed once into a spooled temporary file (in memory
+    up to spool_size, then on disk), so the exact Content-Length is known
+    and the body can be rewound for a resend. hexdigest() is the MD5 of
+    the original file.
+    """
+    DEFAULT_SPOOL_SIZE = 8 * 1024 * 1024
+
+    def __init__(self, file_name, level=6, chunk_size=FileBody.DEFAULT_CHUNK_SIZE, spool_size=DEFAULT_SPOOL_SIZE):
+        self.name = file_name
+        self.chunk_size = chunk_size
+        self.digest = False
+        self.md5 = None
+        self.fh = tempfile.SpooledTemporaryFile(spool_size)
+        md5 = hashlib.md5()
+        self.raw_size = 0
+        try:
+            with open(file_name, 'rb') as source, \
+                    gzip.GzipFile(fileobj=self.fh, mode='wb', compresslevel=level, mtime=0) as target:
+                while True:
+                    chunk = source.read(chunk_size)
+                    if not chunk:
+                        break
+                    md5.update(chunk)
+                    self.raw_size += len(chunk)
+                    target.write(chunk)
+        except:
+            self.fh.close()
+            raise
+        self.raw_md5 = md5.hexdigest()
+        self.size = self.fh.tell()
+        self.fh.seek(0)
+
+    def hexdigest(self):
+        return self.raw_md5
+
+
+class ThrottledBody:
+    """Upload body whose reads are paced by a bandwidth limiter.
+
+    Wraps FileBody, GzipBody or a plain file (the zip bundles); reads are
+    capped at chunk_size so the limiter books the bytes in small steps.
+    """
+
+    def __init__(self, body, limiter, chunk_size=FileBody.DEFAULT_CHUNK_SIZE):
+        self.body = body
+        self.limiter = limiter
+        self.chunk_size = chunk_size
+        if hasattr(body, '__len__'):
+            self.size = len(body)
+        else:
+            position = body.tell()
+            self.size = body.seek(0, os.SEEK_END) - position
+            body.seek(position)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.chunk_size:
+            size = self.chunk_size
+        chunk = self.body.read(size)
+        self.limiter.consume(len(chunk))
+        return chunk
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self.body.seek(offset, whence)
+
+    def tell(self):
+        return self.body.tell()
+
+    def __getattr__(self, name):
+        # hexdigest(), name, close(), ... of the wrapped body
+        return getattr(self.body, name)